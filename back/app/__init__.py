@@ -3,6 +3,7 @@ import os
 from flask import Flask, jsonify
 from werkzeug.exceptions import HTTPException
 
+from . import db_profiles
 from .config import Config
 from .extensions import cors, db, jwt, migrate, socketio
 
@@ -12,12 +13,43 @@ def create_app():
     app.config.from_object(Config())
     _configure_logging(app)
 
+    db_profiles.configure(app)
     db.init_app(app)
     migrate.init_app(app, db)
     cors.init_app(app, resources={r"/*": {"origins": app.config.get("CORS_ORIGINS", "*")}})
     jwt.init_app(app)
-    socketio.init_app(app, cors_allowed_origins=app.config.get("CORS_ORIGINS", "*"))
+    from .ws import backpressure
+
+    socketio_options = {}
+    client_manager = backpressure.from_config(app.config)
+    if client_manager is not None:
+        socketio_options["client_manager"] = client_manager
+    socketio.init_app(
+        app,
+        cors_allowed_origins=app.config.get("CORS_ORIGINS", "*"),
+        async_mode=app.config.get("SOCKETIO_ASYNC_MODE"),
+        **socketio_options,
+    )
     _configure_jwt()
+    from . import (
+        archive, db_routing, instrumentation, jobs, loop_monitor, partitions, profiler, push, query_stats,
+        rate_limit, storage, tracing, wire,
+    )
+
+    db_profiles.init_app(app)
+    db_routing.init_app(app)
+    partitions.init_app(app)
+    archive.init_app(app)
+    query_stats.init_app(app)
+    instrumentation.init_app(app)
+    loop_monitor.init_app(app)
+    tracing.init_app(app)
+    profiler.init_app(app)
+    rate_limit.init_app(app)
+    wire.init_app(app)
+    storage.init_app(app)
+    jobs.init_app(app)
+    push.init_app(app)
     from .ws import handlers  # noqa: F401 - register socket handlers
 
     from .blueprints.auth.routes import bp as auth_bp
@@ -25,12 +57,20 @@ def create_app():
     from .blueprints.messages.routes import bp as messages_bp
     from .blueprints.groups.routes import bp as groups_bp
     from .blueprints.uploads.routes import bp as uploads_bp
+    from .blueprints.users.routes import bp as users_bp
+    from .blueprints.monitoring.routes import bp as monitoring_bp
+    from .blueprints.admin.routes import bp as admin_bp
+    from .blueprints.push.routes import bp as push_bp
 
     app.register_blueprint(auth_bp, url_prefix="/auth")
     app.register_blueprint(dialogs_bp, url_prefix="/dialogs")
     app.register_blueprint(messages_bp, url_prefix="/dialogs")
     app.register_blueprint(groups_bp, url_prefix="/groups")
     app.register_blueprint(uploads_bp, url_prefix="/uploads")
+    app.register_blueprint(users_bp, url_prefix="/users")
+    app.register_blueprint(monitoring_bp)
+    app.register_blueprint(admin_bp, url_prefix="/admin")
+    app.register_blueprint(push_bp, url_prefix="/push")
 
     @app.errorhandler(HTTPException)
     def handle_http_exception(err):
@@ -0,0 +1,406 @@
+"""Cold-history archive: old messages moved out of the live tables into segments.
+
+``flask archive run`` copies messages older than ``ARCHIVE_AFTER_DAYS`` into
+immutable segment files under ``ARCHIVE_DIR/<kind>/<conversation_id>/`` and
+deletes them from the database. History paging merges the live page with the
+archive, so clients keep following ``next_cursor`` without noticing the move.
+
+Segment layout (all integers big-endian)::
+
+    MAGIC
+    block*                 zlib-compressed JSON array of rows, ascending id
+    index entry * count    first_id(16) last_id(16) offset(u64) length(u32) rows(u32)
+    footer                 index_offset(u64) count(u32) FOOTER_MAGIC
+
+Files are named ``<first_id>-<last_id>.seg`` (32 hex digits each) so the id
+range of every segment is known from a directory listing. Readers memory-map the
+file and only inflate the blocks a page touches.
+
+Not archived: unread dialog messages (they feed unread counters) and the newest
+message of each conversation (dialog and group previews point at it).
+"""
+import bisect
+import heapq
+import json
+import logging
+import mmap
+import os
+import struct
+import uuid
+import zlib
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import func
+
+from app.extensions import db
+from app.models import Dialog, GroupMessage, Message, User
+from app.utils import metrics
+from app.utils.cache import LRUCache
+from app.utils.ids import parse_id
+from app.utils.time import utcnow
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"POEBARC1"
+FOOTER_MAGIC = b"POEBIDX1"
+_INDEX_ENTRY = struct.Struct(">16s16sQII")
+_FOOTER = struct.Struct(">QI8s")
+
+# Archived columns; ids and timestamps are stored as strings, ``text`` stays encrypted.
+COLUMNS = (
+    "id", "sender_id", "client_msg_id", "type", "text", "file_url", "file_name",
+    "file_mime", "file_size", "created_at", "delivered_at", "read_at",
+)
+_DATETIME_COLUMNS = ("created_at", "delivered_at", "read_at")
+
+KINDS = {
+    "dialog": (Message, "dialog_id"),
+    "group": (GroupMessage, "group_id"),
+}
+
+archive_cli = AppGroup("archive", help="Move old messages into the cold-history archive.")
+
+
+class SegmentWriter:
+    def __init__(self, path: str, block_rows: int):
+        self.path = path
+        self.block_rows = block_rows
+
+    def write(self, rows) -> int:
+        """Write ``rows`` (dicts in ascending id order) atomically; returns the byte size."""
+        tmp_path = self.path + ".tmp"
+        index = []
+        with open(tmp_path, "wb") as fh:
+            fh.write(MAGIC)
+            offset = len(MAGIC)
+            for start in range(0, len(rows), self.block_rows):
+                block = rows[start:start + self.block_rows]
+                data = zlib.compress(json.dumps(block, separators=(",", ":")).encode(), 6)
+                fh.write(data)
+                index.append((_id_bytes(block[0]["id"]), _id_bytes(block[-1]["id"]), offset, len(data), len(block)))
+                offset += len(data)
+            for entry in index:
+                fh.write(_INDEX_ENTRY.pack(*entry))
+            fh.write(_FOOTER.pack(offset, len(index), FOOTER_MAGIC))
+            fh.flush()
+            os.fsync(fh.fileno())
+            size = fh.tell()
+        os.replace(tmp_path, self.path)
+        _fsync_dir(os.path.dirname(self.path))
+        return size
+
+
+class Segment:
+    """Read-only view of one memory-mapped segment file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path}: not an archive segment")
+        index_offset, count, footer_magic = _FOOTER.unpack_from(self._map, len(self._map) - _FOOTER.size)
+        if footer_magic != FOOTER_MAGIC:
+            raise ValueError(f"{path}: truncated archive segment")
+        self.blocks = [
+            _INDEX_ENTRY.unpack_from(self._map, index_offset + i * _INDEX_ENTRY.size) for i in range(count)
+        ]
+        self._first_ids = [block[0] for block in self.blocks]
+
+    def read_block(self, number: int) -> list:
+        _, _, offset, length, _ = self.blocks[number]
+        return json.loads(zlib.decompress(self._map[offset:offset + length]))
+
+    def block(self, number: int) -> list:
+        key = (self.path, number)
+        rows = _block_cache().get(key)
+        if rows is None:
+            rows = self.read_block(number)
+            _block_cache().set(key, rows)
+            metrics.incr("archive_blocks_inflated")
+        return rows
+
+    def newest_before(self, before: bytes, limit: int) -> list:
+        """Up to ``limit`` rows with id < ``before`` (all rows if None), newest first."""
+        if before is None:
+            number = len(self.blocks) - 1
+        else:
+            number = bisect.bisect_left(self._first_ids, before) - 1
+        found = []
+        while number >= 0 and len(found) < limit:
+            for row in reversed(self.block(number)):
+                if before is None or _id_bytes(row["id"]) < before:
+                    found.append(row)
+                    if len(found) == limit:
+                        break
+            number -= 1
+        return found
+
+
+_segments = None
+_blocks = None
+_listings = {}
+
+
+def _segment_cache() -> LRUCache:
+    global _segments
+    if _segments is None:
+        _segments = LRUCache(current_app.config.get("ARCHIVE_OPEN_SEGMENTS", 128))
+    return _segments
+
+
+def _block_cache() -> LRUCache:
+    global _blocks
+    if _blocks is None:
+        _blocks = LRUCache(current_app.config.get("ARCHIVE_BLOCK_CACHE_SIZE", 256))
+    return _blocks
+
+
+def _id_bytes(value) -> bytes:
+    parsed = parse_id(value)
+    return parsed.bytes if parsed is not None else b""
+
+
+def _fsync_dir(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def conversation_dir(kind: str, conversation_id: str) -> str:
+    return os.path.join(current_app.config["ARCHIVE_DIR"], kind, str(conversation_id))
+
+
+def _listing(kind: str, conversation_id: str) -> list:
+    """``(first_id, last_id, path)`` of every segment, refreshed when the directory changes.
+
+    The archive job usually runs in another process, so the directory mtime is
+    checked on every call; it costs one ``stat`` per history page.
+    """
+    path = conversation_dir(kind, conversation_id)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    cached = _listings.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    segments = []
+    for name in sorted(os.listdir(path)):
+        if not name.endswith(".seg"):
+            continue
+        first_hex, _, last_hex = name[:-4].partition("-")
+        segments.append((bytes.fromhex(first_hex), bytes.fromhex(last_hex), os.path.join(path, name)))
+    _listings[path] = (mtime, segments)
+    return segments
+
+
+def _open(path: str) -> Segment:
+    cache = _segment_cache()
+    segment = cache.get(path)
+    if segment is None:
+        segment = Segment(path)
+        cache.set(path, segment)
+    return segment
+
+
+def bound_for_datetime(dt: datetime) -> uuid.UUID:
+    """Smallest v7 id at ``dt``; turns legacy timestamp cursors into id bounds."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return uuid.UUID(int=int(dt.timestamp() * 1000) << 80)
+
+
+def _row_to_message(row: dict, senders: dict):
+    values = dict(row)
+    for column in _DATETIME_COLUMNS:
+        if values[column] is not None:
+            values[column] = datetime.fromisoformat(values[column])
+    return SimpleNamespace(**values, sender=senders.get(values["sender_id"]))
+
+
+def read_page(kind: str, conversation_id: str, before=None, limit: int = 30, after=None) -> list:
+    """Archived messages of a conversation with ``after`` < id < ``before``, newest first.
+
+    Returns objects with the model's attributes plus ``sender``, so the route
+    serializers handle them like live rows.
+    """
+    segments = _listing(kind, conversation_id)
+    if not segments:
+        return []
+    before_bytes = parse_id(before).bytes if before is not None else None
+    after_bytes = _id_bytes(after) if after is not None else None
+    rows = []
+    for first_id, last_id, path in reversed(segments):
+        if before_bytes is not None and first_id >= before_bytes:
+            continue
+        if after_bytes is not None and last_id <= after_bytes:
+            continue
+        rows.extend(_open(path).newest_before(before_bytes, limit))
+    if after_bytes is not None:
+        rows = [row for row in rows if _id_bytes(row["id"]) > after_bytes]
+    if not rows:
+        return []
+    metrics.incr("archive_page_reads", kind=kind)
+    rows.sort(key=lambda row: _id_bytes(row["id"]), reverse=True)
+    return _as_messages(kind, conversation_id, rows[:limit])
+
+
+def _iter_segment(kind: str, conversation_id: str, path: str):
+    segment = _open(path)
+    for number in range(len(segment.blocks)):
+        yield from _as_messages(kind, conversation_id, segment.read_block(number))
+
+
+def iter_archived(kind: str, conversation_id: str):
+    """Every archived message of a conversation, oldest first, one block at a time.
+
+    Segments from different archive runs can overlap in id range (rows kept
+    live as unread are archived by a later run), so they are merged rather
+    than chained. Blocks bypass the block cache so a full scan doesn't evict
+    what history pages use.
+    """
+    yield from heapq.merge(
+        *(_iter_segment(kind, conversation_id, path) for _, _, path in _listing(kind, conversation_id)),
+        key=lambda message: _id_bytes(message.id),
+    )
+
+
+def _as_messages(kind: str, conversation_id: str, rows: list) -> list:
+    _, column = KINDS[kind]
+    sender_ids = {row["sender_id"] for row in rows}
+    senders = {user.id: user for user in User.query.filter(User.id.in_(sender_ids))}
+    conversation_id = str(conversation_id)
+    messages = []
+    for row in rows:
+        message = _row_to_message(row, senders)
+        setattr(message, column, conversation_id)
+        messages.append(message)
+    return messages
+
+
+def continue_page(kind: str, conversation_id: str, live: list, limit: int, before=None) -> list:
+    """Fill a live history page (newest first) from the archive.
+
+    Live and archived ids interleave: unread dialog messages and the newest
+    message stay live while older and newer neighbours are archived. So the
+    archive is merged in even when the live page is full, limited to rows newer
+    than the oldest live one on it, which usually skips every segment. A row
+    that is both live and archived (an interrupted archive run) is returned once.
+    """
+    if not _listing(kind, conversation_id):
+        return live
+    after = live[-1].id if len(live) >= limit else None
+    archived = read_page(kind, conversation_id, before, limit, after)
+    if not archived:
+        return live
+    seen = {str(message.id) for message in live}
+    merged = live + [message for message in archived if str(message.id) not in seen]
+    merged.sort(key=lambda message: _id_bytes(message.id), reverse=True)
+    return merged[:limit]
+
+
+def _row_dict(message) -> dict:
+    row = {}
+    for column in COLUMNS:
+        value = getattr(message, column)
+        if column in _DATETIME_COLUMNS and value is not None:
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=timezone.utc)
+            value = value.isoformat()
+        row[column] = str(value) if column == "id" else value
+    return row
+
+
+def _archivable(kind: str, conversation_id, cutoff: datetime):
+    model, column = KINDS[kind]
+    query = model.query.filter(getattr(model, column) == conversation_id, model.created_at < cutoff)
+    newest = (
+        db.session.query(func.max(model.id)).filter(getattr(model, column) == conversation_id).scalar()
+    )
+    if newest is not None:
+        query = query.filter(model.id != newest)
+    if kind == "dialog":
+        query = query.filter(Message.read_at.isnot(None))
+        last_message_id = db.session.query(Dialog.last_message_id).filter(Dialog.id == conversation_id).scalar()
+        if last_message_id is not None:
+            query = query.filter(Message.id != last_message_id)
+    return query
+
+
+def archive_conversation(kind: str, conversation_id, cutoff: datetime) -> int:
+    """Move the archivable messages of one conversation into new segments."""
+    model, _ = KINDS[kind]
+    segment_rows = current_app.config.get("ARCHIVE_SEGMENT_ROWS", 50000)
+    block_rows = current_app.config.get("ARCHIVE_BLOCK_ROWS", 256)
+    directory = conversation_dir(kind, conversation_id)
+    moved = 0
+    while True:
+        messages = _archivable(kind, conversation_id, cutoff).order_by(model.id).limit(segment_rows).all()
+        if not messages:
+            break
+        rows = [_row_dict(message) for message in messages]
+        os.makedirs(directory, exist_ok=True)
+        name = f"{_id_bytes(rows[0]['id']).hex()}-{_id_bytes(rows[-1]['id']).hex()}.seg"
+        size = SegmentWriter(os.path.join(directory, name), block_rows).write(rows)
+        # The segment is durable before the rows go; a crash in between only
+        # leaves duplicates, which readers drop.
+        ids = [message.id for message in messages]
+        for start in range(0, len(ids), 500):
+            model.query.filter(model.id.in_(ids[start:start + 500])).delete(synchronize_session=False)
+        db.session.commit()
+        metrics.incr("archive_rows_moved", len(rows), kind=kind)
+        metrics.incr("archive_bytes_written", size, kind=kind)
+        moved += len(rows)
+        if len(messages) < segment_rows:
+            break
+    return moved
+
+
+def run_archive(older_than_days: int = None, kinds=None, max_conversations: int = None) -> dict:
+    """Archive every conversation with messages past the cutoff; returns rows moved per kind."""
+    if older_than_days is None:
+        older_than_days = current_app.config.get("ARCHIVE_AFTER_DAYS", 180)
+    cutoff = utcnow() - timedelta(days=older_than_days)
+    moved = {}
+    for kind in kinds or KINDS:
+        model, column = KINDS[kind]
+        conversation_ids = [
+            row[0]
+            for row in db.session.query(getattr(model, column))
+            .filter(model.created_at < cutoff)
+            .distinct()
+            .limit(max_conversations)
+        ]
+        moved[kind] = 0
+        for conversation_id in conversation_ids:
+            try:
+                moved[kind] += archive_conversation(kind, conversation_id, cutoff)
+            except Exception:
+                db.session.rollback()
+                logger.exception("Archiving %s %s failed", kind, conversation_id)
+    return moved
+
+
+@archive_cli.command("run")
+@click.option("--days", type=int, default=None, help="Archive messages older than this many days.")
+@click.option("--kind", type=click.Choice(sorted(KINDS)), multiple=True, help="Conversation kinds to archive.")
+@click.option("--max-conversations", type=int, default=None, help="Stop after this many conversations per kind.")
+def run_command(days, kind, max_conversations):
+    """Move old messages into archive segments."""
+    moved = run_archive(days, kind or None, max_conversations)
+    click.echo(", ".join(f"{kind}: {count} messages" for kind, count in moved.items()))
+
+
+def init_app(app):
+    app.cli.add_command(archive_cli)
+
+
+metrics.register_gauge("archive_open_segments", lambda: len(_segments) if _segments else 0)
+metrics.register_gauge("archive_cached_blocks", lambda: len(_blocks) if _blocks else 0)
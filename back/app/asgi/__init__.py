@@ -0,0 +1,49 @@
+"""Asyncio/ASGI serving mode, started with ``uvicorn asgi:app`` from ``back/``.
+
+Socket.IO events are served natively by python-socketio's ``AsyncServer`` with an
+async SQLAlchemy engine (``app/asgi/handlers.py``). The REST routes are the same
+Flask app behind asgiref's ``WsgiToAsgi``, which runs them on a single worker
+thread. Events that REST routes send through ``app.ws.outbound`` are handed to
+the event loop.
+
+Extra dependencies are listed in ``requirements-asgi.txt``.
+"""
+import asyncio
+
+import socketio
+from asgiref.wsgi import WsgiToAsgi
+
+from app import create_app, loop_monitor, tracing
+from app.asgi.database import make_session_factory
+from app.asgi.handlers import register_handlers
+from app.ws import backpressure
+from app.ws import outbound
+
+
+def create_asgi_app():
+    flask_app = create_app()
+    if flask_app.extensions["socketio"].async_mode == "eventlet":
+        raise RuntimeError("Set SOCKETIO_ASYNC_MODE=threading before importing the app (see asgi.py)")
+    sio = socketio.AsyncServer(
+        async_mode="asgi",
+        cors_allowed_origins=flask_app.config.get("CORS_ORIGINS", "*"),
+        client_manager=backpressure.from_config(flask_app.config, backpressure.AsyncBoundedManager),
+    )
+    register_handlers(sio, flask_app, make_session_factory(flask_app))
+    loop = None
+    monitor_task = None  # the loop only keeps weak references to tasks
+
+    def emit_from_thread(event, data, to):
+        asyncio.run_coroutine_threadsafe(sio.emit(event, data, to=to), loop)
+
+    async def on_startup():
+        nonlocal loop, monitor_task
+        loop = asyncio.get_running_loop()
+        outbound.set_backend(emit_from_thread, sio.manager)
+        if flask_app.config.get("LOOP_MONITOR_INTERVAL"):
+            monitor_task = loop.create_task(loop_monitor.run_asyncio(flask_app))
+
+    # uvicorn re-raises SIGTERM after shutdown, so atexit handlers don't run.
+    return socketio.ASGIApp(
+        sio, other_asgi_app=WsgiToAsgi(flask_app), on_startup=on_startup, on_shutdown=tracing.flush
+    )
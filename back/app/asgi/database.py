@@ -0,0 +1,48 @@
+"""Async SQLAlchemy engine for the ASGI mode, configured from the same DB profile."""
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app.db_profiles import local_statement_timeout_listener, sqlite_pragmas_listener
+
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+
+def async_url(url):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f"No async driver configured for {backend!r}")
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+def make_session_factory(flask_app) -> async_sessionmaker:
+    profile = flask_app.extensions["db_profile"]
+    url = async_url(flask_app.config["SQLALCHEMY_DATABASE_URI"])
+    options = {}
+    if not (url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")):
+        options.update(
+            poolclass=AsyncAdaptedQueuePool,
+            pool_size=profile["pool_size"],
+            max_overflow=profile["max_overflow"],
+            pool_timeout=profile["pool_timeout"],
+            pool_recycle=profile["pool_recycle"],
+            pool_pre_ping=profile["pool_pre_ping"],
+        )
+    if url.get_backend_name() == "postgresql":
+        if profile.get("statement_timeout_mode") == "startup":
+            server_settings = {"application_name": "poebtalk"}
+            if profile["statement_timeout_ms"]:
+                server_settings["statement_timeout"] = str(profile["statement_timeout_ms"])
+            options["connect_args"] = {"server_settings": server_settings}
+        else:
+            # Transaction-mode poolers can't keep asyncpg's prepared statements.
+            options["connect_args"] = {"statement_cache_size": 0}
+            url = url.update_query_dict({"prepared_statement_cache_size": "0"})
+    engine = create_async_engine(url, **options)
+    if url.get_backend_name() == "sqlite" and profile.get("sqlite_pragmas"):
+        event.listen(engine.sync_engine, "connect", sqlite_pragmas_listener(profile["sqlite_pragmas"]))
+    if profile.get("statement_timeout_mode") == "transaction" and profile["statement_timeout_ms"]:
+        event.listen(engine.sync_engine, "begin", local_statement_timeout_listener(profile["statement_timeout_ms"]))
+    return async_sessionmaker(engine, expire_on_commit=False)
@@ -0,0 +1,344 @@
+"""Socket.IO events on python-socketio's ``AsyncServer``.
+
+Same protocol as ``app/ws/handlers.py`` (the eventlet mode): same event names,
+payloads, validation and error messages. Database work goes through an
+``AsyncSession``; the in-process caches (``app.events``) are only touched on
+asgiref's sync thread, which is also where the Flask routes run.
+"""
+from asgiref.sync import sync_to_async
+from flask_jwt_extended import decode_token
+from sqlalchemy import select, update
+from sqlalchemy.orm import selectinload
+
+from app import db_routing, events, idempotency, instrumentation, rate_limit, tracing
+from app.ws import outbound
+from app.models import Dialog, Group, GroupMember, GroupMessage, Message
+from app.serializers import serialize_group_message, serialize_message
+from app.utils.security import encrypt_text
+from app.utils.time import isoformat, parse_iso8601, utcnow
+
+
+def _content_error(msg_type, text, file_url, file_name):
+    if msg_type == "text":
+        if text is None:
+            return "text is required for text messages"
+    elif msg_type in {"file", "image"}:
+        if not file_url or not file_name:
+            return "file_url and file_name are required for attachments"
+    else:
+        return "Unsupported message type"
+    return None
+
+
+def register_handlers(sio, flask_app, session_factory):
+    partitioned = bool(flask_app.config.get("MESSAGE_PARTITIONING"))
+
+    @sync_to_async
+    def run_hook(func, *args, writer_id=None):
+        with flask_app.app_context():
+            func(*args)
+            if writer_id is not None:
+                db_routing.mark_write(writer_id)
+
+    async def emit(event: str, data: dict, to: str):
+        outbound.record(event, to)
+        await sio.emit(event, data, to=to)
+
+    async def emit_error(sid, message: str):
+        await emit("error", {"error": {"code": "ws_error", "message": message}}, to=sid)
+
+    @sio.on("connect")
+    async def handle_connect(sid, environ, auth=None):
+        await sio.save_session(sid, {"user_id": None})
+
+    @sio.on("message")
+    async def handle_message(sid, data):
+        if not isinstance(data, dict) or "type" not in data:
+            await emit_error(sid, "Invalid payload")
+            return
+        event_type = data.get("type")
+        payload = data.get("payload") or {}
+
+        if event_type == "auth":
+            await handle_auth(sid, data)
+            return
+
+        user_id = (await sio.get_session(sid)).get("user_id")
+        if not user_id:
+            await emit_error(sid, "Unauthorized")
+            await sio.disconnect(sid)
+            return
+        retry_after = rate_limit.check(user_id, event_type, "asgi")
+        if retry_after:
+            await emit("error", rate_limit.ws_error(event_type, retry_after, payload), to=sid)
+            return
+
+        handler = {
+            "message:send": handle_message_send,
+            "message:delivered": handle_message_delivered,
+            "message:read": handle_message_read,
+            "group:message:send": handle_group_message_send,
+        }.get(event_type)
+        if handler is None:
+            await emit_error(sid, "Unknown event type")
+            return
+        with instrumentation.ws_event(event_type, config=flask_app.config.get):
+            await handler(sid, user_id, payload)
+
+    async def handle_auth(sid, data):
+        token = data.get("access_token") or (data.get("payload") or {}).get("access_token")
+        if not token:
+            await emit_error(sid, "access_token is required")
+            await sio.disconnect(sid)
+            return
+        try:
+            with flask_app.app_context():
+                decoded = decode_token(token)
+        except Exception:
+            await emit_error(sid, "Invalid token")
+            await sio.disconnect(sid)
+            return
+        if decoded.get("type") != "access":
+            await emit_error(sid, "Invalid token type")
+            await sio.disconnect(sid)
+            return
+        user_id = decoded.get("sub")
+        await sio.save_session(sid, {"user_id": user_id})
+        await sio.enter_room(sid, f"user:{user_id}")
+        reply = outbound.negotiate(user_id, data)
+        if reply:
+            await emit("auth:ok", reply, to=sid)
+            outbound.apply(sid, reply)
+
+    async def handle_message_send(sid, user_id: str, payload: dict):
+        dialog_id = payload.get("dialog_id")
+        client_msg_id = payload.get("client_msg_id")
+        msg_type = payload.get("msg_type") or payload.get("type") or payload.get("message_type") or "text"
+        text = payload.get("text")
+        if not dialog_id or not client_msg_id:
+            await emit_error(sid, "dialog_id and client_msg_id are required")
+            return
+        trace = tracing.MessageTrace("dialog", "asgi")
+        async with session_factory() as session:
+            with trace.stage("load"):
+                dialog = await session.get(Dialog, dialog_id)
+            if not dialog or not dialog.includes_user(user_id):
+                await emit_error(sid, "Dialog not found or access denied")
+                return
+            error = _content_error(msg_type, text, payload.get("file_url"), payload.get("file_name"))
+            if error:
+                await emit_error(sid, error)
+                return
+            with trace.stage("insert"):
+                message, created = await idempotency.get_or_insert_async(
+                    session,
+                    Message,
+                    user_id,
+                    client_msg_id,
+                    lambda: dict(
+                        dialog_id=dialog_id,
+                        sender_id=user_id,
+                        client_msg_id=client_msg_id,
+                        type=msg_type,
+                        text=trace.timed("encrypt", encrypt_text, text) if text else None,
+                        file_url=payload.get("file_url"),
+                        file_name=payload.get("file_name"),
+                        file_mime=payload.get("file_mime"),
+                        file_size=payload.get("file_size"),
+                        created_at=utcnow(),
+                    ),
+                    partitioned=partitioned,
+                    options=[selectinload(Message.sender)],
+                )
+            if not message or message.dialog_id != dialog_id:
+                await emit_error(sid, "Message conflict")
+                return
+            if created:
+                dialog.last_message_id = message.id
+                dialog.last_message_at = message.created_at
+                with trace.stage("commit"):
+                    await session.commit()
+
+        with trace.stage("serialize"):
+            msg_payload = serialize_message(message)
+        if created:
+            with trace.stage("cache"):
+                await run_hook(
+                    events.message_sent,
+                    "dialog",
+                    dialog_id,
+                    message.created_at,
+                    msg_payload,
+                    [dialog.user1_id, dialog.user2_id],
+                    writer_id=user_id,
+                )
+        with trace.stage("emit"):
+            await emit(
+                "message:ack",
+                {"type": "message:ack", "payload": {"client_msg_id": client_msg_id, "message": msg_payload}},
+                to=sid,
+            )
+            peer_id = dialog.user1_id if dialog.user2_id == user_id else dialog.user2_id
+            await emit("message:new", {"type": "message:new", "payload": {"message": msg_payload}}, to=f"user:{peer_id}")
+        trace.finish(message.id, created)
+
+    async def handle_message_delivered(sid, user_id: str, payload: dict):
+        message_id = payload.get("message_id")
+        delivered_at_raw = payload.get("delivered_at")
+        if not message_id or not delivered_at_raw:
+            await emit_error(sid, "message_id and delivered_at are required")
+            return
+        async with session_factory() as session:
+            message = await session.get(Message, message_id, options=[selectinload(Message.dialog)])
+            if not message or not message.dialog.includes_user(user_id):
+                await emit_error(sid, "Message not found or access denied")
+                return
+            if message.delivered_at:
+                return
+            delivered_at_dt = parse_iso8601(delivered_at_raw)
+            if not delivered_at_dt:
+                await emit_error(sid, "Invalid delivered_at format")
+                return
+            message.delivered_at = delivered_at_dt
+            await session.commit()
+        await run_hook(events.message_delivered, "dialog", message.dialog_id, message.id, message.delivered_at)
+        tracing.delivered("dialog", message, "asgi")
+        await emit(
+            "message:status",
+            {
+                "type": "message:status",
+                "payload": {
+                    "dialog_id": message.dialog_id,
+                    "message_id": message.id,
+                    "delivered_at": isoformat(message.delivered_at),
+                    "read_at": isoformat(message.read_at),
+                },
+            },
+            to=f"user:{message.sender_id}",
+        )
+
+    async def handle_message_read(sid, user_id: str, payload: dict):
+        dialog_id = payload.get("dialog_id")
+        last_read_message_id = payload.get("last_read_message_id")
+        read_at_raw = payload.get("read_at")
+        if not dialog_id or not last_read_message_id or not read_at_raw:
+            await emit_error(sid, "dialog_id, last_read_message_id and read_at are required")
+            return
+        async with session_factory() as session:
+            dialog = await session.get(Dialog, dialog_id)
+            if not dialog or not dialog.includes_user(user_id):
+                await emit_error(sid, "Dialog not found or access denied")
+                return
+            target_message = (
+                await session.execute(select(Message).filter_by(id=last_read_message_id, dialog_id=dialog_id))
+            ).scalars().first()
+            if not target_message:
+                await emit_error(sid, "Message not found")
+                return
+            read_at_dt = parse_iso8601(read_at_raw)
+            if not read_at_dt:
+                await emit_error(sid, "Invalid read_at")
+                return
+            await session.execute(
+                update(Message)
+                .where(
+                    Message.dialog_id == dialog_id,
+                    Message.sender_id != user_id,
+                    Message.created_at <= target_message.created_at,
+                    Message.read_at.is_(None),
+                )
+                .values(read_at=read_at_dt)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        await run_hook(
+            events.messages_read, "dialog", dialog_id, user_id, target_message.created_at, read_at_dt, writer_id=user_id
+        )
+        tracing.read("dialog", target_message, "asgi")
+        await emit(
+            "message:status",
+            {
+                "type": "message:status",
+                "payload": {
+                    "dialog_id": dialog_id,
+                    "message_id": last_read_message_id,
+                    "delivered_at": isoformat(target_message.delivered_at),
+                    "read_at": isoformat(read_at_dt),
+                },
+            },
+            to=f"user:{target_message.sender_id}",
+        )
+
+    async def handle_group_message_send(sid, user_id: str, payload: dict):
+        group_id = payload.get("group_id")
+        client_msg_id = payload.get("client_msg_id")
+        msg_type = payload.get("msg_type") or payload.get("type") or "text"
+        text = payload.get("text")
+        if not group_id or not client_msg_id:
+            await emit_error(sid, "group_id and client_msg_id are required")
+            return
+        trace = tracing.MessageTrace("group", "asgi")
+        async with session_factory() as session:
+            with trace.stage("load"):
+                group = await session.get(Group, group_id)
+                if not group:
+                    await emit_error(sid, "Group not found")
+                    return
+                member_ids = list(
+                    (await session.execute(select(GroupMember.user_id).filter_by(group_id=group_id))).scalars()
+                )
+            if user_id not in member_ids:
+                await emit_error(sid, "Not a member of group")
+                return
+            error = _content_error(msg_type, text, payload.get("file_url"), payload.get("file_name"))
+            if error:
+                await emit_error(sid, error)
+                return
+            with trace.stage("insert"):
+                message, created = await idempotency.get_or_insert_async(
+                    session,
+                    GroupMessage,
+                    user_id,
+                    client_msg_id,
+                    lambda: dict(
+                        group_id=group_id,
+                        sender_id=user_id,
+                        client_msg_id=client_msg_id,
+                        type=msg_type,
+                        text=trace.timed("encrypt", encrypt_text, text) if text else None,
+                        file_url=payload.get("file_url"),
+                        file_name=payload.get("file_name"),
+                        file_mime=payload.get("file_mime"),
+                        file_size=payload.get("file_size"),
+                        created_at=utcnow(),
+                    ),
+                    partitioned=partitioned,
+                    options=[selectinload(GroupMessage.sender)],
+                )
+            if not message or message.group_id != group_id:
+                await emit_error(sid, "Message conflict")
+                return
+            if created:
+                with trace.stage("commit"):
+                    await session.commit()
+
+        with trace.stage("serialize"):
+            msg_payload = serialize_group_message(message)
+        if created:
+            with trace.stage("cache"):
+                await run_hook(
+                    events.message_sent, "group", group_id, message.created_at, msg_payload, member_ids, writer_id=user_id
+                )
+        with trace.stage("emit"):
+            await emit(
+                "group:message:ack",
+                {"type": "group:message:ack", "payload": {"client_msg_id": client_msg_id, "message": msg_payload}},
+                to=f"user:{user_id}",
+            )
+            for uid in member_ids:
+                await emit(
+                    "group:message:new",
+                    {"type": "group:message:new", "payload": {"message": msg_payload}},
+                    to=f"user:{uid}",
+                )
+        trace.finish(message.id, created)
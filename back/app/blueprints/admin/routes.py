@@ -0,0 +1,76 @@
+from functools import wraps
+
+from flask import Blueprint, Response, current_app, jsonify, request
+from flask_jwt_extended import get_jwt_identity, jwt_required
+
+from app import profiler
+from app.extensions import socketio
+
+bp = Blueprint("admin", __name__)
+
+
+def error_response(code: str, message: str, status: int):
+    return jsonify({"error": {"code": code, "message": message}}), status
+
+
+def admin_required(view):
+    """Only users listed in ``ADMIN_USER_IDS``; with the list empty, nobody."""
+
+    @wraps(view)
+    @jwt_required()
+    def wrapper(*args, **kwargs):
+        if get_jwt_identity() not in current_app.config.get("ADMIN_USER_IDS", ()):
+            return error_response("forbidden", "Admin only", 403)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def _profile_response(profile):
+    if not profile.done:
+        return jsonify({"profile": profile.summary()}), 202
+    response = Response(profile.collapsed(), mimetype="text/plain")
+    response.headers["X-Profile-Samples"] = str(profile.samples)
+    response.headers["X-Profile-Idle-Samples"] = str(profile.idle_samples)
+    return response
+
+
+@bp.route("/profile", methods=["POST"])
+@admin_required
+def start_profile():
+    """Sample the worker's stacks; the response is a collapsed-stack profile.
+
+    With ``wait=0`` it returns 202 at once and ``GET /admin/profile`` fetches
+    the result, so the request doesn't hold a worker for the whole run. That is
+    the default, and the only choice, outside eventlet: in the ASGI mode REST
+    runs on one thread, which waiting would take from every other request.
+    """
+    green = socketio.async_mode == "eventlet"
+    wait = request.args.get("wait", "1" if green else "0") != "0"
+    if wait and not green:
+        return error_response("bad_request", "wait=1 needs the eventlet server; poll GET /admin/profile", 400)
+    seconds = request.args.get("seconds", current_app.config["PROFILE_DEFAULT_SECONDS"], type=float)
+    interval = request.args.get("interval", current_app.config["PROFILE_INTERVAL"], type=float)
+    if not seconds or seconds <= 0 or not interval or interval <= 0:
+        return error_response("bad_request", "seconds and interval must be positive", 400)
+    if seconds > current_app.config["PROFILE_MAX_SECONDS"]:
+        return error_response("bad_request", f"seconds must be at most {current_app.config['PROFILE_MAX_SECONDS']:g}", 400)
+    try:
+        profile = profiler.start(seconds, interval, include_idle=request.args.get("idle") == "1")
+    except profiler.ProfilerBusy as exc:
+        return error_response("conflict", str(exc), 409)
+    if not wait:
+        return jsonify({"profile": profile.summary()}), 202
+    while not profile.done:
+        # A green sleep under eventlet: the worker keeps serving while we wait.
+        socketio.sleep(0.1)
+    return _profile_response(profile)
+
+
+@bp.route("/profile", methods=["GET"])
+@admin_required
+def last_profile():
+    profile = profiler.last()
+    if profile is None:
+        return error_response("not_found", "No profile has been taken", 404)
+    return _profile_response(profile)
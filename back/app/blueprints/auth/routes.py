@@ -6,6 +6,7 @@ from flask_jwt_extended import (
 )
 
 from app.extensions import db
+from app.blueprints.users.routes import invalidate_search_cache
 from app.models import User
 from app.utils.security import hash_password, verify_password
 
@@ -35,6 +36,7 @@ def register():
     user.password_hash = hash_password(password)
     db.session.add(user)
     db.session.commit()
+    invalidate_search_cache(username)
 
     access_token = create_access_token(identity=user.id, additional_claims={"type": "access"})
     refresh_token = create_refresh_token(identity=user.id, additional_claims={"type": "refresh"})
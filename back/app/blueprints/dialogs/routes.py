@@ -3,8 +3,13 @@ from datetime import datetime
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import get_jwt_identity, jwt_required
 
+from app import versions
+from app.db_routing import replica_reads
+from app.query_stats import count_items, query_budget
 from app.extensions import db, socketio
+from app.list_cache import cached_list_response, invalidate_dialogs
 from app.models import Dialog, Message, User
+from app.utils.http_cache import conditional_json
 from app.utils.time import isoformat, utcnow
 from app.utils.security import decrypt_text
 
@@ -66,15 +71,38 @@ def serialize_dialog(dialog: Dialog, current_user_id: str):
 
 
 @bp.route("", methods=["GET"])
+@replica_reads
+@query_budget(1, per_item=3)  # peer, last message and unread count per dialog
 @jwt_required()
 def list_dialogs():
     user_id = get_jwt_identity()
-    dialogs = Dialog.query.filter(
-        (Dialog.user1_id == user_id) | (Dialog.user2_id == user_id)
-    ).order_by(Dialog.last_message_at.desc().nullslast(), Dialog.created_at.desc())
 
-    items = [serialize_dialog(d, user_id) for d in dialogs]
-    return jsonify({"items": items, "next_cursor": None})
+    def build():
+        dialogs = Dialog.query.filter(
+            (Dialog.user1_id == user_id) | (Dialog.user2_id == user_id)
+        ).order_by(Dialog.last_message_at.desc().nullslast(), Dialog.created_at.desc())
+        items = [serialize_dialog(d, user_id) for d in dialogs]
+        count_items(len(items))
+        return {"items": items, "next_cursor": None}
+
+    return cached_list_response("dialogs", user_id, build)
+
+
+@bp.route("/<dialog_id>", methods=["GET"])
+@replica_reads
+@query_budget(6)
+@jwt_required()
+def get_dialog(dialog_id):
+    user_id = get_jwt_identity()
+    dialog = Dialog.query.get(dialog_id)
+    if not dialog:
+        return error_response("not_found", "Dialog not found", 404)
+    if not dialog.includes_user(user_id):
+        return error_response("forbidden", "Access denied", 403)
+    return conditional_json(
+        versions.etag("dialog", dialog_id, "header", user_id),
+        lambda: {"dialog": serialize_dialog(dialog, user_id)},
+    )
 
 
 @bp.route("", methods=["POST"])
@@ -112,6 +140,7 @@ def create_dialog():
         dialog = Dialog(user1_id=user1_id, user2_id=user2_id, created_at=utcnow())
         db.session.add(dialog)
         db.session.commit()
+        invalidate_dialogs(user_id, peer_user_id)
 
     dialog_data = {
         "id": dialog.id,
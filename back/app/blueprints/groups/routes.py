@@ -1,10 +1,21 @@
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import get_jwt_identity, jwt_required
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 
-from app.extensions import db, socketio
+from app.db_routing import replica_reads
+from app.query_stats import count_items, query_budget
+from app.extensions import db
+from app.ws import outbound
+from app import archive, events, export, idempotency, rate_limit, tracing, versions
+from app.history_cache import first_page
+from app.partitions import created_at_upper_bound
+from app.list_cache import cached_list_response, invalidate_groups
 from app.models import Group, GroupMember, GroupMessage, User
-from app.utils.security import decrypt_text, encrypt_text
+from app.serializers import serialize_group_message
+from app.utils.security import encrypt_text
+from app.utils.http_cache import conditional_json
+from app.utils.ids import parse_id
 from app.utils.time import isoformat, parse_iso8601, utcnow
 
 bp = Blueprint("groups", __name__)
@@ -13,28 +24,6 @@ bp = Blueprint("groups", __name__)
 def error_response(code: str, message: str, status: int):
     return jsonify({"error": {"code": code, "message": message}}), status
 
-
-def serialize_message(msg: GroupMessage):
-    sender = msg.sender
-    return {
-        "id": msg.id,
-        "group_id": msg.group_id,
-        "client_msg_id": msg.client_msg_id,
-        "sender_id": msg.sender_id,
-        "sender_username": sender.username if sender else None,
-        "sender_avatar_url": sender.avatar_url if sender else None,
-        "type": msg.type,
-        "text": decrypt_text(msg.text),
-        "file_url": msg.file_url,
-        "file_name": msg.file_name,
-        "file_mime": msg.file_mime,
-        "file_size": msg.file_size,
-        "created_at": isoformat(msg.created_at),
-        "delivered_at": isoformat(msg.delivered_at),
-        "read_at": isoformat(msg.read_at),
-    }
-
-
 def serialize_group(group: Group, current_user_id: str):
     members = [
         {"id": gm.user.id, "username": gm.user.username, "avatar_url": gm.user.avatar_url}
@@ -47,7 +36,7 @@ def serialize_group(group: Group, current_user_id: str):
         "created_at": isoformat(group.created_at),
         "members": members,
         "last_message_at": isoformat(group.messages[-1].created_at) if group.messages else None,
-        "last_message": serialize_message(group.messages[-1]) if group.messages else None,
+        "last_message": serialize_group_message(group.messages[-1]) if group.messages else None,
     }
 
 
@@ -57,15 +46,23 @@ def _ensure_member(group_id: str, user_id: str):
 
 
 @bp.route("", methods=["GET"])
+@replica_reads
+@query_budget(2, per_item=2)  # members in one go; messages and a departed sender per group
 @jwt_required()
 def list_groups():
     user_id = get_jwt_identity()
-    groups = (
-        Group.query.join(GroupMember, GroupMember.group_id == Group.id)
-        .filter(GroupMember.user_id == user_id)
-        .all()
-    )
-    return jsonify({"items": [serialize_group(g, user_id) for g in groups]})
+
+    def build():
+        groups = (
+            Group.query.join(GroupMember, GroupMember.group_id == Group.id)
+            .filter(GroupMember.user_id == user_id)
+            .options(selectinload(Group.members).joinedload(GroupMember.user))
+            .all()
+        )
+        count_items(len(groups))
+        return {"items": [serialize_group(g, user_id) for g in groups]}
+
+    return cached_list_response("groups", user_id, build)
 
 
 @bp.route("", methods=["POST"])
@@ -94,6 +91,7 @@ def create_group():
     for uid in found_ids:
         db.session.add(GroupMember(group_id=group.id, user_id=uid, added_at=utcnow()))
     db.session.commit()
+    invalidate_groups(found_ids)
     return jsonify({"group": serialize_group(group, user_id)}), 201
 
 
@@ -124,10 +122,13 @@ def add_members(group_id):
             db.session.rollback()
             continue
     db.session.commit()
+    invalidate_groups(gm.user_id for gm in group.members)
     return jsonify({"group": serialize_group(group, user_id)})
 
 
 @bp.route("/<group_id>/messages", methods=["GET"])
+@replica_reads
+@query_budget(6)
 @jwt_required()
 def list_group_messages(group_id):
     user_id = get_jwt_identity()
@@ -136,22 +137,64 @@ def list_group_messages(group_id):
     before_param = request.args.get("before")
     limit = int(request.args.get("limit", 30))
     query = GroupMessage.query.filter_by(group_id=group_id)
+
+    archive_before = None
+
+    def load(n):
+        messages = query.options(selectinload(GroupMessage.sender)).order_by(GroupMessage.id.desc()).limit(n).all()
+        messages = archive.continue_page("group", group_id, messages, n, archive_before)
+        return [(m.created_at, serialize_group_message(m)) for m in messages]
+
     if before_param:
-        before_dt = parse_iso8601(before_param)
-        if not before_dt:
-            return error_response("bad_request", "Invalid before parameter", 400)
-        query = query.filter(GroupMessage.created_at < before_dt)
-    messages = query.order_by(GroupMessage.created_at.desc()).limit(limit).all()
-    next_cursor = isoformat(messages[-1].created_at) if messages and len(messages) == limit else None
-    return jsonify({"items": [serialize_message(m) for m in messages], "next_cursor": next_cursor})
+        before_id = parse_id(before_param)
+        if before_id is not None:
+            query = query.filter(GroupMessage.id < str(before_id))
+            archive_before = before_id
+            upper_bound = created_at_upper_bound(before_id)
+            if upper_bound is not None:
+                query = query.filter(GroupMessage.created_at <= upper_bound)
+        else:
+            # Timestamp cursors handed out before ids became time-ordered.
+            before_dt = parse_iso8601(before_param)
+            if not before_dt:
+                return error_response("bad_request", "Invalid before parameter", 400)
+            query = query.filter(GroupMessage.created_at < before_dt)
+            archive_before = archive.bound_for_datetime(before_dt)
 
+    def build():
+        if before_param:
+            items = [payload for _, payload in load(limit)]
+        else:
+            items = first_page("group", group_id, limit, load)
+        next_cursor = items[-1]["id"] if items and len(items) == limit else None
+        return {"items": items, "next_cursor": next_cursor}
 
-@bp.route("/<group_id>/messages", methods=["POST"])
+    return conditional_json(versions.etag("group", group_id, before_param, limit), build)
+
+
+@bp.route("/<group_id>/export", methods=["GET"])
+@replica_reads
 @jwt_required()
-def send_group_message(group_id):
+def export_group(group_id):
     user_id = get_jwt_identity()
     if not _ensure_member(group_id, user_id):
         return error_response("forbidden", "Not in group", 403)
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in export.FORMATS:
+        return error_response("bad_request", "format must be ndjson or gzip", 400)
+    return export.export_response("group", group_id, serialize_group_message, fmt)
+
+
+@bp.route("/<group_id>/messages", methods=["POST"])
+@query_budget(10)
+@jwt_required()
+@rate_limit.limit("group:message:send")
+def send_group_message(group_id):
+    user_id = get_jwt_identity()
+    trace = tracing.MessageTrace("group", "rest")
+    with trace.stage("load"):
+        if not _ensure_member(group_id, user_id):
+            return error_response("forbidden", "Not in group", 403)
     data = request.get_json(force=True, silent=True) or {}
     client_msg_id = data.get("client_msg_id")
     msg_type = data.get("type")
@@ -171,36 +214,46 @@ def send_group_message(group_id):
     else:
         return error_response("bad_request", "Unsupported message type", 400)
 
-    msg = GroupMessage(
-        group_id=group_id,
-        sender_id=user_id,
-        client_msg_id=client_msg_id,
-        type=msg_type,
-        text=encrypt_text(text) if text else None,
-        file_url=file_url,
-        file_name=file_name,
-        file_mime=file_mime,
-        file_size=file_size,
-        created_at=utcnow(),
-    )
-    db.session.add(msg)
-    try:
-        db.session.commit()
-    except IntegrityError:
-        db.session.rollback()
-        msg = GroupMessage.query.filter_by(sender_id=user_id, client_msg_id=client_msg_id, group_id=group_id).first()
-        if not msg:
-            return error_response("conflict", "Message conflict", 409)
-
-    payload = serialize_message(msg)
+    with trace.stage("insert"):
+        msg, created = idempotency.get_or_insert(
+            GroupMessage,
+            user_id,
+            client_msg_id,
+            lambda: dict(
+                group_id=group_id,
+                sender_id=user_id,
+                client_msg_id=client_msg_id,
+                type=msg_type,
+                text=trace.timed("encrypt", encrypt_text, text) if text else None,
+                file_url=file_url,
+                file_name=file_name,
+                file_mime=file_mime,
+                file_size=file_size,
+                created_at=utcnow(),
+            ),
+        )
+    if not msg or msg.group_id != group_id:
+        return error_response("conflict", "Message conflict", 409)
+    if created:
+        with trace.stage("commit"):
+            db.session.commit()
+
+    with trace.stage("serialize"):
+        payload = serialize_group_message(msg)
     # notify members
-    member_ids = [gm.user_id for gm in GroupMember.query.filter_by(group_id=group_id).all()]
-    for uid in member_ids:
-        socketio.emit("group:message:new", {"type": "group:message:new", "payload": {"message": payload}}, room=f"user:{uid}")
-    # ack to sender
-    socketio.emit(
-        "group:message:ack",
-        {"type": "group:message:ack", "payload": {"client_msg_id": client_msg_id, "message": payload}},
-        room=f"user:{user_id}",
-    )
+    with trace.stage("members"):
+        member_ids = [gm.user_id for gm in GroupMember.query.filter_by(group_id=group_id).all()]
+    if created:
+        with trace.stage("cache"):
+            events.message_sent("group", group_id, msg.created_at, payload, member_ids)
+    with trace.stage("emit"):
+        for uid in member_ids:
+            outbound.emit("group:message:new", {"type": "group:message:new", "payload": {"message": payload}}, to=f"user:{uid}")
+        # ack to sender
+        outbound.emit(
+            "group:message:ack",
+            {"type": "group:message:ack", "payload": {"client_msg_id": client_msg_id, "message": payload}},
+            to=f"user:{user_id}",
+        )
+    trace.finish(msg.id, created)
     return jsonify({"message": payload})
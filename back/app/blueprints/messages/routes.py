@@ -1,11 +1,19 @@
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import get_jwt_identity, jwt_required
-from sqlalchemy.exc import IntegrityError
-
-from app.extensions import db, socketio
+from sqlalchemy.orm import selectinload
+from app.db_routing import replica_reads
+from app.query_stats import query_budget
+from app.extensions import db
+from app.ws import outbound
+from app import archive, events, export, idempotency, rate_limit, tracing, versions
+from app.history_cache import first_page
+from app.partitions import created_at_upper_bound
 from app.models import Dialog, Message
+from app.serializers import serialize_message
+from app.utils.http_cache import conditional_json
+from app.utils.ids import parse_id
 from app.utils.time import isoformat, parse_iso8601, utcnow
-from app.utils.security import encrypt_text, decrypt_text
+from app.utils.security import encrypt_text
 
 bp = Blueprint("messages", __name__)
 
@@ -13,28 +21,6 @@ bp = Blueprint("messages", __name__)
 def error_response(code: str, message: str, status: int):
     return jsonify({"error": {"code": code, "message": message}}), status
 
-
-def serialize_message(message: Message):
-    sender = message.sender
-    return {
-        "id": message.id,
-        "dialog_id": message.dialog_id,
-        "client_msg_id": message.client_msg_id,
-        "sender_id": message.sender_id,
-        "sender_username": sender.username if sender else None,
-        "sender_avatar_url": sender.avatar_url if sender else None,
-        "type": message.type,
-        "text": decrypt_text(message.text),
-        "file_url": message.file_url,
-        "file_name": message.file_name,
-        "file_mime": message.file_mime,
-        "file_size": message.file_size,
-        "created_at": isoformat(message.created_at),
-        "delivered_at": isoformat(message.delivered_at),
-        "read_at": isoformat(message.read_at),
-    }
-
-
 def _get_dialog_or_forbid(dialog_id: str, user_id: str):
     dialog = Dialog.query.get(dialog_id)
     if not dialog:
@@ -45,6 +31,8 @@ def _get_dialog_or_forbid(dialog_id: str, user_id: str):
 
 
 @bp.route("/<dialog_id>/messages", methods=["GET"])
+@replica_reads
+@query_budget(6)
 @jwt_required()
 def get_messages(dialog_id):
     user_id = get_jwt_identity()
@@ -55,23 +43,65 @@ def get_messages(dialog_id):
     before_param = request.args.get("before")
     limit = int(request.args.get("limit", 30))
     query = Message.query.filter_by(dialog_id=dialog_id)
-    if before_param:
-        before_dt = parse_iso8601(before_param)
-        if not before_dt:
-            return error_response("bad_request", "Invalid before parameter", 400)
-        query = query.filter(Message.created_at < before_dt)
 
-    messages = query.order_by(Message.created_at.desc()).limit(limit).all()
-    next_cursor = isoformat(messages[-1].created_at) if messages and len(messages) == limit else None
+    archive_before = None
 
-    return jsonify({"items": [serialize_message(m) for m in messages], "next_cursor": next_cursor})
+    def load(n):
+        messages = query.options(selectinload(Message.sender)).order_by(Message.id.desc()).limit(n).all()
+        messages = archive.continue_page("dialog", dialog_id, messages, n, archive_before)
+        return [(m.created_at, serialize_message(m)) for m in messages]
+
+    if before_param:
+        before_id = parse_id(before_param)
+        if before_id is not None:
+            query = query.filter(Message.id < str(before_id))
+            archive_before = before_id
+            upper_bound = created_at_upper_bound(before_id)
+            if upper_bound is not None:
+                query = query.filter(Message.created_at <= upper_bound)
+        else:
+            # Timestamp cursors handed out before ids became time-ordered.
+            before_dt = parse_iso8601(before_param)
+            if not before_dt:
+                return error_response("bad_request", "Invalid before parameter", 400)
+            query = query.filter(Message.created_at < before_dt)
+            archive_before = archive.bound_for_datetime(before_dt)
+
+    def build():
+        if before_param:
+            items = [payload for _, payload in load(limit)]
+        else:
+            items = first_page("dialog", dialog_id, limit, load)
+        next_cursor = items[-1]["id"] if items and len(items) == limit else None
+        return {"items": items, "next_cursor": next_cursor}
+
+    # Revalidation is answered from the conversation version, before any rows load.
+    return conditional_json(versions.etag("dialog", dialog_id, before_param, limit), build)
+
+
+@bp.route("/<dialog_id>/export", methods=["GET"])
+@replica_reads
+@jwt_required()
+def export_dialog(dialog_id):
+    user_id = get_jwt_identity()
+    dialog, err = _get_dialog_or_forbid(dialog_id, user_id)
+    if err:
+        return err
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in export.FORMATS:
+        return error_response("bad_request", "format must be ndjson or gzip", 400)
+    return export.export_response("dialog", dialog.id, serialize_message, fmt)
 
 
 @bp.route("/<dialog_id>/messages", methods=["POST"])
+@query_budget(10)
 @jwt_required()
+@rate_limit.limit("message:send")
 def send_message(dialog_id):
     user_id = get_jwt_identity()
-    dialog, err = _get_dialog_or_forbid(dialog_id, user_id)
+    trace = tracing.MessageTrace("dialog", "rest")
+    with trace.stage("load"):
+        dialog, err = _get_dialog_or_forbid(dialog_id, user_id)
     if err:
         return err
 
@@ -96,41 +126,46 @@ def send_message(dialog_id):
     else:
         return error_response("bad_request", "Unsupported message type", 400)
 
-    message = Message(
-        dialog_id=dialog_id,
-        sender_id=user_id,
-        client_msg_id=client_msg_id,
-        type=msg_type,
-        text=encrypt_text(text) if text else None,
-        file_url=file_url,
-        file_name=file_name,
-        file_mime=file_mime,
-        file_size=file_size,
-        created_at=utcnow(),
-    )
-    db.session.add(message)
-    try:
-        db.session.commit()
-    except IntegrityError:
-        db.session.rollback()
-        message = (
-            Message.query.filter_by(sender_id=user_id, client_msg_id=client_msg_id)
-            .filter_by(dialog_id=dialog_id)
-            .first()
+    with trace.stage("insert"):
+        message, created = idempotency.get_or_insert(
+            Message,
+            user_id,
+            client_msg_id,
+            lambda: dict(
+                dialog_id=dialog_id,
+                sender_id=user_id,
+                client_msg_id=client_msg_id,
+                type=msg_type,
+                text=trace.timed("encrypt", encrypt_text, text) if text else None,
+                file_url=file_url,
+                file_name=file_name,
+                file_mime=file_mime,
+                file_size=file_size,
+                created_at=utcnow(),
+            ),
         )
-        if not message:
-            return error_response("conflict", "Message already exists with different dialog", 409)
-
-    dialog.last_message_id = message.id
-    dialog.last_message_at = message.created_at
-    db.session.commit()
-
-    payload = serialize_message(message)
-    socketio.emit("message:new", {"type": "message:new", "payload": {"message": payload}}, room=f"user:{dialog.peer_for(user_id).id}")
+    if not message or message.dialog_id != dialog_id:
+        return error_response("conflict", "Message already exists with different dialog", 409)
+
+    if created:
+        dialog.last_message_id = message.id
+        dialog.last_message_at = message.created_at
+        with trace.stage("commit"):
+            db.session.commit()
+
+    with trace.stage("serialize"):
+        payload = serialize_message(message)
+    if created:
+        with trace.stage("cache"):
+            events.message_sent("dialog", dialog_id, message.created_at, payload, [dialog.user1_id, dialog.user2_id])
+    with trace.stage("emit"):
+        outbound.emit("message:new", {"type": "message:new", "payload": {"message": payload}}, to=f"user:{dialog.peer_for(user_id).id}")
+    trace.finish(message.id, created)
     return jsonify({"message": payload})
 
 
 @bp.route("/<dialog_id>/read_up_to", methods=["POST"])
+@query_budget(6)
 @jwt_required()
 def read_up_to(dialog_id):
     user_id = get_jwt_identity()
@@ -160,9 +195,11 @@ def read_up_to(dialog_id):
         .update({"read_at": read_at_dt}, synchronize_session=False)
     )
     db.session.commit()
+    events.messages_read("dialog", dialog_id, user_id, target_message.created_at, read_at_dt)
+    tracing.read("dialog", target_message, "rest")
 
     sender_id = target_message.sender_id
-    socketio.emit(
+    outbound.emit(
         "message:status",
         {
             "type": "message:status",
@@ -173,6 +210,6 @@ def read_up_to(dialog_id):
                 "read_at": isoformat(read_at_dt),
             },
         },
-        room=f"user:{sender_id}",
+        to=f"user:{sender_id}",
     )
     return jsonify({"ok": True})
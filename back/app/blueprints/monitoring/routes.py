@@ -0,0 +1,53 @@
+import time
+from functools import wraps
+
+from flask import Blueprint, Response, current_app, jsonify, request
+from sqlalchemy import text
+
+from app import loop_monitor
+from app.extensions import db
+from app.utils import metrics
+
+bp = Blueprint("monitoring", __name__)
+
+
+def error_response(code: str, message: str, status: int):
+    return jsonify({"error": {"code": code, "message": message}}), status
+
+
+def scrape_only(view):
+    """Only peers in ``METRICS_ALLOWED_IPS``; ``/health`` and ``/ready`` stay public."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not metrics.scrape_allowed(request.remote_addr, current_app.config.get("METRICS_ALLOWED_IPS", ())):
+            return error_response("forbidden", "Metrics are not served to this address", 403)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@bp.route("/stats", methods=["GET"])
+@scrape_only
+def stats():
+    return jsonify(metrics.snapshot())
+
+
+@bp.route("/metrics", methods=["GET"])
+@scrape_only
+def prometheus_metrics():
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+@bp.route("/ready", methods=["GET"])
+def ready():
+    """Deep readiness for the load balancer: primary database and event-loop lag."""
+    checks = {"event_loop": loop_monitor.status()}
+    started = time.perf_counter()
+    try:
+        db.session.execute(text("SELECT 1"))
+        checks["database"] = {"ok": True, "seconds": round(time.perf_counter() - started, 4)}
+    except Exception as exc:
+        checks["database"] = {"ok": False, "error": exc.__class__.__name__}
+    ok = all(check["ok"] for check in checks.values())
+    return jsonify({"status": "ok" if ok else "unavailable", "checks": checks}), 200 if ok else 503
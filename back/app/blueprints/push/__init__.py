@@ -0,0 +1 @@
+# empty init to register blueprint
@@ -0,0 +1,74 @@
+from flask import Blueprint, jsonify, request
+from flask_jwt_extended import get_jwt_identity, jwt_required
+
+from app import push
+from app.extensions import db
+from app.models import PushDevice
+from app.utils.time import isoformat, utcnow
+
+bp = Blueprint("push", __name__)
+
+PLATFORMS = {"ios", "android", "web"}
+
+
+def error_response(code: str, message: str, status: int):
+    return jsonify({"error": {"code": code, "message": message}}), status
+
+
+def serialize_device(device: PushDevice) -> dict:
+    return {
+        "id": device.id,
+        "token": device.token,
+        "platform": device.platform,
+        "created_at": isoformat(device.created_at),
+        "updated_at": isoformat(device.updated_at),
+    }
+
+
+def _token(data: dict):
+    token = data.get("token")
+    if not isinstance(token, str) or not token.strip() or len(token) > 255:
+        return None
+    return token.strip()
+
+
+@bp.route("/devices", methods=["POST"])
+@jwt_required()
+def register_device():
+    user_id = get_jwt_identity()
+    data = request.get_json(force=True, silent=True) or {}
+    token = _token(data)
+    if token is None:
+        return error_response("bad_request", "token is required", 400)
+    platform = data.get("platform")
+    if platform is not None and platform not in PLATFORMS:
+        return error_response("bad_request", "platform must be one of ios, android, web", 400)
+
+    # A token belongs to the device, not the account: the last user to sign in on it gets the pushes.
+    device = PushDevice.query.filter_by(token=token).first()
+    created = device is None
+    if created:
+        device = PushDevice(user_id=user_id, token=token, platform=platform)
+        db.session.add(device)
+    else:
+        device.user_id = user_id
+        device.platform = platform or device.platform
+        device.updated_at = utcnow()
+    db.session.commit()
+    provider = push.get()
+    body = {"device": serialize_device(device), "provider": provider.name if provider else None}
+    return jsonify(body), 201 if created else 200
+
+
+@bp.route("/devices", methods=["DELETE"])
+@jwt_required()
+def unregister_device():
+    user_id = get_jwt_identity()
+    token = _token(request.get_json(force=True, silent=True) or {})
+    if token is None:
+        return error_response("bad_request", "token is required", 400)
+    deleted = PushDevice.query.filter_by(user_id=user_id, token=token).delete(synchronize_session=False)
+    db.session.commit()
+    if not deleted:
+        return error_response("not_found", "Device not registered", 404)
+    return jsonify({"ok": True})
@@ -1,46 +1,116 @@
-import os
+import re
 import uuid
 from pathlib import Path
 
-from flask import Blueprint, current_app, jsonify, request, send_from_directory
+from flask import Blueprint, current_app, jsonify, request
 from flask_jwt_extended import jwt_required
 
+from app import storage
+from app.utils import metrics
+
 bp = Blueprint("uploads", __name__)
 
+DEFAULT_MIME = "application/octet-stream"
+# The name ends up in URLs and object keys; other extensions are dropped.
+SAFE_EXTENSION = re.compile(r"\.[A-Za-z0-9]{1,16}")
+
+
+def error_response(code: str, message: str, status: int):
+    return jsonify({"error": {"code": code, "message": message}}), status
+
+
+def _new_name(file_name: str) -> str:
+    ext = Path(file_name).suffix
+    return uuid.uuid4().hex + (ext if SAFE_EXTENSION.fullmatch(ext) else "")
+
+
+def _describe(name: str, file_name: str, size: int, mime: str) -> dict:
+    # relative URL for storage, absolute for clients (needed for images on web)
+    rel_url = f"/uploads/{name}"
+    return {
+        "url": rel_url,
+        "absolute_url": request.url_root.rstrip("/") + rel_url,
+        "file_name": file_name,
+        "file_size": size,
+        "file_mime": mime,
+    }
+
+
+def _stream_size(stream) -> int:
+    stream.seek(0, 2)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
 
 @bp.route("", methods=["POST"])
 @jwt_required()
 def upload_file():
     if "file" not in request.files:
-        return jsonify({"error": {"code": "bad_request", "message": "file is required"}}), 400
+        return error_response("bad_request", "file is required", 400)
 
     file = request.files["file"]
     if file.filename == "":
-        return jsonify({"error": {"code": "bad_request", "message": "empty filename"}}), 400
+        return error_response("bad_request", "empty filename", 400)
 
-    upload_dir = Path(current_app.instance_path) / "uploads"
-    upload_dir.mkdir(parents=True, exist_ok=True)
+    size = _stream_size(file.stream)
+    if size > current_app.config["UPLOAD_MAX_BYTES"]:
+        return error_response("too_large", "File is too large", 413)
+    store = storage.get()
+    name = _new_name(file.filename)
+    mime = file.mimetype or DEFAULT_MIME
+    store.save(name, file.stream, size, mime)
+    metrics.incr("uploads", backend=store.name, via="app")
+    return jsonify(_describe(name, file.filename, size, mime))
 
-    ext = Path(file.filename).suffix
-    filename = f"{uuid.uuid4().hex}{ext}"
-    filepath = upload_dir / filename
-    file.save(filepath)
 
-    # relative URL for storage, absolute for clients (needed for images on web)
-    rel_url = f"/uploads/{filename}"
-    abs_url = request.url_root.rstrip("/") + rel_url
-    return jsonify(
-        {
-            "url": rel_url,
-            "absolute_url": abs_url,
-            "file_name": file.filename,
-            "file_size": filepath.stat().st_size,
-            "file_mime": file.mimetype,
-        }
-    )
+@bp.route("/presign", methods=["POST"])
+@jwt_required()
+def presign_upload():
+    data = request.get_json(force=True, silent=True) or {}
+    file_name = data.get("file_name")
+    file_size = data.get("file_size")
+    mime = data.get("file_mime") or DEFAULT_MIME
+    if not isinstance(file_name, str) or not file_name.strip():
+        return error_response("bad_request", "file_name is required", 400)
+    if not isinstance(file_size, int) or isinstance(file_size, bool) or file_size < 0:
+        return error_response("bad_request", "file_size must be a non-negative integer", 400)
+    if file_size > current_app.config["UPLOAD_MAX_BYTES"]:
+        return error_response("too_large", "File is too large", 413)
+
+    store = storage.get()
+    name = _new_name(file_name)
+    body = _describe(name, file_name, file_size, mime)
+    body["upload"] = {
+        "method": "PUT",
+        "url": store.presign_put(name, mime, file_size, request.url_root.rstrip("/")),
+        "headers": {"Content-Type": mime},
+        "expires_in": store.expires,
+    }
+    metrics.incr("uploads", backend=store.name, via="presigned")
+    return jsonify(body)
+
+
+@bp.route("/<path:filename>", methods=["PUT"])
+def put_file(filename):
+    # Target of the local backend's presigned URLs; the signature stands in for the token.
+    store = storage.get()
+    if not isinstance(store, storage.LocalStorage):
+        return error_response("not_found", "Uploads go to object storage", 404)
+    size = request.args.get("size", "")
+    if not store.verify_put(
+        filename, request.args.get("expires", ""), size, request.headers.get("Content-Type", ""),
+        request.args.get("signature", ""),
+    ):
+        return error_response("forbidden", "Invalid or expired upload URL", 403)
+    if request.content_length != int(size):
+        return error_response("bad_request", "Content-Length must match the presigned size", 400)
+    if (store.root / filename).exists():
+        return error_response("conflict", "File already uploaded", 409)
+    store.save(filename, request.stream, int(size), request.headers["Content-Type"])
+    return jsonify({"ok": True})
 
 
 @bp.route("/<path:filename>", methods=["GET"])
 def serve_file(filename):
-    upload_dir = Path(current_app.instance_path) / "uploads"
-    return send_from_directory(upload_dir, filename, as_attachment=False)
+    return storage.get().serve(filename)
@@ -0,0 +1,79 @@
+from flask import Blueprint, current_app, jsonify, request
+from flask_jwt_extended import jwt_required
+from sqlalchemy import and_, func, or_
+
+from app.extensions import db
+from app.models import User
+from app.utils.cache import LRUCache
+
+bp = Blueprint("users", __name__)
+
+# Sorted result pages for hot prefixes, keyed by (prefix, after, limit).
+_search_cache = None
+
+
+def error_response(code: str, message: str, status: int):
+    return jsonify({"error": {"code": code, "message": message}}), status
+
+
+def _get_search_cache() -> LRUCache:
+    global _search_cache
+    if _search_cache is None:
+        _search_cache = LRUCache(current_app.config.get("USER_SEARCH_CACHE_SIZE", 1024))
+    return _search_cache
+
+
+def invalidate_search_cache(username: str):
+    """Drop cached pages whose prefix would now also match ``username``."""
+    if _search_cache is None:
+        return
+    lowered = username.lower()
+    _search_cache.discard_where(lambda key: lowered.startswith(key[0]))
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _search(prefix: str, after: str, limit: int):
+    lowered = func.lower(User.username)
+    # The range predicate lets the lower(username) index drive the scan; LIKE keeps
+    # the result exact under collations where the range is wider than the prefix.
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    query = db.session.query(User.id, User.username, User.avatar_url).filter(
+        lowered >= prefix,
+        lowered < upper,
+        lowered.like(_escape_like(prefix) + "%", escape="\\"),
+    )
+    if after:
+        after_lowered = after.lower()
+        query = query.filter(
+            or_(lowered > after_lowered, and_(lowered == after_lowered, User.username > after))
+        )
+    rows = query.order_by(lowered, User.username).limit(limit).all()
+    items = [{"id": row.id, "username": row.username, "avatar_url": row.avatar_url} for row in rows]
+    next_cursor = rows[-1].username if len(rows) == limit else None
+    return items, next_cursor
+
+
+@bp.route("/search", methods=["GET"])
+@jwt_required()
+def search_users():
+    prefix = (request.args.get("prefix") or "").strip().lower()
+    if not prefix:
+        return error_response("bad_request", "prefix is required", 400)
+    max_limit = current_app.config.get("USER_SEARCH_MAX_LIMIT", 50)
+    limit = request.args.get("limit", 20, type=int)
+    if limit is None or limit < 1:
+        return error_response("bad_request", "Invalid limit parameter", 400)
+    limit = min(limit, max_limit)
+    after = request.args.get("after") or None
+
+    cache = _get_search_cache()
+    key = (prefix, after, limit)
+    cached = cache.get(key)
+    if cached is None:
+        cached = _search(prefix, after, limit)
+        cache.set(key, cached)
+    items, next_cursor = cached
+    return jsonify({"items": items, "next_cursor": next_cursor})
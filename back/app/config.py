@@ -9,5 +9,104 @@ class Config:
         "DATABASE_URL", "sqlite:///chat.db"
     ).replace("postgres://", "postgresql://")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Read replicas, comma separated; see app/db_routing.py.
+    SQLALCHEMY_BINDS = {
+        f"replica{i}": url.strip().replace("postgres://", "postgresql://")
+        for i, url in enumerate(filter(None, os.getenv("DATABASE_REPLICA_URLS", "").split(",")))
+    }
+    REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", 5))
+    REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", 10))
+    REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", 2))
+    # Engine profile and overrides; see app/db_profiles.py.
+    DB_PROFILE = os.getenv("DB_PROFILE")
+    DB_POOL_SIZE = os.getenv("DB_POOL_SIZE")
+    DB_MAX_OVERFLOW = os.getenv("DB_MAX_OVERFLOW")
+    DB_POOL_TIMEOUT = os.getenv("DB_POOL_TIMEOUT")
+    DB_POOL_RECYCLE = os.getenv("DB_POOL_RECYCLE")
+    DB_STATEMENT_TIMEOUT_MS = os.getenv("DB_STATEMENT_TIMEOUT_MS")
     CORS_ORIGINS = os.getenv("CORS_ORIGINS", "*")
     PORT = os.getenv("PORT", 5000)
+    # None lets Flask-SocketIO pick (eventlet when installed); asgi.py forces "threading".
+    SOCKETIO_ASYNC_MODE = os.getenv("SOCKETIO_ASYNC_MODE")
+    USER_SEARCH_MAX_LIMIT = int(os.getenv("USER_SEARCH_MAX_LIMIT", 50))
+    USER_SEARCH_CACHE_SIZE = int(os.getenv("USER_SEARCH_CACHE_SIZE", 1024))
+    HISTORY_CACHE_PER_CONVERSATION = int(os.getenv("HISTORY_CACHE_PER_CONVERSATION", 50))
+    HISTORY_CACHE_MAX_BYTES = int(os.getenv("HISTORY_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+    LIST_CACHE_SIZE = int(os.getenv("LIST_CACHE_SIZE", 10000))
+    # Users whose list versions are kept; see app/list_cache.py.
+    LIST_VERSIONS_SIZE = int(os.getenv("LIST_VERSIONS_SIZE", 100000))
+    IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 50000))
+    # Conversations whose ETag counters are kept; see app/versions.py.
+    ETAG_VERSIONS_SIZE = int(os.getenv("ETAG_VERSIONS_SIZE", 100000))
+    MESSAGE_PARTITIONING = os.getenv("MESSAGE_PARTITIONING") == "1"
+    MESSAGE_PARTITIONS_AHEAD = int(os.getenv("MESSAGE_PARTITIONS_AHEAD", 3))
+    ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(os.getcwd(), "archive"))
+    ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 180))
+    ARCHIVE_BLOCK_ROWS = int(os.getenv("ARCHIVE_BLOCK_ROWS", 256))
+    ARCHIVE_SEGMENT_ROWS = int(os.getenv("ARCHIVE_SEGMENT_ROWS", 50000))
+    ARCHIVE_BLOCK_CACHE_SIZE = int(os.getenv("ARCHIVE_BLOCK_CACHE_SIZE", 256))
+    EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 500))
+    # Query counting per request/event; see app/query_stats.py.
+    N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", 10))
+    QUERY_BUDGET_DEFAULT = int(os.environ["QUERY_BUDGET_DEFAULT"]) if os.getenv("QUERY_BUDGET_DEFAULT") else None
+    QUERY_BUDGET_ENFORCE = os.getenv("QUERY_BUDGET_ENFORCE") == "1"
+    QUERY_STATS_HEADERS = os.getenv("QUERY_STATS_HEADERS") == "1"
+    # Event-loop lag monitor and readiness; see app/loop_monitor.py. 0 disables the monitor.
+    LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", 0.1))
+    LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", 0.5))
+    READY_MAX_LOOP_LAG = float(os.getenv("READY_MAX_LOOP_LAG", 1.0))
+    # Message lifecycle spans as JSON lines; see app/tracing.py. Unset disables the export.
+    TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")
+    TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 1.0))
+    # Peers (IPs or CIDRs, comma separated) that may read /stats, /metrics and the worker's
+    # --metrics-port; see app/utils/metrics.py. Empty allows nobody.
+    METRICS_ALLOWED_IPS = [
+        ip.strip() for ip in os.getenv("METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",") if ip.strip()
+    ]
+    # User ids (comma separated) allowed to call /admin endpoints.
+    ADMIN_USER_IDS = {uid.strip() for uid in os.getenv("ADMIN_USER_IDS", "").split(",") if uid.strip()}
+    # Sampling profiler; see app/profiler.py.
+    PROFILE_DEFAULT_SECONDS = float(os.getenv("PROFILE_DEFAULT_SECONDS", 10))
+    PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 60))
+    PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+    PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.getcwd(), "profiles"))
+    # Per-user token buckets, "event=rate/burst,..."; see app/rate_limit.py. Empty disables them.
+    RATE_LIMITS = os.getenv(
+        "RATE_LIMITS", "message:send=10/30,group:message:send=10/30,message:delivered=50/200,message:read=20/60,*=20/40"
+    )
+    RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000))
+    # Outbound queue bounds per socket, in packets; see app/ws/backpressure.py. WS_QUEUE_MAX=0 disables them.
+    WS_QUEUE_SOFT_LIMIT = int(os.getenv("WS_QUEUE_SOFT_LIMIT", 64))
+    WS_QUEUE_MAX = int(os.getenv("WS_QUEUE_MAX", 1024))
+    WS_QUEUE_DRAIN_INTERVAL = float(os.getenv("WS_QUEUE_DRAIN_INTERVAL", 0.1))
+    # Batched delivery for sockets that ask for it at auth; see app/ws/backpressure.py. 0 disables it.
+    WS_BATCH_WINDOW_MS = float(os.getenv("WS_BATCH_WINDOW_MS", 10))
+    WS_BATCH_MAX_EVENTS = int(os.getenv("WS_BATCH_MAX_EVENTS", 100))
+    # Attachment storage: local or s3; see app/storage.py.
+    STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+    UPLOAD_DIR = os.getenv("UPLOAD_DIR")
+    UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 50 * 1024 * 1024))
+    UPLOAD_URL_EXPIRES = int(os.getenv("UPLOAD_URL_EXPIRES", 900))
+    S3_ENDPOINT = os.getenv("S3_ENDPOINT", "https://s3.amazonaws.com")
+    S3_BUCKET = os.getenv("S3_BUCKET")
+    S3_REGION = os.getenv("S3_REGION", "us-east-1")
+    S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
+    S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
+    S3_KEY_PREFIX = os.getenv("S3_KEY_PREFIX", "uploads/")
+    # "path" (https://endpoint/bucket/key, MinIO) or "virtual" (https://bucket.endpoint/key).
+    S3_ADDRESSING = os.getenv("S3_ADDRESSING", "path")
+    # Encodings clients may negotiate besides JSON, comma separated; see app/wire.py.
+    WS_ENCODINGS = os.getenv("WS_ENCODINGS", "msgpack")
+    # Background jobs; see app/jobs.py. Backoff doubles per attempt from BASE up to MAX seconds.
+    JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "4"))
+    JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+    JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+    JOB_BACKOFF_BASE = float(os.getenv("JOB_BACKOFF_BASE", "5"))
+    JOB_BACKOFF_MAX = float(os.getenv("JOB_BACKOFF_MAX", "3600"))
+    # Pushes to offline recipients: expo, fake or empty (off); see app/push.py. Needs a jobs worker.
+    PUSH_PROVIDER = os.getenv("PUSH_PROVIDER", "")
+    PUSH_COALESCE_SECONDS = float(os.getenv("PUSH_COALESCE_SECONDS", "10"))
+    PUSH_PREVIEW = os.getenv("PUSH_PREVIEW", "1") == "1"
+    PUSH_EXPO_URL = os.getenv("PUSH_EXPO_URL", "https://exp.host/--/api/v2/push/send")
+    PUSH_EXPO_ACCESS_TOKEN = os.getenv("PUSH_EXPO_ACCESS_TOKEN", "")
+    PUSH_FAKE_PATH = os.getenv("PUSH_FAKE_PATH", "")
@@ -0,0 +1,202 @@
+"""Named database engine profiles.
+
+``DB_PROFILE`` picks one of ``PROFILES`` (by default ``sqlite-dev`` for SQLite
+URLs and ``postgres`` otherwise); ``DB_POOL_SIZE``, ``DB_MAX_OVERFLOW``,
+``DB_POOL_TIMEOUT``, ``DB_POOL_RECYCLE`` and ``DB_STATEMENT_TIMEOUT_MS`` override
+single values. The same profile is applied to the primary and every replica
+bind.
+
+* ``sqlite-dev``: WAL journal, ``synchronous=NORMAL`` and a busy timeout on
+  every connection, so readers don't block the writer and concurrent writers
+  wait instead of failing with "database is locked".
+* ``postgres``: pre-ping, recycling and a server-side ``statement_timeout``
+  passed as a connection startup option.
+* ``pgbouncer``: for a transaction-mode pooler, which rejects startup options
+  and shares server sessions between clients. The timeout is set with
+  ``SET LOCAL`` at the start of every transaction and no session state is used.
+
+Every pool records how long checkouts wait (``db_pool_*`` metrics). Under
+eventlet, psycopg2 is switched to green I/O so a query or a pool wait only
+blocks its own greenlet.
+"""
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+from app.utils import metrics
+
+PROFILES = {
+    "sqlite-dev": {
+        "pool_size": 5,
+        "max_overflow": 10,
+        "pool_timeout": 10,
+        "pool_recycle": -1,
+        "pool_pre_ping": False,
+        "statement_timeout_ms": 0,
+        "sqlite_pragmas": {"journal_mode": "WAL", "synchronous": "NORMAL", "busy_timeout": 5000},
+    },
+    "postgres": {
+        "pool_size": 10,
+        "max_overflow": 20,
+        "pool_timeout": 5,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        "statement_timeout_ms": 5000,
+        "statement_timeout_mode": "startup",
+    },
+    "pgbouncer": {
+        "pool_size": 5,
+        "max_overflow": 5,
+        "pool_timeout": 5,
+        "pool_recycle": 300,
+        "pool_pre_ping": True,
+        "statement_timeout_ms": 5000,
+        "statement_timeout_mode": "transaction",
+    },
+}
+
+_OVERRIDES = {
+    "DB_POOL_SIZE": "pool_size",
+    "DB_MAX_OVERFLOW": "max_overflow",
+    "DB_POOL_TIMEOUT": "pool_timeout",
+    "DB_POOL_RECYCLE": "pool_recycle",
+    "DB_STATEMENT_TIMEOUT_MS": "statement_timeout_ms",
+}
+
+# Checkouts waiting longer than this are counted as slow.
+SLOW_CHECKOUT_SECONDS = 0.05
+
+_pools = {}
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        name = self._orig_logging_name or "primary"
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            metrics.incr("db_pool_checkout_failures", engine=name)
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            metrics.incr("db_pool_checkouts", engine=name)
+            metrics.incr("db_pool_checkout_wait_us", int(waited * 1_000_000), engine=name)
+            if waited > SLOW_CHECKOUT_SECONDS:
+                metrics.incr("db_pool_slow_checkouts", engine=name)
+
+
+def resolve_profile(app) -> dict:
+    url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    name = app.config.get("DB_PROFILE") or ("sqlite-dev" if url.get_backend_name() == "sqlite" else "postgres")
+    if name not in PROFILES:
+        raise RuntimeError(f"Unknown DB_PROFILE {name!r}; expected one of {', '.join(PROFILES)}")
+    profile = dict(PROFILES[name], name=name)
+    for key, option in _OVERRIDES.items():
+        if app.config.get(key) is not None:
+            profile[option] = int(app.config[key])
+    return profile
+
+
+def engine_options(profile: dict, url, label: str) -> dict:
+    """``create_engine`` keyword arguments for ``url`` under ``profile``."""
+    url = make_url(url)
+    options = {"url": url, "pool_logging_name": label}
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        # In-memory databases live in a single connection; keep SQLAlchemy's pool.
+        return options
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=profile["pool_size"],
+        max_overflow=profile["max_overflow"],
+        pool_timeout=profile["pool_timeout"],
+        pool_recycle=profile["pool_recycle"],
+        pool_pre_ping=profile["pool_pre_ping"],
+    )
+    if url.get_backend_name() == "postgresql":
+        connect_args = {}
+        if profile.get("statement_timeout_mode") == "startup":
+            connect_args["application_name"] = "poebtalk"
+            if profile["statement_timeout_ms"]:
+                connect_args["options"] = f"-c statement_timeout={profile['statement_timeout_ms']}"
+        options["connect_args"] = connect_args
+    return options
+
+
+def configure(app):
+    """Turn the profile into per-engine options; call before ``db.init_app``."""
+    profile = resolve_profile(app)
+    app.extensions["db_profile"] = profile
+    options = engine_options(profile, app.config["SQLALCHEMY_DATABASE_URI"], "primary")
+    options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {key: value for key, value in options.items() if key != "url"}
+    app.config["SQLALCHEMY_BINDS"] = {
+        key: engine_options(profile, value, key) if isinstance(value, str) else value
+        for key, value in app.config.get("SQLALCHEMY_BINDS", {}).items()
+    }
+
+
+def sqlite_pragmas_listener(pragmas: dict):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+    return on_connect
+
+
+def local_statement_timeout_listener(timeout_ms: int):
+    def on_begin(conn):
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+
+    return on_begin
+
+
+def _make_psycopg_green(app):
+    if app.extensions["socketio"].async_mode != "eventlet":
+        return
+    from eventlet.support import psycopg2_patcher
+
+    psycopg2_patcher.make_psycopg_green()
+
+
+def init_app(app):
+    """Attach per-connection setup to the engines; call after ``db.init_app``."""
+    from app.extensions import db
+
+    profile = app.extensions["db_profile"]
+    with app.app_context():
+        engines = dict(db.engines)
+    for key, engine in engines.items():
+        label = key or "primary"
+        _pools[label] = engine
+        backend = engine.dialect.name
+        if backend == "sqlite" and profile.get("sqlite_pragmas"):
+            event.listen(engine, "connect", sqlite_pragmas_listener(profile["sqlite_pragmas"]))
+        if backend == "postgresql":
+            if engine.dialect.driver == "psycopg2" and "socketio" in app.extensions:
+                _make_psycopg_green(app)
+            if profile.get("statement_timeout_mode") == "transaction" and profile["statement_timeout_ms"]:
+                event.listen(engine, "begin", local_statement_timeout_listener(profile["statement_timeout_ms"]))
+
+
+def _pool_status() -> dict:
+    status = {}
+    for label, engine in _pools.items():
+        pool = engine.pool
+        if isinstance(pool, QueuePool):
+            status[label] = {
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "overflow": max(pool.overflow(), 0),
+                "idle": pool.checkedin(),
+            }
+    return status
+
+
+metrics.register_gauge("db_pool", _pool_status, label="engine")
@@ -0,0 +1,190 @@
+"""Route read-only endpoints to read replicas.
+
+Replicas are configured with ``DATABASE_REPLICA_URLS`` and become Flask-SQLAlchemy
+binds named ``replica0``, ``replica1``, ... . A view decorated with
+``@replica_reads`` sends its SELECTs to a healthy replica; everything else,
+including any flush, goes to the primary. A request switches back to the
+primary when:
+
+* its user committed a write less than ``REPLICA_STICKY_SECONDS`` ago
+  (read-your-writes, covering REST and WebSocket writes);
+* the session already flushed in this request;
+* every replica lags more than ``REPLICA_MAX_LAG_SECONDS`` or is unreachable,
+  as measured by a background probe every ``REPLICA_LAG_CHECK_INTERVAL``.
+
+Data read from a replica may be slightly stale, so it is never stored in the
+in-process caches and never tagged with a version ETag.
+"""
+import itertools
+import logging
+import time
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from flask import session as socket_session
+from flask_jwt_extended import get_jwt_identity
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+from sqlalchemy.sql import Select
+
+from app.utils import metrics
+from app.utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+REPLICA_PREFIX = "replica"
+
+# Seconds behind the primary; an idle primary reports 0 instead of a growing gap.
+PG_LAG_QUERY = (
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+_NOT_CHOSEN = object()
+
+_last_write = LRUCache(100000)
+_lag = {}
+_round_robin = itertools.count()
+
+
+class RoutingSession(Session):
+    """Session that sends SELECTs of ``@replica_reads`` views to a replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and isinstance(clause, Select):
+            replica = current_replica()
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def replica_reads(view):
+    """Mark a read-only view as safe to serve from a replica."""
+    view.replica_reads = True
+    return view
+
+
+def replica_names() -> list:
+    return [key for key in current_app.config.get("SQLALCHEMY_BINDS", {}) if key.startswith(REPLICA_PREFIX)]
+
+
+def _writer_identity():
+    if getattr(request, "sid", None) is not None:
+        return socket_session.get("user_id")
+    try:
+        return get_jwt_identity()
+    except RuntimeError:
+        return None
+
+
+def _is_sticky(user_id) -> bool:
+    if user_id is None:
+        return False
+    written_at = _last_write.get(user_id)
+    return written_at is not None and time.monotonic() - written_at < current_app.config["REPLICA_STICKY_SECONDS"]
+
+
+def _healthy_replicas() -> list:
+    max_lag = current_app.config["REPLICA_MAX_LAG_SECONDS"]
+    return [name for name in replica_names() if _lag.get(name, 0.0) <= max_lag]
+
+
+def _choose_replica():
+    if not has_request_context() or g.get("db_wrote"):
+        return None
+    view = current_app.view_functions.get(request.endpoint)
+    if not getattr(view, "replica_reads", False):
+        return None
+    if _is_sticky(_writer_identity()):
+        metrics.incr("db_route", target="primary", reason="sticky")
+        return None
+    healthy = _healthy_replicas()
+    if not healthy:
+        if replica_names():
+            metrics.incr("db_route", target="primary", reason="lag")
+        return None
+    name = healthy[next(_round_robin) % len(healthy)]
+    metrics.incr("db_route", target=name, reason="read")
+    return name
+
+
+def current_replica():
+    """Replica engine for this request's reads, or None for the primary.
+
+    Decided on first use, after ``jwt_required`` has resolved the user, and kept
+    for the rest of the request so one response never mixes two databases.
+    """
+    if not has_app_context():
+        return None
+    name = g.get("db_replica", _NOT_CHOSEN)
+    if name is _NOT_CHOSEN:
+        name = _choose_replica()
+        g.db_replica = name
+    if name is None or g.get("db_wrote"):
+        return None
+    return current_app.extensions["sqlalchemy"].engines[name]
+
+
+def on_replica() -> bool:
+    """True if this request has read from a replica."""
+    return has_app_context() and g.get("db_replica") not in (None, _NOT_CHOSEN)
+
+
+def mark_write(user_id: str):
+    _last_write.set(user_id, time.monotonic())
+
+
+def set_lag(name: str, seconds: float):
+    _lag[name] = seconds
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _after_flush(session, flush_context):
+    if has_app_context():
+        g.db_wrote = True
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _after_commit(session):
+    if has_request_context() and g.get("db_wrote"):
+        user_id = _writer_identity()
+        if user_id is not None:
+            mark_write(user_id)
+
+
+def measure_lag(engine) -> float:
+    with engine.connect() as conn:
+        if engine.dialect.name == "postgresql":
+            return float(conn.execute(text(PG_LAG_QUERY)).scalar() or 0.0)
+        # Other backends have no replication to measure; just check reachability.
+        conn.execute(text("SELECT 1"))
+        return 0.0
+
+
+def _lag_loop(app):
+    from app.extensions import db, socketio
+
+    while True:
+        with app.app_context():
+            for name in replica_names():
+                try:
+                    set_lag(name, measure_lag(db.engines[name]))
+                except Exception:
+                    logger.warning("Replica %s is unreachable", name, exc_info=True)
+                    set_lag(name, float("inf"))
+            interval = app.config["REPLICA_LAG_CHECK_INTERVAL"]
+        socketio.sleep(interval)
+
+
+def init_app(app):
+    from app.utils.background import start_on_first_request
+
+    if any(key.startswith(REPLICA_PREFIX) for key in app.config.get("SQLALCHEMY_BINDS", {})):
+        start_on_first_request(app, _lag_loop, app)
+
+
+# Unreachable replicas are reported as null.
+metrics.register_gauge(
+    "replica_lag_seconds",
+    lambda: {name: lag if lag != float("inf") else None for name, lag in _lag.items()},
+    label="replica",
+)
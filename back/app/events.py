@@ -0,0 +1,33 @@
+"""Fan-out of message changes to the in-process caches.
+
+Route and Socket.IO handlers call these after committing, so the history ring
+buffers, list snapshots and conversation versions all observe the same events.
+New messages also queue pushes for recipients who are offline (``app/push.py``).
+"""
+from app import push, versions
+from app.history_cache import get_history_cache
+from app.list_cache import invalidate_dialogs, invalidate_groups
+from app.utils import metrics
+
+
+def message_sent(kind: str, conversation_id: str, created_at, payload: dict, member_ids):
+    metrics.observe("message_recipients", len(member_ids), buckets=metrics.SIZE_BUCKETS, kind=kind)
+    get_history_cache().push(kind, conversation_id, created_at, payload)
+    versions.bump(kind, conversation_id)
+    if kind == "dialog":
+        invalidate_dialogs(*member_ids)
+    else:
+        invalidate_groups(member_ids)
+    push.message_sent(kind, created_at, payload, member_ids)
+
+
+def message_delivered(kind: str, conversation_id: str, message_id: str, delivered_at):
+    get_history_cache().update_status(kind, conversation_id, message_id, delivered_at=delivered_at)
+    versions.bump(kind, conversation_id)
+
+
+def messages_read(kind: str, conversation_id: str, reader_id: str, up_to, read_at):
+    get_history_cache().mark_read(kind, conversation_id, reader_id, up_to, read_at)
+    versions.bump(kind, conversation_id)
+    if kind == "dialog":
+        invalidate_dialogs(reader_id)
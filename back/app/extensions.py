@@ -4,7 +4,9 @@ from flask_migrate import Migrate
 from flask_socketio import SocketIO
 from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy()
+from app.db_routing import RoutingSession
+
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 migrate = Migrate()
 jwt = JWTManager()
 # Let Flask-SocketIO pick the best available async mode (eventlet/gevent/threading).
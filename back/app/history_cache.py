@@ -0,0 +1,184 @@
+"""In-memory ring buffers with the newest serialized messages of hot conversations.
+
+Entries live in the process, which matches the single eventlet worker we deploy.
+Every write path that changes a message (send, delivered, read) must go through
+this module so that cached first pages never disagree with the database.
+"""
+from collections import OrderedDict, deque
+from datetime import timezone
+
+from flask import current_app
+
+from app.db_routing import on_replica
+from app.utils import metrics
+from app.utils.time import isoformat
+
+
+class _Entry:
+    __slots__ = ("messages", "complete", "size")
+
+    def __init__(self, capacity: int):
+        # (created_at, payload) pairs ordered oldest -> newest.
+        self.messages = deque(maxlen=capacity)
+        # True when the buffer holds the whole conversation history.
+        self.complete = False
+        self.size = 0
+
+
+def _as_utc(dt):
+    # SQLite hands back naive datetimes even for timezone-aware columns.
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
+
+def _payload_size(payload: dict) -> int:
+    return 64 + sum(len(k) + (len(v) if isinstance(v, str) else 8) for k, v in payload.items())
+
+
+class HistoryCache:
+    def __init__(self, per_conversation: int, max_bytes: int):
+        self.per_conversation = per_conversation
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.per_conversation > 0 and self.max_bytes > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def page(self, kind: str, conversation_id: str, limit: int):
+        """Return the newest ``limit`` payloads, or None if the buffer can't answer."""
+        entry = self._entries.get((kind, conversation_id))
+        if entry is None or (limit > len(entry.messages) and not entry.complete):
+            self.misses += 1
+            return None
+        self._entries.move_to_end((kind, conversation_id))
+        self.hits += 1
+        items = []
+        for _, payload in reversed(entry.messages):
+            if len(items) == limit:
+                break
+            items.append(payload)
+        return items
+
+    def fill(self, kind: str, conversation_id: str, messages, complete: bool):
+        """Seed a buffer from ``(created_at, payload)`` pairs ordered newest first."""
+        if not self.enabled:
+            return
+        self.invalidate(kind, conversation_id)
+        entry = _Entry(self.per_conversation)
+        for created_at, payload in reversed(messages[: self.per_conversation]):
+            self._append(entry, _as_utc(created_at), dict(payload))
+        entry.complete = complete and len(messages) <= self.per_conversation
+        self._entries[(kind, conversation_id)] = entry
+        self.total_bytes += entry.size
+        self._evict()
+
+    def push(self, kind: str, conversation_id: str, created_at, payload: dict):
+        """Add a freshly sent message to an already cached conversation."""
+        entry = self._entries.get((kind, conversation_id))
+        if entry is None:
+            return
+        if any(p["id"] == payload["id"] for _, p in entry.messages):
+            return
+        created_at = _as_utc(created_at)
+        before = entry.size
+        if len(entry.messages) == entry.messages.maxlen:
+            entry.complete = False
+        # Canonical v7 id strings sort like the ids themselves, i.e. by creation.
+        if not entry.messages or entry.messages[-1][1]["id"] <= payload["id"]:
+            self._append(entry, created_at, dict(payload))
+        else:
+            # Commits can land slightly out of order; keep the buffer sorted.
+            ordered = sorted([*entry.messages, (created_at, dict(payload))], key=lambda item: item[1]["id"])
+            entry.messages.clear()
+            entry.size = 0
+            for item in ordered[-entry.messages.maxlen:]:
+                self._append(entry, *item)
+        self.total_bytes += entry.size - before
+        self._entries.move_to_end((kind, conversation_id))
+        self._evict()
+
+    def update_status(self, kind: str, conversation_id: str, message_id: str, **fields):
+        entry = self._entries.get((kind, conversation_id))
+        if entry is None:
+            return
+        for _, payload in entry.messages:
+            if payload["id"] == message_id:
+                payload.update({name: isoformat(value) for name, value in fields.items()})
+                return
+
+    def mark_read(self, kind: str, conversation_id: str, reader_id: str, up_to, read_at):
+        """Mirror ``read_up_to``: peer messages up to ``up_to`` without read_at get ``read_at``."""
+        entry = self._entries.get((kind, conversation_id))
+        if entry is None:
+            return
+        up_to = _as_utc(up_to)
+        read_at_iso = isoformat(read_at)
+        for created_at, payload in entry.messages:
+            if created_at <= up_to and payload["sender_id"] != reader_id and payload["read_at"] is None:
+                payload["read_at"] = read_at_iso
+
+    def invalidate(self, kind: str, conversation_id: str):
+        entry = self._entries.pop((kind, conversation_id), None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+
+    def clear(self):
+        self._entries.clear()
+        self.total_bytes = 0
+
+    def _append(self, entry: _Entry, created_at, payload: dict):
+        if len(entry.messages) == entry.messages.maxlen:
+            entry.size -= _payload_size(entry.messages[0][1])
+        entry.messages.append((created_at, payload))
+        entry.size += _payload_size(payload)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self.total_bytes -= entry.size
+            self.evictions += 1
+
+
+_history_cache = None
+
+
+def get_history_cache() -> HistoryCache:
+    global _history_cache
+    if _history_cache is None:
+        _history_cache = HistoryCache(
+            current_app.config.get("HISTORY_CACHE_PER_CONVERSATION", 50),
+            current_app.config.get("HISTORY_CACHE_MAX_BYTES", 32 * 1024 * 1024),
+        )
+    return _history_cache
+
+
+def first_page(kind: str, conversation_id: str, limit: int, load):
+    """Serve the newest page of a conversation, filling the buffer on a miss.
+
+    ``load(n)`` must return up to ``n`` ``(created_at, payload)`` pairs, newest first.
+    """
+    cache = get_history_cache()
+    if not cache.enabled or limit > cache.per_conversation:
+        return [payload for _, payload in load(limit)]
+    items = cache.page(kind, conversation_id, limit)
+    if items is not None:
+        return items
+    rows = load(cache.per_conversation)
+    # A lagging replica may miss a message already pushed to the buffer.
+    if not on_replica():
+        cache.fill(kind, conversation_id, rows, complete=len(rows) < cache.per_conversation)
+    return [payload for _, payload in rows[:limit]]
+
+
+metrics.register_gauge("history_cache_conversations", lambda: len(_history_cache) if _history_cache else 0)
+metrics.register_gauge("history_cache_bytes", lambda: _history_cache.total_bytes if _history_cache else 0)
+metrics.register_gauge("history_cache_hits", lambda: _history_cache.hits if _history_cache else 0)
+metrics.register_gauge("history_cache_misses", lambda: _history_cache.misses if _history_cache else 0)
+metrics.register_gauge("history_cache_evictions", lambda: _history_cache.evictions if _history_cache else 0)
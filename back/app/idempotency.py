@@ -0,0 +1,116 @@
+"""Retry-safe message inserts keyed by ``(sender_id, client_msg_id)``.
+
+Clients on flaky networks resend ``client_msg_id``s they already delivered. A
+bounded map of recently stored keys answers most of those retries without an
+insert (an entry whose row is gone, because the send's commit failed, is
+dropped and the insert runs again); the rest are absorbed by ``INSERT ... ON CONFLICT DO NOTHING RETURNING``
+so a duplicate never raises ``IntegrityError`` or rolls back the session.
+"""
+from flask import current_app
+from sqlalchemy import insert, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from app.extensions import db
+from app.utils import metrics
+from app.utils.cache import LRUCache
+
+_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+_recent = None
+
+
+def _get_recent() -> LRUCache:
+    global _recent
+    if _recent is None:
+        _recent = LRUCache(current_app.config.get("IDEMPOTENCY_CACHE_SIZE", 50000))
+    return _recent
+
+
+def _insert_partitioned(session, model, values: dict):
+    # Unique constraints on a partitioned table must include created_at, so
+    # ON CONFLICT can't see retries; serialize on the key with an advisory lock.
+    session.execute(
+        text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+        {"key": f"{model.__tablename__}:{values['sender_id']}:{values['client_msg_id']}"},
+    )
+    existing = session.execute(
+        select(model.id).filter_by(sender_id=values["sender_id"], client_msg_id=values["client_msg_id"])
+    ).first()
+    if existing:
+        return None
+    return session.execute(insert(model).values(**values).returning(model.id)).scalar()
+
+
+def _insert(session, model, values: dict, partitioned: bool):
+    """Insert a row and return its id, or None if the key already exists."""
+    dialect = session.get_bind(mapper=model.__mapper__).dialect.name
+    if dialect == "postgresql" and partitioned:
+        return _insert_partitioned(session, model, values)
+    dialect_insert = _INSERTS.get(dialect)
+    if dialect_insert is not None:
+        stmt = (
+            dialect_insert(model)
+            .values(**values)
+            .on_conflict_do_nothing(index_elements=["sender_id", "client_msg_id"])
+            .returning(model.id)
+        )
+        return session.execute(stmt).scalar()
+    row = model(**values)
+    try:
+        with session.begin_nested():
+            session.add(row)
+    except IntegrityError:
+        return None
+    return row.id
+
+
+def get_or_insert(model, sender_id: str, client_msg_id: str, make_values):
+    """Return ``(message, created)`` for a send, reusing an earlier insert on retry.
+
+    ``make_values`` is only called when a new row is needed, so retries skip
+    encryption as well as the insert. The caller commits.
+    """
+    kind = model.__tablename__
+    recent = _get_recent()
+    key = (kind, sender_id, client_msg_id)
+    message_id = recent.get(key)
+    if message_id is not None:
+        message = db.session.get(model, message_id)
+        if message is not None:
+            metrics.incr("message_duplicate_retries", table=kind, path="cache")
+            return message, False
+        # Cached by a send whose commit then failed: the row never existed.
+        recent.pop(key)
+        metrics.incr("idempotency_cache_stale", table=kind)
+    message_id = _insert(db.session, model, make_values(), current_app.config.get("MESSAGE_PARTITIONING"))
+    if message_id is not None:
+        recent.set(key, message_id)
+        metrics.incr("messages_inserted", table=kind)
+        return db.session.get(model, message_id), True
+    metrics.incr("message_duplicate_retries", table=kind, path="conflict")
+    message = model.query.filter_by(sender_id=sender_id, client_msg_id=client_msg_id).first()
+    if message is not None:
+        recent.set(key, message.id)
+    return message, False
+
+
+async def get_or_insert_async(session, model, sender_id: str, client_msg_id: str, make_values, partitioned=False, options=()):
+    """``get_or_insert`` for an ``AsyncSession``; ``options`` are loader options for the result.
+
+    The recent-key map is skipped: it belongs to the thread serving WSGI
+    requests, and the insert still answers retries on its own.
+    """
+    kind = model.__tablename__
+    message_id = await session.run_sync(_insert, model, make_values(), partitioned)
+    if message_id is not None:
+        metrics.incr("messages_inserted", table=kind)
+        return await session.get(model, message_id, options=options), True
+    metrics.incr("message_duplicate_retries", table=kind, path="conflict")
+    result = await session.execute(
+        select(model).options(*options).filter_by(sender_id=sender_id, client_msg_id=client_msg_id)
+    )
+    return result.scalars().first(), False
+
+
+metrics.register_gauge("idempotency_cache_entries", lambda: len(_recent) if _recent else 0)
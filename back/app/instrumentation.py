@@ -0,0 +1,46 @@
+"""Latency histograms for HTTP requests and Socket.IO events.
+
+``http_request_seconds`` is labelled by endpoint, method and status, and
+``ws_event_seconds`` by event type. Both are exported at ``/metrics``.
+Streamed responses are timed up to the first byte.
+"""
+import time
+from contextlib import contextmanager
+
+from flask import request
+
+from app import query_stats
+from app.utils import metrics
+
+
+@contextmanager
+def ws_event(event_type, **kwargs):
+    """Time one Socket.IO event and count its queries (see ``app.query_stats``)."""
+    started = time.perf_counter()
+    try:
+        with query_stats.track_event(event_type, **kwargs) as scope:
+            yield scope
+    finally:
+        metrics.observe("ws_event_seconds", time.perf_counter() - started, type=query_stats.event_label(event_type))
+
+
+def _before_request():
+    request.started_at = time.perf_counter()
+
+
+def _after_request(response):
+    started = getattr(request, "started_at", None)
+    if started is not None:
+        metrics.observe(
+            "http_request_seconds",
+            time.perf_counter() - started,
+            endpoint=request.endpoint or "unmatched",
+            method=request.method,
+            status=response.status_code,
+        )
+    return response
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
@@ -0,0 +1,404 @@
+"""Durable background jobs in the application database.
+
+Work that doesn't belong on the request path is registered as a job and
+enqueued from anywhere with an app context::
+
+    @jobs.job("thumbnails:make", max_attempts=3)
+    def make_thumbnail(payload):
+        ...
+
+    jobs.enqueue("thumbnails:make", {"file": name})
+    db.session.commit()
+
+``enqueue`` adds a row to the ``jobs`` table in the caller's session, so the
+job exists exactly when the caller's transaction commits; callers that have
+already committed pass ``commit=True`` to write it in a transaction of its
+own. With ``key``, a job that is still queued under the same key absorbs the
+new one: bursts of the same work (one push per user, one reindex per
+conversation) collapse into one run.
+
+``flask jobs worker`` runs them: a polling loop claims due jobs with a
+conditional ``UPDATE ... WHERE status = 'queued'``, which works the same on
+SQLite and PostgreSQL and lets any number of workers share a queue, and hands
+them to ``--concurrency`` threads, each with its own app context and session.
+A claim is a lease of ``JOB_LEASE_SECONDS``; jobs of a worker that died are
+queued again once their lease runs out (or fail, if that was their last
+attempt), so handlers must tolerate running twice. While a handler runs, the
+worker keeps extending its lease; a worker that lost a lease anyway (say, a
+long database outage) leaves the job to whoever holds it now. A failed job is retried after ``JOB_BACKOFF_BASE * 2**(attempt - 1)``
+seconds (capped at ``JOB_BACKOFF_MAX``, with jitter) until ``max_attempts``,
+then kept with status ``failed`` and its last error. Finished jobs are deleted.
+
+Metrics: ``job_wait_seconds{job}`` (due -> started), ``job_run_seconds{job,outcome}``
+and ``jobs_run_total{job,outcome}`` in the worker (``--metrics-port`` serves them),
+and the ``jobs`` gauge (rows per status) wherever ``/metrics`` is scraped.
+"""
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import case, delete, func, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from app.extensions import db
+from app.models import Job
+from app.utils import metrics
+from app.utils.time import utcnow
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, FAILED = "queued", "running", "failed"
+
+# Seconds, from 10ms to a day: jobs can be scheduled far ahead or wait out a backlog.
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 86400)
+
+_handlers = {}  # name -> (func, queue, max_attempts)
+
+jobs_cli = AppGroup("jobs", help="Run and inspect background jobs.")
+
+
+class UnknownJob(LookupError):
+    pass
+
+
+def job(name: str, queue: str = "default", max_attempts: int = 5):
+    """Register the decorated ``func(payload)`` as the handler of job ``name``."""
+
+    def decorator(func):
+        _handlers[name] = (func, queue, max_attempts)
+        return func
+
+    return decorator
+
+
+def _add(session, name: str, payload: dict, delay: float, key: str) -> Job:
+    _, queue, max_attempts = _handlers[name]
+    if key is not None:
+        existing = session.query(Job).filter_by(key=key, status=QUEUED).first()
+        if existing is not None:
+            metrics.incr("jobs_coalesced", job=name)
+            return existing
+    row = Job(
+        queue=queue,
+        name=name,
+        payload=json.dumps(payload or {}, separators=(",", ":")),
+        key=key,
+        status=QUEUED,
+        attempts=0,
+        max_attempts=max_attempts,
+        run_at=utcnow() + timedelta(seconds=delay),
+    )
+    session.add(row)
+    metrics.incr("jobs_enqueued", job=name)
+    return row
+
+
+def enqueue(name: str, payload: dict = None, delay: float = 0, key: str = None, commit: bool = False) -> Job:
+    """Queue job ``name``; returns the new row, or the queued one with the same ``key``."""
+    if name not in _handlers:
+        raise UnknownJob(name)
+    if not commit:
+        return _add(db.session, name, payload, delay, key)
+    # A transaction of its own on the primary: the caller's session keeps its state and loaded objects.
+    with Session(db.engine, expire_on_commit=False) as session:
+        row = _add(session, name, payload, delay, key)
+        session.commit()
+    return row
+
+
+def backoff(attempt: int, base: float, cap: float) -> float:
+    """Seconds before retry number ``attempt`` (1-based): exponential, capped, with jitter."""
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def _aware(value):
+    # SQLite hands timestamps back without a timezone.
+    return value.replace(tzinfo=timezone.utc) if value is not None and value.tzinfo is None else value
+
+
+class Worker:
+    def __init__(self, app, queues=None, concurrency: int = 4, poll_interval: float = 1.0):
+        self.app = app
+        self.queues = list(queues or [])
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease = app.config["JOB_LEASE_SECONDS"]
+        self.backoff_base = app.config["JOB_BACKOFF_BASE"]
+        self.backoff_max = app.config["JOB_BACKOFF_MAX"]
+        self.id = f"{socket.gethostname()}:{os.getpid()}:{id(self) & 0xFFFF:04x}"
+        self._slots = threading.Semaphore(concurrency)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._active = set()  # ids of the jobs running now
+
+    def stop(self):
+        self._stop.set()
+
+    def requeue_expired(self) -> int:
+        """Put jobs whose lease ran out (their worker died) back in the queue; returns how many expired.
+
+        A job that has used up its attempts fails instead: one that kills its
+        worker would otherwise be claimed again forever.
+        """
+        exhausted = Job.attempts >= Job.max_attempts
+        result = db.session.execute(
+            update(Job)
+            .where(Job.status == RUNNING, Job.locked_until < utcnow())
+            .values(
+                status=case((exhausted, FAILED), else_=QUEUED),
+                last_error=case((exhausted, "Lease expired on the last attempt"), else_=Job.last_error),
+                locked_by=None,
+                locked_until=None,
+            )
+        )
+        db.session.commit()
+        if result.rowcount:
+            logger.warning("%d jobs had expired leases; requeued, or failed if out of attempts", result.rowcount)
+            metrics.incr("jobs_lease_expired", result.rowcount)
+        return result.rowcount
+
+    def claim(self, limit: int) -> list:
+        """Claim up to ``limit`` due jobs; returns their ids."""
+        now = utcnow()
+        query = db.session.query(Job.id).filter(Job.status == QUEUED, Job.run_at <= now)
+        if self.queues:
+            query = query.filter(Job.queue.in_(self.queues))
+        candidates = [row[0] for row in query.order_by(Job.run_at).limit(limit * 2)]
+        claimed = []
+        for job_id in candidates:
+            if len(claimed) >= limit:
+                break
+            # Whoever flips the status first owns the job; other workers update no row.
+            result = db.session.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == QUEUED)
+                .values(
+                    status=RUNNING, locked_by=self.id, locked_until=now + timedelta(seconds=self.lease),
+                    attempts=Job.attempts + 1,
+                )
+            )
+            if result.rowcount:
+                claimed.append(job_id)
+        db.session.commit()
+        return claimed
+
+    def _owned(self, job_id):
+        # Only while this worker still holds the lease: once it expired, another worker may own the job.
+        return Job.id == job_id, Job.status == RUNNING, Job.locked_by == self.id
+
+    def execute(self, job_id):
+        """Run one claimed job in its own app context."""
+        with self.app.app_context():
+            row = db.session.get(Job, job_id)
+            if row is None or row.status != RUNNING or row.locked_by != self.id:
+                return
+            name, attempts, max_attempts = row.name, row.attempts, row.max_attempts
+            wait = max(0.0, (utcnow() - _aware(row.run_at)).total_seconds())
+            metrics.observe("job_wait_seconds", wait, buckets=WAIT_BUCKETS, job=name)
+            started = time.perf_counter()
+            try:
+                handler = _handlers.get(name)
+                if handler is None:
+                    raise UnknownJob(name)
+                handler[0](json.loads(row.payload))
+                db.session.commit()
+            except Exception as exc:
+                db.session.rollback()
+                outcome = "error" if self._failed(job_id, name, exc, attempts, max_attempts) else "lost"
+            else:
+                deleted = db.session.execute(delete(Job).where(*self._owned(job_id))).rowcount
+                db.session.commit()
+                outcome = "ok" if deleted else "lost"
+            if outcome == "lost":
+                logger.warning("Job %s %s finished after losing its lease; it is another worker's now", name, job_id)
+            metrics.observe("job_run_seconds", time.perf_counter() - started, job=name, outcome=outcome)
+            metrics.incr("jobs_run", job=name, outcome=outcome)
+
+    def _failed(self, job_id, name: str, exc: Exception, attempts: int, max_attempts: int) -> bool:
+        """Retry or fail the job; False if this worker no longer holds it."""
+        values = {"last_error": f"{exc.__class__.__name__}: {exc}"[:2000], "locked_by": None, "locked_until": None}
+        final = attempts >= max_attempts or isinstance(exc, UnknownJob)
+        if final:
+            values["status"] = FAILED
+        else:
+            delay = backoff(attempts, self.backoff_base, self.backoff_max)
+            values.update(status=QUEUED, run_at=utcnow() + timedelta(seconds=delay))
+        updated = db.session.execute(update(Job).where(*self._owned(job_id)).values(**values)).rowcount
+        db.session.commit()
+        if not updated:
+            return False
+        if final:
+            logger.error("Job %s %s failed for good after %d attempts", name, job_id, attempts, exc_info=exc)
+        else:
+            logger.warning("Job %s %s failed (attempt %d), retrying in %.1fs: %s", name, job_id, attempts, delay, exc)
+        return True
+
+    def _heartbeat(self, done: threading.Event):
+        # Extends the leases of running jobs, so a slow handler is not taken for a dead worker.
+        while not done.wait(self.lease / 3):
+            with self._lock:
+                active = list(self._active)
+            if not active:
+                continue
+            with self.app.app_context():
+                try:
+                    db.session.execute(
+                        update(Job)
+                        .where(Job.id.in_(active), Job.status == RUNNING, Job.locked_by == self.id)
+                        .values(locked_until=utcnow() + timedelta(seconds=self.lease))
+                    )
+                    db.session.commit()
+                except SQLAlchemyError:
+                    db.session.rollback()
+                    logger.exception("Could not extend the leases of %d jobs", len(active))
+
+    def _run_one(self, job_id):
+        try:
+            self.execute(job_id)
+        except Exception:
+            logger.exception("Worker failed on job %s", job_id)
+        finally:
+            with self._lock:
+                self._active.discard(job_id)
+            self._slots.release()
+
+    def run(self, burst: bool = False) -> int:
+        """Process jobs until stopped (or, with ``burst``, until none are due); returns the number run."""
+        processed = 0
+        next_reap = 0.0
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(done,), name="job-heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            with ThreadPoolExecutor(self.concurrency, thread_name_prefix="job") as pool:
+                while not self._stop.is_set():
+                    with self.app.app_context():
+                        if time.monotonic() >= next_reap:
+                            self.requeue_expired()
+                            next_reap = time.monotonic() + self.lease / 2
+                        free = 0
+                        while self._slots.acquire(blocking=False):
+                            free += 1
+                        claimed = self.claim(free) if free else []
+                    for _ in range(free - len(claimed)):
+                        self._slots.release()
+                    with self._lock:
+                        self._active.update(claimed)
+                    for job_id in claimed:
+                        pool.submit(self._run_one, job_id)
+                    processed += len(claimed)
+                    if claimed and len(claimed) == free:
+                        # Every slot is busy: wait for one before polling again.
+                        self._slots.acquire()
+                        self._slots.release()
+                        continue
+                    with self._lock:
+                        idle = not self._active
+                    if burst and not claimed and idle:
+                        break
+                    self._stop.wait(self.poll_interval)
+        finally:
+            done.set()
+            heartbeat.join()
+        return processed
+
+
+def _serve_metrics(port: int, allowed):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if not metrics.scrape_allowed(self.client_address[0], allowed):
+                self.send_error(403)
+                return
+            body = metrics.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, name="job-metrics", daemon=True).start()
+
+
+@jobs_cli.command("worker")
+@click.option("--queue", "queues", multiple=True, help="Queues to take jobs from (default: all).")
+@click.option("--concurrency", type=int, default=None, help="Jobs run at the same time.")
+@click.option("--poll", type=float, default=None, help="Seconds between polls when idle.")
+@click.option("--burst", is_flag=True, help="Exit once no job is due.")
+@click.option("--metrics-port", type=int, default=None, help="Serve Prometheus metrics on this port.")
+@with_appcontext
+def worker_command(queues, concurrency, poll, burst, metrics_port):
+    """Run queued jobs."""
+    app = current_app._get_current_object()
+    worker = Worker(
+        app,
+        queues,
+        concurrency or app.config["JOB_CONCURRENCY"],
+        poll if poll is not None else app.config["JOB_POLL_INTERVAL"],
+    )
+    if metrics_port:
+        _serve_metrics(metrics_port, app.config["METRICS_ALLOWED_IPS"])
+    click.echo(f"Worker {worker.id}: queues {', '.join(queues) or 'all'}, concurrency {worker.concurrency}")
+    try:
+        processed = worker.run(burst=burst)
+    except KeyboardInterrupt:
+        worker.stop()
+        processed = None
+    if processed is not None:
+        click.echo(f"{processed} jobs run")
+
+
+@jobs_cli.command("stats")
+@with_appcontext
+def stats_command():
+    """Count jobs per name and status."""
+    rows = db.session.query(Job.name, Job.status, func.count()).group_by(Job.name, Job.status).all()
+    for name, status, count in sorted(rows):
+        click.echo(f"{name}\t{status}\t{count}")
+    if not rows:
+        click.echo("No jobs.")
+
+
+@jobs_cli.command("retry")
+@click.option("--name", default=None, help="Only jobs with this name.")
+@with_appcontext
+def retry_command(name):
+    """Queue failed jobs again."""
+    query = update(Job).where(Job.status == FAILED)
+    if name:
+        query = query.where(Job.name == name)
+    result = db.session.execute(query.values(status=QUEUED, attempts=0, run_at=utcnow(), last_error=None))
+    db.session.commit()
+    click.echo(f"{result.rowcount} jobs queued again")
+
+
+def _counts():
+    if not has_app_context():
+        return None
+    try:
+        return dict(db.session.query(Job.status, func.count()).group_by(Job.status).all())
+    except SQLAlchemyError:
+        db.session.rollback()
+        return None
+
+
+def init_app(app):
+    app.cli.add_command(jobs_cli)
+
+
+metrics.register_gauge("jobs", _counts, label="status")
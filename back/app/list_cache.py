@@ -0,0 +1,102 @@
+"""Per-user snapshots of the dialog and group lists with version tokens.
+
+Every event that can change what ``GET /dialogs`` or ``GET /groups`` returns for
+a user must call ``invalidate`` for that user; the bumped version doubles as the
+ETag so unchanged lists are answered with 304 without touching the database.
+
+Versions are kept the way app/versions.py keeps conversation counters: an LRU
+of ``LIST_VERSIONS_SIZE`` users, values from one clock, and once the LRU is
+full a missing user reports the latest clock value, so an evicted user never
+gets an old version (and a stale 304) back.
+"""
+import hashlib
+import itertools
+
+from flask import current_app
+
+from app.db_routing import on_replica
+from app.utils import metrics
+from app.utils.cache import LRUCache
+from app.utils.http_cache import BOOT_NONCE, conditional_json
+
+
+class ListCache:
+    def __init__(self, maxsize: int, versions_size: int = 100000):
+        self._snapshots = LRUCache(maxsize)
+        self._versions = LRUCache(versions_size)
+        self._clock = itertools.count(1)
+        self._last = 0
+
+    def __len__(self):
+        return len(self._snapshots)
+
+    def version(self, kind: str, user_id: str) -> int:
+        # Until something has been evicted, a missing user's lists have not changed since boot.
+        missing = self._last if len(self._versions) >= self._versions.maxsize else 0
+        return self._versions.get((kind, user_id), missing)
+
+    def etag(self, kind: str, user_id: str) -> str:
+        user_tag = hashlib.sha1(user_id.encode()).hexdigest()[:12]
+        return f"{kind}-{BOOT_NONCE}-{user_tag}-{self.version(kind, user_id)}"
+
+    def get(self, kind: str, user_id: str):
+        cached = self._snapshots.get((kind, user_id))
+        if cached is None or cached[0] != self.version(kind, user_id):
+            return None
+        return cached[1]
+
+    def set(self, kind: str, user_id: str, version: int, body):
+        self._snapshots.set((kind, user_id), (version, body))
+
+    def invalidate(self, kind: str, user_ids):
+        for user_id in set(user_ids):
+            value = next(self._clock)
+            self._last = max(self._last, value)
+            self._versions.set((kind, user_id), value)
+            self._snapshots.pop((kind, user_id))
+            metrics.incr("list_cache_invalidations", kind=kind)
+
+
+_list_cache = None
+
+
+def get_list_cache() -> ListCache:
+    global _list_cache
+    if _list_cache is None:
+        _list_cache = ListCache(
+            current_app.config.get("LIST_CACHE_SIZE", 10000), current_app.config.get("LIST_VERSIONS_SIZE", 100000)
+        )
+    return _list_cache
+
+
+def invalidate_dialogs(*user_ids):
+    get_list_cache().invalidate("dialogs", user_ids)
+
+
+def invalidate_groups(user_ids):
+    get_list_cache().invalidate("groups", user_ids)
+
+
+def cached_list_response(kind: str, user_id: str, build):
+    """Answer a list request from the snapshot, honouring ``If-None-Match``."""
+    cache = get_list_cache()
+    version = cache.version(kind, user_id)
+
+    def build_cached():
+        body = cache.get(kind, user_id)
+        if body is None:
+            metrics.incr("list_cache_misses", kind=kind)
+            body = build()
+            if not on_replica():
+                cache.set(kind, user_id, version, body)
+        else:
+            metrics.incr("list_cache_hits", kind=kind)
+        return body
+
+    response = conditional_json(cache.etag(kind, user_id), build_cached)
+    if response.status_code == 304:
+        metrics.incr("list_cache_not_modified", kind=kind)
+    return response
+
+
+metrics.register_gauge("list_cache_entries", lambda: len(_list_cache) if _list_cache else 0)
@@ -0,0 +1,145 @@
+"""Event-loop lag monitor and blocking-call detector.
+
+With a single eventlet worker, anything that blocks the hub (PBKDF2, Fernet
+over a large page, a slow non-green query, a file write) stalls every socket.
+A monitor task sleeps ``LOOP_MONITOR_INTERVAL`` seconds in a loop and records
+how late it wakes up (``event_loop_lag_seconds``). It runs as a greenlet under
+eventlet and as an asyncio task in the ASGI mode.
+
+A blocked loop can't report on itself, so a native OS thread watches the
+monitor's heartbeat. When the heartbeat is more than ``LOOP_STALL_THRESHOLD``
+seconds late, the watchdog logs the stack the loop thread is executing right
+now, which is the offending greenlet or coroutine, and counts the stall in
+``event_loop_stalls``. Each stall is reported once.
+
+``status()`` feeds the deep readiness check (``GET /ready``).
+"""
+import logging
+import sys
+import time
+import traceback
+from collections import deque
+
+from app.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 60
+
+_monitor = None
+
+
+def _native():
+    """Unpatched ``threading``, ``time.sleep`` and ``get_ident``, even after eventlet.monkey_patch."""
+    try:
+        from eventlet import patcher
+    except ImportError:
+        import _thread
+        import threading
+
+        return threading, time.sleep, _thread.get_ident
+    return patcher.original("threading"), patcher.original("time").sleep, patcher.original("_thread").get_ident
+
+
+class LoopMonitor:
+    def __init__(self, interval: float, stall_threshold: float, thread_ident: int):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.thread_ident = thread_ident
+        self.last_beat = time.monotonic()
+        self.last_lag = None
+        self.recent = deque(maxlen=max(1, int(WINDOW_SECONDS / interval)))
+        self.stall_reported = False
+        self.stalls = 0
+
+    def beat(self, lag: float):
+        self.last_beat = time.monotonic()
+        self.last_lag = lag
+        self.recent.append(lag)
+        self.stall_reported = False
+        metrics.observe("event_loop_lag_seconds", lag)
+
+    def check(self):
+        """Called from the watchdog thread; logs the loop's stack once per stall."""
+        overdue = time.monotonic() - self.last_beat - self.interval
+        if overdue < self.stall_threshold or self.stall_reported:
+            return
+        self.stall_reported = True
+        self.stalls += 1
+        metrics.incr("event_loop_stalls")
+        frame = sys._current_frames().get(self.thread_ident)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "(loop thread not found)\n"
+        logger.warning("Event loop blocked for %.3fs; it is running:\n%s", overdue + self.interval, stack)
+
+    def status(self) -> dict:
+        return {
+            "lag_seconds": self.last_lag,
+            "max_lag_seconds": max(self.recent) if self.recent else None,
+            "seconds_since_beat": round(time.monotonic() - self.last_beat, 3),
+            "stalls": self.stalls,
+        }
+
+
+def _start(app, thread_ident: int) -> LoopMonitor:
+    global _monitor
+    monitor = LoopMonitor(app.config["LOOP_MONITOR_INTERVAL"], app.config["LOOP_STALL_THRESHOLD"], thread_ident)
+    _monitor = monitor
+    threading, sleep, _ = _native()
+
+    def watchdog():
+        while _monitor is monitor:
+            sleep(monitor.interval / 2)
+            try:
+                monitor.check()
+            except Exception:
+                logger.exception("Loop watchdog failed")
+
+    threading.Thread(target=watchdog, name="loop-watchdog", daemon=True).start()
+    return monitor
+
+
+def _run_green(app):
+    from app.extensions import socketio
+
+    monitor = _start(app, _native()[2]())
+    while True:
+        expected = time.monotonic() + monitor.interval
+        socketio.sleep(monitor.interval)
+        monitor.beat(max(0.0, time.monotonic() - expected))
+
+
+async def run_asyncio(app):
+    """The same monitor for the ASGI mode's event loop; start it as a task on startup."""
+    import asyncio
+    import threading
+
+    monitor = _start(app, threading.get_ident())
+    while True:
+        expected = time.monotonic() + monitor.interval
+        await asyncio.sleep(monitor.interval)
+        monitor.beat(max(0.0, time.monotonic() - expected))
+
+
+def status() -> dict:
+    """Loop health for the readiness check; ``ok`` is True while the monitor hasn't started."""
+    from flask import current_app
+
+    if _monitor is None:
+        return {"ok": True, "running": False}
+    result = _monitor.status()
+    limit = current_app.config["READY_MAX_LOOP_LAG"]
+    result["ok"] = result["seconds_since_beat"] <= limit + _monitor.interval and (result["lag_seconds"] or 0) <= limit
+    result["running"] = True
+    return result
+
+
+def init_app(app):
+    from app.utils.background import start_on_first_request
+
+    if app.config.get("LOOP_MONITOR_INTERVAL") and app.extensions["socketio"].async_mode == "eventlet":
+        start_on_first_request(app, _run_green, app)
+
+
+metrics.register_gauge(
+    "event_loop_lag_max_seconds", lambda: max(_monitor.recent) if _monitor and _monitor.recent else None
+)
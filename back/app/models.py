@@ -1,20 +1,49 @@
 import uuid
 from datetime import datetime, timezone
 
-from sqlalchemy import CheckConstraint, UniqueConstraint, and_, or_
+from sqlalchemy import CheckConstraint, LargeBinary, UniqueConstraint, and_, or_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.types import TypeDecorator
 from werkzeug.security import check_password_hash, generate_password_hash
 
 from .extensions import db
+from .utils.ids import new_id, parse_id
 
 
 def _utcnow():
     return datetime.now(timezone.utc)
 
 
+class CompactUUID(TypeDecorator):
+    """UUID column: native ``uuid`` on PostgreSQL, 16 raw bytes elsewhere, ``str`` in Python."""
+
+    impl = LargeBinary(16)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(postgresql.UUID(as_uuid=False))
+        return dialect.type_descriptor(LargeBinary(16))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        parsed = parse_id(value)
+        if parsed is None:
+            # Malformed ids coming from URLs simply match no row.
+            return None
+        return str(parsed) if dialect.name == "postgresql" else parsed.bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None or isinstance(value, str):
+            return value
+        return str(uuid.UUID(bytes=bytes(value)))
+
+
 class User(db.Model):
     __tablename__ = "users"
 
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(db.String(36), primary_key=True, default=new_id)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password_hash = db.Column(db.String(255), nullable=False)
     avatar_url = db.Column(db.String(255), nullable=True)
@@ -35,6 +64,10 @@ class User(db.Model):
         return check_password_hash(self.password_hash, password)
 
 
+# Case-insensitive prefix lookups in /users/search range-scan this index.
+db.Index("ix_users_username_lower", db.func.lower(User.username))
+
+
 class Dialog(db.Model):
     __tablename__ = "dialogs"
     __table_args__ = (
@@ -42,12 +75,12 @@ class Dialog(db.Model):
         CheckConstraint("user1_id != user2_id", name="check_users_different"),
     )
 
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
     user1_id = db.Column(db.String(36), db.ForeignKey("users.id"), nullable=False)
     user2_id = db.Column(db.String(36), db.ForeignKey("users.id"), nullable=False)
     created_at = db.Column(db.DateTime(timezone=True), default=_utcnow, nullable=False)
     last_message_at = db.Column(db.DateTime(timezone=True), nullable=True)
-    last_message_id = db.Column(db.String(36), db.ForeignKey("messages.id"), nullable=True)
+    last_message_id = db.Column(CompactUUID, db.ForeignKey("messages.id"), nullable=True)
 
     user1 = db.relationship("User", foreign_keys=[user1_id], back_populates="dialogs_as_user1")
     user2 = db.relationship("User", foreign_keys=[user2_id], back_populates="dialogs_as_user2")
@@ -73,10 +106,14 @@ class Dialog(db.Model):
 
 class Message(db.Model):
     __tablename__ = "messages"
-    __table_args__ = (UniqueConstraint("sender_id", "client_msg_id", name="uq_sender_client_msg"),)
+    __table_args__ = (
+        UniqueConstraint("sender_id", "client_msg_id", name="uq_sender_client_msg"),
+        # History pages walk a dialog in id order; v7 ids are time-ordered.
+        db.Index("ix_messages_dialog_id_id", "dialog_id", "id"),
+    )
 
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    dialog_id = db.Column(db.String(36), db.ForeignKey("dialogs.id"), nullable=False, index=True)
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    dialog_id = db.Column(CompactUUID, db.ForeignKey("dialogs.id"), nullable=False)
     sender_id = db.Column(db.String(36), db.ForeignKey("users.id"), nullable=False, index=True)
     client_msg_id = db.Column(db.String(64), nullable=False)
     type = db.Column(db.String(20), nullable=False, default="text")
@@ -96,7 +133,7 @@ class Message(db.Model):
 class Group(db.Model):
     __tablename__ = "groups"
 
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
     name = db.Column(db.String(120), nullable=False)
     owner_id = db.Column(db.String(36), db.ForeignKey("users.id"), nullable=False)
     created_at = db.Column(db.DateTime(timezone=True), default=_utcnow, nullable=False)
@@ -110,8 +147,8 @@ class GroupMember(db.Model):
     __tablename__ = "group_members"
     __table_args__ = (UniqueConstraint("group_id", "user_id", name="uq_group_member"),)
 
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    group_id = db.Column(db.String(36), db.ForeignKey("groups.id"), nullable=False)
+    id = db.Column(db.String(36), primary_key=True, default=new_id)
+    group_id = db.Column(CompactUUID, db.ForeignKey("groups.id"), nullable=False)
     user_id = db.Column(db.String(36), db.ForeignKey("users.id"), nullable=False)
     added_at = db.Column(db.DateTime(timezone=True), default=_utcnow, nullable=False)
 
@@ -121,10 +158,13 @@ class GroupMember(db.Model):
 
 class GroupMessage(db.Model):
     __tablename__ = "group_messages"
-    __table_args__ = (UniqueConstraint("sender_id", "client_msg_id", name="uq_group_sender_client_msg"),)
+    __table_args__ = (
+        UniqueConstraint("sender_id", "client_msg_id", name="uq_group_sender_client_msg"),
+        db.Index("ix_group_messages_group_id_id", "group_id", "id"),
+    )
 
-    id = db.Column(db.String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
-    group_id = db.Column(db.String(36), db.ForeignKey("groups.id"), nullable=False, index=True)
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    group_id = db.Column(CompactUUID, db.ForeignKey("groups.id"), nullable=False)
     sender_id = db.Column(db.String(36), db.ForeignKey("users.id"), nullable=False, index=True)
     client_msg_id = db.Column(db.String(64), nullable=False)
     type = db.Column(db.String(20), nullable=False, default="text")
@@ -139,3 +179,40 @@ class GroupMessage(db.Model):
 
     group = db.relationship("Group", back_populates="messages")
     sender = db.relationship("User")
+
+
+class Job(db.Model):
+    """Deferred work; see app/jobs.py."""
+
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # Workers look for the oldest due job of their queues.
+        db.Index("ix_jobs_status_queue_run_at", "status", "queue", "run_at"),
+    )
+
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    queue = db.Column(db.String(64), nullable=False, default="default")
+    name = db.Column(db.String(128), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default="{}")  # JSON
+    key = db.Column(db.String(255), nullable=True, index=True)
+    status = db.Column(db.String(16), nullable=False, default="queued")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime(timezone=True), default=_utcnow, nullable=False)
+    locked_by = db.Column(db.String(64), nullable=True)
+    locked_until = db.Column(db.DateTime(timezone=True), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime(timezone=True), default=_utcnow, nullable=False)
+
+
+class PushDevice(db.Model):
+    """A device token for push notifications; see app/push.py."""
+
+    __tablename__ = "push_devices"
+
+    id = db.Column(CompactUUID, primary_key=True, default=new_id)
+    user_id = db.Column(db.String(36), db.ForeignKey("users.id"), nullable=False, index=True)
+    token = db.Column(db.String(255), unique=True, nullable=False)
+    platform = db.Column(db.String(16), nullable=True)
+    created_at = db.Column(db.DateTime(timezone=True), default=_utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime(timezone=True), default=_utcnow, onupdate=_utcnow, nullable=False)
@@ -0,0 +1,153 @@
+"""Monthly range partitions for ``messages`` and ``group_messages`` on PostgreSQL.
+
+The tables are converted by the ``partition message tables`` migration when it
+runs with ``MESSAGE_PARTITIONING=1``. This module keeps future partitions in
+place and derives the ``created_at`` bounds that let history queries prune.
+"""
+import logging
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.extensions import db, socketio
+from app.utils import metrics
+from app.utils.ids import id_datetime
+
+logger = logging.getLogger(__name__)
+
+PARTITIONED_TABLES = ("messages", "group_messages")
+
+# Upper bound on how far a row's created_at can trail the timestamp in its id.
+ID_CLOCK_SLACK = timedelta(minutes=1)
+
+MAINTENANCE_INTERVAL = 6 * 60 * 60
+
+partitions_cli = AppGroup("partitions", help="Manage monthly message partitions.")
+
+
+def _month_start(dt: datetime) -> datetime:
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(dt: datetime) -> datetime:
+    return (dt.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def partition_name(table: str, month: datetime) -> str:
+    return f"{table}_y{month:%Y}m{month:%m}"
+
+
+def is_partitioned(connection, table: str) -> bool:
+    if connection.dialect.name != "postgresql":
+        return False
+    return bool(
+        connection.execute(
+            text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)"),
+            {"table": table},
+        ).scalar()
+    )
+
+
+def _exists(conn, name: str) -> bool:
+    return bool(conn.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar())
+
+
+def _create_partition(conn, table: str, name: str, start: datetime, end: datetime) -> int:
+    """Create partition ``name`` of ``table`` for ``[start, end)``; returns rows moved out of DEFAULT."""
+    bounds = f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    default = f"{table}_default"
+    in_range = "created_at >= :start AND created_at < :end"
+    params = {"start": start, "end": end}
+    stranded = 0
+    if _exists(conn, default):
+        stranded = conn.execute(text(f'SELECT count(*) FROM "{default}" WHERE {in_range}'), params).scalar()
+    if not stranded:
+        conn.execute(text(f'CREATE TABLE "{name}" PARTITION OF "{table}" {bounds}'))
+        return 0
+    # PostgreSQL refuses a partition whose range already has rows in DEFAULT: take DEFAULT out,
+    # create the partition, move the rows through the parent and put DEFAULT back.
+    conn.execute(text(f'ALTER TABLE "{table}" DETACH PARTITION "{default}"'))
+    conn.execute(text(f'CREATE TABLE "{name}" PARTITION OF "{table}" {bounds}'))
+    conn.execute(text(f'INSERT INTO "{table}" SELECT * FROM "{default}" WHERE {in_range}'), params)
+    conn.execute(text(f'DELETE FROM "{default}" WHERE {in_range}'), params)
+    conn.execute(text(f'ALTER TABLE "{table}" ATTACH PARTITION "{default}" DEFAULT'))
+    return stranded
+
+
+def ensure_partitions(months_ahead: int = None, now: datetime = None):
+    """Create the current month's partitions and ``months_ahead`` more; returns new names.
+
+    Rows that landed in the DEFAULT partition for want of their month's
+    partition are moved into it. A partition that can't be created is logged
+    and counted (``message_partition_errors``) and the others still are.
+    """
+    if months_ahead is None:
+        months_ahead = current_app.config.get("MESSAGE_PARTITIONS_AHEAD", 3)
+    month = _month_start(now or datetime.now(timezone.utc))
+    created = []
+    with db.engine.begin() as conn:
+        for table in PARTITIONED_TABLES:
+            if not is_partitioned(conn, table):
+                continue
+            start = month
+            for _ in range(months_ahead + 1):
+                end = _next_month(start)
+                name = partition_name(table, start)
+                if not _exists(conn, name):
+                    try:
+                        with conn.begin_nested():
+                            moved = _create_partition(conn, table, name, start, end)
+                    except SQLAlchemyError:
+                        logger.exception("Could not create message partition %s", name)
+                        metrics.incr("message_partition_errors", table=table)
+                    else:
+                        created.append(name)
+                        if moved:
+                            logger.warning("Moved %d rows of %s out of the DEFAULT partition", moved, name)
+                            metrics.incr("message_partition_rows_moved", moved, table=table)
+                start = end
+    return created
+
+
+def created_at_upper_bound(before_id):
+    """Newest ``created_at`` a row older than the ``before_id`` cursor can have.
+
+    Adding this predicate to id-paged history queries lets PostgreSQL skip every
+    partition that starts after the cursor.
+    """
+    ts = id_datetime(before_id)
+    return ts + ID_CLOCK_SLACK if ts is not None else None
+
+
+def _maintenance_loop(app):
+    while True:
+        with app.app_context():
+            try:
+                created = ensure_partitions()
+                if created:
+                    logger.info("Created message partitions: %s", ", ".join(created))
+            except Exception:
+                logger.exception("Message partition maintenance failed")
+            finally:
+                db.session.remove()
+        socketio.sleep(MAINTENANCE_INTERVAL)
+
+
+def init_app(app):
+    from app.utils.background import start_on_first_request
+
+    app.cli.add_command(partitions_cli)
+    if app.config.get("MESSAGE_PARTITIONING"):
+        start_on_first_request(app, _maintenance_loop, app)
+
+
+@partitions_cli.command("ensure")
+@click.option("--ahead", type=int, default=None, help="Months to create beyond the current one.")
+def ensure_command(ahead):
+    """Create missing monthly partitions."""
+    created = ensure_partitions(ahead)
+    click.echo("\n".join(created) if created else "All partitions present.")
@@ -0,0 +1,217 @@
+"""On-demand sampling profiler for the running worker.
+
+A native OS thread wakes every ``interval`` seconds for ``seconds`` seconds and
+records the Python stack of every other thread from ``sys._current_frames()``.
+Under eventlet all greenlets share the hub thread, so each sample is the
+greenlet that holds the CPU at that instant, which is what a CPU spike is made
+of. Stacks are counted in the collapsed format (``thread;outer;...;leaf count``
+per line) that ``flamegraph.pl``, speedscope and inferno read directly.
+
+Samples where a thread is only waiting (the eventlet hub or asyncio selector
+polling, lock and condition waits) are dropped unless ``include_idle`` is set,
+so an idle worker produces an almost empty profile.
+
+Safeguards: one profile at a time per process (``ProfilerBusy`` otherwise),
+``PROFILE_MAX_SECONDS`` caps the duration, and the sampler stops at its
+deadline on its own, whether or not anyone collects the result.
+
+Started by ``POST /admin/profile`` or, without HTTP, by ``kill -USR2 <pid>``,
+which writes the profile to ``PROFILE_DIR``.
+"""
+import logging
+import os
+import signal
+import sys
+import time
+from collections import Counter
+
+from app.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# (path suffix, function) of leaf frames that mean "waiting, not running".
+IDLE_LEAVES = (
+    ("/selectors.py", "select"),
+    ("/threading.py", "wait"),
+    ("/queue.py", "get"),
+    ("/eventlet/hubs/hub.py", "wait"),
+    ("/eventlet/hubs/epolls.py", "do_poll"),
+    ("/eventlet/hubs/poll.py", "do_poll"),
+    ("/eventlet/hubs/poll.py", "wait"),
+    ("/eventlet/hubs/selects.py", "wait"),
+    ("/eventlet/hubs/kqueue.py", "wait"),
+    # Sleeps in C between checks, so its leaf is its own frame.
+    ("/app/loop_monitor.py", "watchdog"),
+)
+
+# Never sample faster than this, whatever the caller asks for.
+MIN_INTERVAL = 0.001
+
+_lock = None
+_last = None
+_max_seconds = 60.0
+
+
+def _native():
+    """Unpatched ``threading`` and ``time.sleep``, even after eventlet.monkey_patch."""
+    try:
+        from eventlet import patcher
+    except ImportError:
+        import threading
+
+        return threading, time.sleep
+    return patcher.original("threading"), patcher.original("time").sleep
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+def _short_path(filename: str) -> str:
+    marker = "site-packages" + os.sep
+    if marker in filename:
+        return filename.split(marker, 1)[1]
+    cwd = os.getcwd() + os.sep
+    return filename[len(cwd):] if filename.startswith(cwd) else filename
+
+
+def _thread_names(native_threading) -> dict:
+    # eventlet's original threading module keeps its own registry, which lacks
+    # threads started through the (possibly unpatched) public one.
+    import threading
+
+    threads = threading.enumerate() + (native_threading.enumerate() if native_threading is not threading else [])
+    return {t.ident: t.name.replace(";", "_") for t in threads}
+
+
+def _is_idle(code) -> bool:
+    return any(code.co_name == name and code.co_filename.endswith(suffix) for suffix, name in IDLE_LEAVES)
+
+
+class Profile:
+    def __init__(self, seconds: float, interval: float, include_idle: bool = False):
+        self.seconds = seconds
+        self.interval = interval
+        self.include_idle = include_idle
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle_samples = 0
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self._labels = {}
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def sample(self, own_ident: int, thread_names: dict):
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            self.samples += 1
+            if not self.include_idle and _is_idle(frame.f_code):
+                self.idle_samples += 1
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.append(thread_names.get(ident, f"thread-{ident}"))
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def run(self):
+        threading, sleep = _native()
+        own = threading.get_ident()
+        self.started_at = time.time()
+        deadline = time.monotonic() + self.seconds
+        try:
+            while time.monotonic() < deadline:
+                names = _thread_names(threading)
+                self.sample(own, names)
+                sleep(self.interval)
+        except Exception as exc:
+            logger.exception("Profiler failed")
+            self.error = exc.__class__.__name__
+        finally:
+            self.finished_at = time.time()
+            metrics.incr("profiles")
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self) -> dict:
+        return {
+            "running": not self.done,
+            "seconds": self.seconds,
+            "interval": self.interval,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "samples": self.samples,
+            "idle_samples": self.idle_samples,
+            "stacks": len(self.stacks),
+            "error": self.error,
+        }
+
+
+def start(seconds: float, interval: float, include_idle: bool = False, on_done=None) -> Profile:
+    """Start sampling in a native thread; raises ``ProfilerBusy`` if one is running."""
+    global _last
+    if not _lock.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running")
+    profile = Profile(min(seconds, _max_seconds), max(interval, MIN_INTERVAL), include_idle)
+    _last = profile
+
+    def target():
+        try:
+            profile.run()
+            if on_done is not None:
+                on_done(profile)
+        finally:
+            _lock.release()
+
+    try:
+        _native()[0].Thread(target=target, name="profiler", daemon=True).start()
+    except Exception:
+        _lock.release()
+        raise
+    logger.info("Profiling for %.1fs every %.4fs", profile.seconds, profile.interval)
+    return profile
+
+
+def last() -> Profile:
+    return _last
+
+
+def _write(directory: str, profile: Profile):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"profile-{os.getpid()}-{int(profile.started_at)}.collapsed")
+    with open(path, "w") as fh:
+        fh.write(profile.collapsed())
+    logger.info("Profile written to %s", path)
+
+
+def init_app(app):
+    global _lock, _max_seconds
+    if _lock is None:
+        _lock = _native()[0].Lock()
+    _max_seconds = app.config["PROFILE_MAX_SECONDS"]
+    if not hasattr(signal, "SIGUSR2") or _native()[0].current_thread() is not _native()[0].main_thread():
+        return
+    seconds = app.config["PROFILE_DEFAULT_SECONDS"]
+    interval = app.config["PROFILE_INTERVAL"]
+    directory = app.config["PROFILE_DIR"]
+
+    def handle(signum, frame):
+        try:
+            start(seconds, interval, on_done=lambda profile: _write(directory, profile))
+        except ProfilerBusy:
+            logger.warning("SIGUSR2 ignored: a profile is already running")
+
+    signal.signal(signal.SIGUSR2, handle)
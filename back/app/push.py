@@ -0,0 +1,268 @@
+"""Push notifications for recipients who are offline.
+
+Live delivery only reaches ``user:<id>`` rooms, so a recipient with no socket
+hears about a message only when the app reconnects. With ``PUSH_PROVIDER``
+set, every send (WS, ASGI and REST, through ``events.message_sent``) checks
+which recipients have no socket on this server and, if any, enqueues one
+``push:fanout`` job (``app/jobs.py``) with their ids: a single insert after
+the message is committed, nothing else on the send path.
+
+In the worker, ``push:fanout`` keeps the recipients that registered a device
+(``POST /push/devices``) and enqueues ``push:notify`` for each, delayed by
+``PUSH_COALESCE_SECONDS`` and keyed by user. Further messages within that
+window join the queued job, so a burst turns into one notification per user:
+the job counts what the user hasn't seen since the first message and sends
+"alice: see you at 8", "5 new messages" (one chat) or "12 new messages in
+4 chats" to each of their devices. Dialog messages already read by then
+are not counted, and nothing is sent if none are left.
+
+Providers: ``expo`` (Expo push API, which forwards to APNs/FCM) and ``fake``,
+which records what it would send (and appends it to ``PUSH_FAKE_PATH`` as
+JSON lines) for tests and local runs. Tokens the provider reports as
+unregistered are deleted. ``PUSH_PREVIEW=0`` keeps message text out of
+notifications.
+"""
+import json
+import logging
+import time
+import urllib.error
+import urllib.request
+
+from flask import current_app
+from sqlalchemy import and_, case, func, or_, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import jobs
+from app.extensions import db
+from app.models import Dialog, Group, GroupMember, GroupMessage, Message, PushDevice, User
+from app.utils import metrics
+from app.utils.security import decrypt_text
+from app.utils.time import isoformat, parse_iso8601
+from app.ws import outbound
+
+logger = logging.getLogger(__name__)
+
+OK, INVALID, ERROR = "ok", "invalid", "error"
+
+_provider = None
+
+
+class PushError(Exception):
+    """The provider could not take the notifications; the job is retried."""
+
+
+class FakeProvider:
+    name = "fake"
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.sent = []
+        self.invalid = set()  # tokens to report as unregistered
+
+    def send(self, notifications: list) -> list:
+        self.sent.extend(notifications)
+        if self.path:
+            with open(self.path, "a") as fh:
+                fh.writelines(json.dumps(n, separators=(",", ":")) + "\n" for n in notifications)
+        return [INVALID if n["token"] in self.invalid else OK for n in notifications]
+
+
+class ExpoProvider:
+    name = "expo"
+    CHUNK = 100  # messages per request the API accepts
+
+    def __init__(self, url: str, access_token: str = None, timeout: float = 10):
+        self.url = url
+        self.access_token = access_token
+        self.timeout = timeout
+
+    def _post(self, messages: list) -> list:
+        headers = {"Accept": "application/json", "Content-Type": "application/json"}
+        if self.access_token:
+            headers["Authorization"] = f"Bearer {self.access_token}"
+        request = urllib.request.Request(self.url, data=json.dumps(messages).encode(), method="POST", headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())["data"]
+        except (urllib.error.URLError, ValueError, KeyError) as exc:
+            raise PushError(f"Expo push request failed: {exc}") from exc
+
+    def send(self, notifications: list) -> list:
+        results = []
+        for start in range(0, len(notifications), self.CHUNK):
+            chunk = notifications[start:start + self.CHUNK]
+            tickets = self._post(
+                [
+                    {"to": n["token"], "title": n["title"], "body": n["body"], "data": n["data"], "sound": "default"}
+                    for n in chunk
+                ]
+            )
+            for ticket in tickets:
+                if ticket.get("status") == "ok":
+                    results.append(OK)
+                elif (ticket.get("details") or {}).get("error") == "DeviceNotRegistered":
+                    results.append(INVALID)
+                else:
+                    logger.warning("Expo rejected a notification: %s", ticket.get("message"))
+                    results.append(ERROR)
+        return results
+
+
+def from_config(config):
+    backend = config.get("PUSH_PROVIDER") or ""
+    if not backend:
+        return None
+    if backend == "fake":
+        return FakeProvider(config.get("PUSH_FAKE_PATH") or None)
+    if backend == "expo":
+        return ExpoProvider(config["PUSH_EXPO_URL"], config.get("PUSH_EXPO_ACCESS_TOKEN") or None)
+    raise ValueError(f"Unknown PUSH_PROVIDER {backend!r}; expected expo or fake")
+
+
+def get():
+    return _provider
+
+
+def message_sent(kind: str, created_at, payload: dict, member_ids):
+    """Queue pushes for the recipients of a committed message who have no live socket."""
+    if _provider is None:
+        return
+    sender_id = payload.get("sender_id")
+    offline = [user_id for user_id in member_ids if user_id != sender_id and not outbound.is_online(user_id)]
+    if not offline:
+        return
+    metrics.incr("push_offline_recipients", len(offline), kind=kind)
+    try:
+        jobs.enqueue("push:fanout", {"since": isoformat(created_at), "user_ids": offline}, commit=True)
+    except SQLAlchemyError:
+        # The message is already committed and delivered live; losing its push is the lesser harm.
+        db.session.rollback()
+        logger.exception("Could not queue pushes for %d recipients", len(offline))
+        metrics.incr("push_enqueue_errors")
+
+
+@jobs.job("push:fanout", queue="push")
+def fanout(payload: dict):
+    delay = current_app.config["PUSH_COALESCE_SECONDS"]
+    since = payload["since"]
+    for user_id in sorted(set(payload["user_ids"])):
+        # A no-op UPDATE of the user's devices: finds out whether there are any, and locks them
+        # (the rows on PostgreSQL, the database on SQLite) until this job commits, so concurrent
+        # fanouts for the same user take turns and coalesce instead of both queueing a push.
+        touched = db.session.execute(
+            update(PushDevice).where(PushDevice.user_id == user_id).values(updated_at=PushDevice.updated_at)
+        )
+        if not touched.rowcount:
+            continue
+        queued = jobs.enqueue("push:notify", {"user_id": user_id, "since": since}, delay=delay, key=f"push:{user_id}")
+        # Fanouts can run out of order; the notification covers everything from the earliest message.
+        pending = json.loads(queued.payload)
+        # Parsed, not as strings: isoformat() drops the fraction when microseconds are 0.
+        if parse_iso8601(since) < parse_iso8601(pending["since"]):
+            queued.payload = json.dumps({**pending, "since": since}, separators=(",", ":"))
+
+
+def _unread(user_id: str, since) -> list:
+    """``[(kind, conversation_id, count, last_at)]`` of messages to ``user_id`` since ``since``."""
+    dialogs = (
+        db.session.query(Message.dialog_id, func.count(), func.max(Message.created_at))
+        .join(Dialog, Dialog.id == Message.dialog_id)
+        .filter(
+            or_(Dialog.user1_id == user_id, Dialog.user2_id == user_id),
+            Message.sender_id != user_id,
+            Message.read_at.is_(None),
+            Message.created_at >= since,
+        )
+        .group_by(Message.dialog_id)
+    )
+    groups = (
+        db.session.query(GroupMessage.group_id, func.count(), func.max(GroupMessage.created_at))
+        .join(GroupMember, and_(GroupMember.group_id == GroupMessage.group_id, GroupMember.user_id == user_id))
+        .filter(GroupMessage.sender_id != user_id, GroupMessage.created_at >= since)
+        .group_by(GroupMessage.group_id)
+    )
+    rows = [("dialog", *row) for row in dialogs] + [("group", *row) for row in groups]
+    return sorted(rows, key=lambda row: row[3], reverse=True)
+
+
+def _titles(user_id: str, rows: list) -> dict:
+    dialog_ids = [row[1] for row in rows if row[0] == "dialog"]
+    group_ids = [row[1] for row in rows if row[0] == "group"]
+    titles = {}
+    if dialog_ids:
+        peer_id = case((Dialog.user1_id == user_id, Dialog.user2_id), else_=Dialog.user1_id)
+        query = db.session.query(Dialog.id, User.username).join(User, User.id == peer_id).filter(Dialog.id.in_(dialog_ids))
+        titles.update((("dialog", dialog_id), username) for dialog_id, username in query)
+    if group_ids:
+        query = db.session.query(Group.id, Group.name).filter(Group.id.in_(group_ids))
+        titles.update((("group", group_id), name) for group_id, name in query)
+    return titles
+
+
+def _preview(kind: str, conversation_id: str, user_id: str) -> str:
+    model, column = (Message, Message.dialog_id) if kind == "dialog" else (GroupMessage, GroupMessage.group_id)
+    message = (
+        model.query.filter(column == conversation_id, model.sender_id != user_id)
+        .order_by(model.created_at.desc())
+        .first()
+    )
+    if message.type == "text":
+        text = decrypt_text(message.text) or ""
+    else:
+        text = f"[{message.type}] {message.file_name or ''}".rstrip()
+    if kind == "group":
+        text = f"{message.sender.username}: {text}"
+    return text[:180]
+
+
+def summarize(user_id: str, since, preview: bool = True):
+    """One notification's ``title``, ``body`` and ``data`` for what ``user_id`` missed, or None."""
+    rows = _unread(user_id, since)
+    if not rows:
+        return None
+    titles = _titles(user_id, rows)
+    total = sum(row[2] for row in rows)
+    data = {
+        "type": "messages",
+        "count": total,
+        "conversations": [{"kind": kind, "id": cid, "count": count} for kind, cid, count, _ in rows],
+    }
+    if len(rows) == 1:
+        kind, conversation_id, count, _ = rows[0]
+        title = titles.get((kind, conversation_id)) or "New message"
+        if count == 1:
+            body = _preview(kind, conversation_id, user_id) if preview else "New message"
+        else:
+            body = f"{count} new messages"
+        return {"title": title, "body": body, "data": data}
+    names = [titles.get((kind, cid)) for kind, cid, _, _ in rows]
+    names = [name for name in names if name]
+    body = ", ".join(names[:3]) + (f" and {len(rows) - 3} more" if len(rows) > 3 else "")
+    return {"title": f"{total} new messages in {len(rows)} chats", "body": body, "data": data}
+
+
+@jobs.job("push:notify", queue="push", max_attempts=3)
+def notify(payload: dict):
+    provider = get()
+    if provider is None:
+        return
+    user_id = payload["user_id"]
+    devices = PushDevice.query.filter_by(user_id=user_id).all()
+    if not devices:
+        return
+    summary = summarize(user_id, parse_iso8601(payload["since"]), current_app.config["PUSH_PREVIEW"])
+    if summary is None:
+        metrics.incr("push_skipped", provider=provider.name)
+        return
+    started = time.perf_counter()
+    results = provider.send([{"token": device.token, **summary} for device in devices])
+    metrics.observe("push_send_seconds", time.perf_counter() - started, provider=provider.name)
+    for device, result in zip(devices, results):
+        metrics.incr("push_notifications", provider=provider.name, outcome=result)
+        if result == INVALID:
+            db.session.delete(device)
+
+
+def init_app(app):
+    global _provider
+    _provider = from_config(app.config)
@@ -0,0 +1,185 @@
+"""Query counts and database time per HTTP request and per Socket.IO event.
+
+Every statement on any engine (primary, replicas, the async engine of the ASGI
+mode) is counted against the scope it runs in: an HTTP request, scoped by
+endpoint, or one Socket.IO event, scoped as ``ws:<event type>``. The current
+scope lives in a context variable, so it follows greenlets, threads and asyncio
+tasks alike. When a scope ends:
+
+* ``db_queries`` and ``db_query_time_us`` are incremented for it;
+* a statement that ran ``N_PLUS_ONE_THRESHOLD`` times or more is logged with its
+  SQL as a likely N+1 (``db_n_plus_one``);
+* a scope over its budget is logged (``db_query_budget_exceeded``), or raises
+  ``QueryBudgetExceeded`` when ``QUERY_BUDGET_ENFORCE`` is set, which is meant
+  for test runs. Views declare budgets with ``@query_budget(n)``, events in
+  ``EVENT_BUDGETS``; ``QUERY_BUDGET_DEFAULT`` covers the rest. Views whose
+  queries grow with what they list (one lookup per dialog, say) declare
+  ``@query_budget(n, per_item=k)`` and report the rows with ``count_items``.
+
+In debug mode, or with ``QUERY_STATS_HEADERS``, HTTP responses carry
+``X-DB-Queries`` and ``X-DB-Time-Ms``.
+"""
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import current_app, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# Queries per Socket.IO event type, as the eventlet handlers run them.
+EVENT_BUDGETS = {
+    "auth": 0,
+    "message:send": 9,  # one of them queues pushes for an offline peer
+    "message:delivered": 4,
+    "message:read": 6,
+    "group:message:send": 8,
+}
+
+_current = ContextVar("query_scope", default=None)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryScope:
+    def __init__(self, name: str, budget=None, per_item: int = 0):
+        self.name = name
+        self.budget = budget
+        self.per_item = per_item
+        self.items = 0
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    def record(self, statement: str, seconds: float):
+        self.count += 1
+        self.seconds += seconds
+        self.statements[statement] += 1
+
+    def repeated(self, threshold: int) -> list:
+        return [(statement, n) for statement, n in self.statements.most_common() if n >= threshold]
+
+
+def query_budget(limit: int, per_item: int = 0):
+    """Declare the most queries a view may run per request, plus ``per_item`` per counted item."""
+
+    def decorator(view):
+        view.query_budget = limit
+        view.query_budget_per_item = per_item
+        return view
+
+    return decorator
+
+
+def count_items(n: int):
+    """Report ``n`` items built in the current scope; each raises a ``per_item`` budget."""
+    scope = _current.get()
+    if scope is not None:
+        scope.items += n
+
+
+def current_scope():
+    return _current.get()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    scope = _current.get()
+    started = conn.info.get("query_started")
+    if scope is not None and started:
+        scope.record(statement, time.perf_counter() - started.pop())
+
+
+def _config(key, default=None):
+    return current_app.config.get(key, default) if has_app_context() else default
+
+
+def finish(scope: QueryScope, config=_config):
+    """Record the scope's totals and check it for N+1 patterns and its budget."""
+    metrics.incr("db_queries", scope.count, scope=scope.name)
+    metrics.incr("db_query_time_us", int(scope.seconds * 1_000_000), scope=scope.name)
+    for statement, n in scope.repeated(config("N_PLUS_ONE_THRESHOLD", 10)):
+        metrics.incr("db_n_plus_one", scope=scope.name)
+        logger.warning("Possible N+1 in %s: statement ran %d times: %s", scope.name, n, " ".join(statement.split()))
+    if scope.budget is not None:
+        budget = scope.budget + scope.per_item * scope.items
+    else:
+        budget = config("QUERY_BUDGET_DEFAULT")
+    if budget is not None and scope.count > budget:
+        metrics.incr("db_query_budget_exceeded", scope=scope.name)
+        message = f"{scope.name} ran {scope.count} queries, budget is {budget}"
+        if config("QUERY_BUDGET_ENFORCE"):
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+
+@contextmanager
+def track(name: str, budget=None, config=_config):
+    """Count the queries of one unit of work, such as a Socket.IO event."""
+    scope = QueryScope(name, budget)
+    token = _current.set(scope)
+    try:
+        yield scope
+    finally:
+        _current.reset(token)
+    finish(scope, config)
+
+
+def event_label(event_type) -> str:
+    # Event types come from clients; keep unknown ones out of the metric labels.
+    return event_type if event_type in EVENT_BUDGETS else "unknown"
+
+
+def track_event(event_type: str, config=_config):
+    event_type = event_label(event_type)
+    return track(f"ws:{event_type}", EVENT_BUDGETS.get(event_type), config)
+
+
+def _before_request():
+    view = current_app.view_functions.get(request.endpoint)
+    scope = QueryScope(
+        request.endpoint or "unmatched",
+        getattr(view, "query_budget", None),
+        getattr(view, "query_budget_per_item", 0),
+    )
+    request.query_scope_token = _current.set(scope)
+
+
+def _after_request(response):
+    scope = _current.get()
+    if scope is None:
+        return response
+    if current_app.debug or current_app.config.get("QUERY_STATS_HEADERS"):
+        response.headers["X-DB-Queries"] = str(scope.count)
+        response.headers["X-DB-Time-Ms"] = f"{scope.seconds * 1000:.2f}"
+    # Streamed bodies query after this point; they are not counted.
+    _current.reset(request.query_scope_token)
+    request.query_scope_token = None
+    finish(scope)
+    return response
+
+
+def _teardown_request(exc):
+    token = getattr(request, "query_scope_token", None)
+    if token is not None:
+        _current.reset(token)
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
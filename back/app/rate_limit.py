@@ -0,0 +1,106 @@
+"""Token-bucket rate limits per user and event type.
+
+Every (user, event type) pair has a bucket holding up to ``burst`` tokens that
+refills at ``rate`` tokens per second; each event takes one. An event that
+finds its bucket empty is rejected without touching the database: the
+Socket.IO dispatchers answer with an ``error`` whose code is ``rate_limited``
+and whose ``retry_after`` says when a token will be available, and the REST
+send endpoints return ``429`` with ``Retry-After``. REST and Socket.IO share
+buckets: ``POST /dialogs/<id>/messages`` draws from ``message:send``.
+
+``RATE_LIMITS`` is ``event=rate/burst`` pairs, comma separated; ``*`` covers
+event types that are not listed, and an empty value disables limiting.
+Buckets live in an LRU of ``RATE_LIMIT_MAX_KEYS`` entries; an evicted bucket
+comes back full, which only ever favours the client. Rejections are counted
+in ``rate_limited{event,transport}``.
+"""
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import jsonify
+from flask_jwt_extended import get_jwt_identity
+
+from app.utils import metrics
+from app.utils.cache import LRUCache
+
+_limiter = None
+
+
+def parse_limits(spec: str) -> dict:
+    """``"message:send=10/30,*=50/100"`` -> ``{"message:send": (10.0, 30.0), "*": (50.0, 100.0)}``."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        event, _, value = item.rpartition("=")
+        rate, _, burst = value.partition("/")
+        if not event or not rate or float(rate) <= 0:
+            raise ValueError(f"Invalid rate limit {item!r}; expected event=rate/burst with rate > 0")
+        limits[event.strip()] = (float(rate), max(1.0, float(burst or rate)))
+    return limits
+
+
+class RateLimiter:
+    def __init__(self, limits: dict, max_keys: int):
+        self.limits = limits
+        self._buckets = LRUCache(max_keys)
+        # REST routes and the ASGI event loop can take tokens from different threads.
+        self._lock = threading.Lock()
+
+    def hit(self, user_id: str, event: str, now: float = None) -> float:
+        """Take a token; returns 0 when allowed, else the seconds until one is available."""
+        limit = self.limits.get(event) or self.limits.get("*")
+        if limit is None:
+            return 0.0
+        rate, burst = limit
+        key = (user_id, event if event in self.limits else "*")
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.get(key) or (burst, now)
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets.set(key, (tokens - 1, now))
+                return 0.0
+            self._buckets.set(key, (tokens, now))
+        return (1 - tokens) / rate
+
+
+def check(user_id: str, event: str, transport: str) -> float:
+    """``RateLimiter.hit`` on the app's limiter, counting rejections."""
+    if _limiter is None:
+        return 0.0
+    retry_after = _limiter.hit(user_id, event)
+    if retry_after:
+        metrics.incr("rate_limited", event=event if event in _limiter.limits else "*", transport=transport)
+    return retry_after
+
+
+def ws_error(event: str, retry_after: float, payload: dict) -> dict:
+    error = {"code": "rate_limited", "message": "Rate limit exceeded", "event": event, "retry_after": round(retry_after, 3)}
+    if isinstance(payload, dict) and payload.get("client_msg_id"):
+        error["client_msg_id"] = payload["client_msg_id"]
+    return {"error": error}
+
+
+def limit(event: str):
+    """Apply ``event``'s bucket to a REST view; goes under ``@jwt_required()``."""
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            retry_after = check(get_jwt_identity(), event, "rest")
+            if retry_after:
+                response = jsonify({"error": {"code": "rate_limited", "message": "Rate limit exceeded"}})
+                response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+                return response, 429
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def init_app(app):
+    global _limiter
+    limits = parse_limits(app.config.get("RATE_LIMITS"))
+    _limiter = RateLimiter(limits, app.config.get("RATE_LIMIT_MAX_KEYS", 100000)) if limits else None
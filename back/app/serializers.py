@@ -0,0 +1,31 @@
+"""Message payloads shared by REST routes and both WebSocket servers."""
+from app.models import GroupMessage, Message
+from app.utils.security import decrypt_text
+from app.utils.time import isoformat
+
+
+def _message_fields(message) -> dict:
+    sender = message.sender
+    return {
+        "client_msg_id": message.client_msg_id,
+        "sender_id": message.sender_id,
+        "sender_username": sender.username if sender else None,
+        "sender_avatar_url": sender.avatar_url if sender else None,
+        "type": message.type,
+        "text": decrypt_text(message.text),
+        "file_url": message.file_url,
+        "file_name": message.file_name,
+        "file_mime": message.file_mime,
+        "file_size": message.file_size,
+        "created_at": isoformat(message.created_at),
+        "delivered_at": isoformat(message.delivered_at),
+        "read_at": isoformat(message.read_at),
+    }
+
+
+def serialize_message(message: Message) -> dict:
+    return {"id": message.id, "dialog_id": message.dialog_id, **_message_fields(message)}
+
+
+def serialize_group_message(message: GroupMessage) -> dict:
+    return {"id": message.id, "group_id": message.group_id, **_message_fields(message)}
@@ -0,0 +1,200 @@
+"""Storage backends for attachments.
+
+Clients upload in two steps: ``POST /uploads/presign`` returns a URL that
+accepts exactly one ``PUT`` of the declared size and type, and the message
+then refers to the file by its stable app URL ``/uploads/<name>``.
+
+* ``local`` (default): files live in ``UPLOAD_DIR`` (``instance/uploads``);
+  the presigned URL points back at the app (``PUT /uploads/<name>``, signed
+  with ``SECRET_KEY``) and ``GET /uploads/<name>`` serves the file, as before.
+* ``s3``: any S3-compatible store (AWS, MinIO, Ceph RGW). URLs are presigned
+  with Signature Version 4 (query string, ``UNSIGNED-PAYLOAD``); the PUT URL
+  also signs ``Content-Type`` and ``Content-Length``, so the store rejects
+  anything but the declared file. ``GET /uploads/<name>`` answers with a
+  redirect to a presigned GET. No attachment byte passes through the app.
+
+Presigned URLs live ``UPLOAD_URL_EXPIRES`` seconds and uploads are capped at
+``UPLOAD_MAX_BYTES``. The multipart ``POST /uploads`` still works for older
+clients; with ``s3`` the app forwards the body to the store itself.
+"""
+import hashlib
+import hmac
+import os
+import shutil
+import time
+import urllib.request
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import quote, urlsplit
+
+from flask import redirect, send_from_directory
+
+_storage = None
+
+ALGORITHM = "AWS4-HMAC-SHA256"
+
+
+def _quote(value: str, safe: str = "-_.~") -> str:
+    return quote(value, safe=safe)
+
+
+class LocalStorage:
+    name = "local"
+
+    def __init__(self, root: str, secret: str, expires: int):
+        self.root = Path(root)
+        self._secret = secret.encode()
+        self.expires = expires
+
+    def _signature(self, method: str, name: str, expires: int, size: int, mime: str) -> str:
+        message = f"{method}\n{name}\n{expires}\n{size}\n{mime}".encode()
+        return hmac.new(self._secret, message, hashlib.sha256).hexdigest()
+
+    def presign_put(self, name: str, mime: str, size: int, base_url: str) -> str:
+        expires = int(time.time()) + self.expires
+        signature = self._signature("PUT", name, expires, size, mime)
+        return f"{base_url}/uploads/{_quote(name)}?expires={expires}&size={size}&signature={signature}"
+
+    def verify_put(self, name: str, expires: str, size: str, mime: str, signature: str) -> bool:
+        if not expires.isdigit() or not size.isdigit() or int(expires) < time.time():
+            return False
+        expected = self._signature("PUT", name, int(expires), int(size), mime)
+        return hmac.compare_digest(expected, signature)
+
+    def save(self, name: str, stream, size: int, mime: str) -> int:
+        """Write ``stream`` to ``name``; returns the bytes written, at most ``size``."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self.root / name
+        with open(path, "wb") as fh:
+            shutil.copyfileobj(_Limited(stream, size), fh)
+        return path.stat().st_size
+
+    def serve(self, name: str):
+        return send_from_directory(self.root, name, as_attachment=False)
+
+
+class _Limited:
+    """Reads at most ``limit`` bytes from ``stream``."""
+
+    def __init__(self, stream, limit: int):
+        self.stream = stream
+        self.remaining = limit
+
+    def read(self, size: int = -1) -> bytes:
+        if self.remaining <= 0:
+            return b""
+        size = self.remaining if size is None or size < 0 else min(size, self.remaining)
+        data = self.stream.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+class S3Storage:
+    name = "s3"
+
+    def __init__(
+        self, endpoint: str, bucket: str, region: str, access_key: str, secret_key: str, expires: int,
+        prefix: str = "", virtual_host: bool = False,
+    ):
+        parts = urlsplit(endpoint)
+        self.scheme = parts.scheme or "https"
+        self.bucket = bucket
+        self.region = region
+        self.access_key = access_key
+        self._secret_key = secret_key
+        self.expires = expires
+        self.prefix = prefix
+        if virtual_host:
+            self.host = f"{bucket}.{parts.netloc}"
+            self.base_path = parts.path.rstrip("/")
+        else:
+            self.host = parts.netloc
+            self.base_path = f"{parts.path.rstrip('/')}/{bucket}"
+
+    def _signing_key(self, datestamp: str) -> bytes:
+        key = ("AWS4" + self._secret_key).encode()
+        for part in (datestamp, self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        return key
+
+    def presign(self, method: str, name: str, headers: dict = None, query: dict = None, now: datetime = None) -> str:
+        """A SigV4 query-string presigned URL for ``method`` on object ``name``."""
+        now = now or datetime.now(timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        scope = f"{amz_date[:8]}/{self.region}/s3/aws4_request"
+        signed = {"host": self.host, **{k.lower(): str(v).strip() for k, v in (headers or {}).items()}}
+        signed_headers = ";".join(sorted(signed))
+        params = {
+            "X-Amz-Algorithm": ALGORITHM,
+            "X-Amz-Credential": f"{self.access_key}/{scope}",
+            "X-Amz-Date": amz_date,
+            "X-Amz-Expires": str(self.expires),
+            "X-Amz-SignedHeaders": signed_headers,
+            **(query or {}),
+        }
+        canonical_query = "&".join(f"{_quote(k)}={_quote(v)}" for k, v in sorted(params.items()))
+        path = _quote(f"{self.base_path}/{self.prefix}{name}", safe="/-_.~")
+        canonical_request = "\n".join(
+            [
+                method,
+                path,
+                canonical_query,
+                "".join(f"{k}:{signed[k]}\n" for k in sorted(signed)),
+                signed_headers,
+                "UNSIGNED-PAYLOAD",
+            ]
+        )
+        string_to_sign = "\n".join(
+            [ALGORITHM, amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()]
+        )
+        signature = hmac.new(self._signing_key(amz_date[:8]), string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return f"{self.scheme}://{self.host}{path}?{canonical_query}&X-Amz-Signature={signature}"
+
+    def presign_put(self, name: str, mime: str, size: int, base_url: str = None) -> str:
+        return self.presign("PUT", name, {"Content-Type": mime, "Content-Length": size})
+
+    def save(self, name: str, stream, size: int, mime: str) -> int:
+        request = urllib.request.Request(
+            self.presign_put(name, mime, size),
+            data=_Limited(stream, size),
+            method="PUT",
+            headers={"Content-Type": mime, "Content-Length": str(size)},
+        )
+        with urllib.request.urlopen(request, timeout=60):
+            pass
+        return size
+
+    def serve(self, name: str):
+        response = redirect(self.presign("GET", name))
+        # Good for a little less than the URL itself.
+        response.headers["Cache-Control"] = f"private, max-age={max(0, self.expires - 60)}"
+        return response
+
+
+def from_config(config, instance_path: str):
+    backend = config.get("STORAGE_BACKEND") or "local"
+    expires = config["UPLOAD_URL_EXPIRES"]
+    if backend == "local":
+        root = config.get("UPLOAD_DIR") or os.path.join(instance_path, "uploads")
+        return LocalStorage(root, config["SECRET_KEY"], expires)
+    if backend == "s3":
+        return S3Storage(
+            config["S3_ENDPOINT"],
+            config["S3_BUCKET"],
+            config["S3_REGION"],
+            config["S3_ACCESS_KEY"],
+            config["S3_SECRET_KEY"],
+            expires,
+            prefix=config.get("S3_KEY_PREFIX") or "",
+            virtual_host=config.get("S3_ADDRESSING") == "virtual",
+        )
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}; expected local or s3")
+
+
+def get():
+    return _storage
+
+
+def init_app(app):
+    global _storage
+    _storage = from_config(app.config, app.instance_path)
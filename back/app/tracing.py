@@ -0,0 +1,178 @@
+"""Message lifecycle tracing: send, delivered and read.
+
+A send (``message:send``, ``group:message:send`` or the REST equivalents)
+opens a ``MessageTrace`` and times its stages: ``load`` (conversation lookup
+and access check), ``encrypt``, ``insert``, ``commit``, ``serialize``,
+``cache`` (the ``app.events`` hooks), ``members`` (group member list, where
+it is read separately) and ``emit`` (ack and fan-out). Stage
+times exclude nested stages, so they add up to ``total``. They are recorded in
+``message_stage_seconds{kind,transport,stage}``; retried sends that found an
+earlier insert are not recorded.
+
+The message id is the trace context: the trace id is its hex form, so the
+peer's ``message:delivered`` and ``message:read`` land in the same trace
+without extra state. Those record the time since the message was stored in
+``message_lifecycle_seconds{kind,phase}``, measured with the server clock.
+
+With ``TRACE_EXPORT_PATH`` set, spans are appended to that file as JSON lines
+(one trace per message, ``TRACE_SAMPLE_RATE`` of messages, sampled by id so a
+message is either fully traced or not at all) for a local collector. Writes are
+buffered and flushed at most once per second, and on exit (ASGI shutdown in
+the ASGI mode).
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timezone
+
+from app.utils import metrics
+from app.utils.ids import parse_id
+from app.utils.time import utcnow
+
+# Seconds, from 50ms to a day: peers can be offline for a long time.
+LIFECYCLE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 21600, 86400)
+FLUSH_INTERVAL = 1.0
+FLUSH_LINES = 200
+
+_export_path = None
+_sample_rate = 1.0
+_buffer = []
+_last_flush = 0.0
+_lock = threading.Lock()
+
+
+def _span_id() -> str:
+    return os.urandom(8).hex()
+
+
+def trace_id(message_id) -> str:
+    return parse_id(message_id).hex
+
+
+def sampled(message_id) -> bool:
+    if _export_path is None:
+        return False
+    # The low bits of a v7 id are random.
+    return (parse_id(message_id).int & 0xFFFFFFFF) < _sample_rate * 0x100000000
+
+
+class MessageTrace:
+    def __init__(self, kind: str, transport: str):
+        self.kind = kind
+        self.transport = transport
+        self.start_ns = time.time_ns()
+        self.started = time.perf_counter()
+        self.stages = []  # (name, start offset, duration, exclusive duration)
+        self._children = [0.0]
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        self._children.append(0.0)
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            nested = self._children.pop()
+            self._children[-1] += duration
+            self.stages.append((name, started - self.started, duration, duration - nested))
+
+    def timed(self, name: str, func, *args):
+        with self.stage(name):
+            return func(*args)
+
+    def finish(self, message_id, created: bool):
+        if not created or message_id is None:
+            return
+        total = time.perf_counter() - self.started
+        labels = {"kind": self.kind, "transport": self.transport}
+        for name, _, _, exclusive in self.stages:
+            metrics.observe("message_stage_seconds", exclusive, stage=name, **labels)
+        metrics.observe("message_stage_seconds", total, stage="total", **labels)
+        if sampled(message_id):
+            tid = trace_id(message_id)
+            root = _span_id()
+            spans = [_span(tid, root, None, "message.send", self.start_ns, total, message_id=str(message_id), **labels)]
+            spans.extend(
+                _span(tid, _span_id(), root, name, self.start_ns + int(offset * 1e9), duration)
+                for name, offset, duration, _ in self.stages
+            )
+            _export(spans)
+
+
+def _span(tid, span_id, parent, name, start_ns, seconds, **attributes) -> dict:
+    return {
+        "trace_id": tid,
+        "span_id": span_id,
+        "parent_span_id": parent,
+        "name": name,
+        "start_unix_nano": start_ns,
+        "end_unix_nano": start_ns + int(seconds * 1e9),
+        "attributes": attributes,
+    }
+
+
+def _since_stored(message) -> float:
+    created_at = message.created_at
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (utcnow() - created_at).total_seconds())
+
+
+def _phase(phase: str, kind: str, message, transport: str):
+    elapsed = _since_stored(message)
+    metrics.observe("message_lifecycle_seconds", elapsed, buckets=LIFECYCLE_BUCKETS, kind=kind, phase=phase)
+    if sampled(message.id):
+        now = time.time_ns()
+        span = _span(trace_id(message.id), _span_id(), None, f"message.{phase}", now, 0, kind=kind, transport=transport)
+        span["attributes"]["since_stored_seconds"] = round(elapsed, 6)
+        _export([span])
+
+
+def delivered(kind: str, message, transport: str):
+    """The recipient acknowledged ``message``."""
+    _phase("delivered", kind, message, transport)
+
+
+def read(kind: str, message, transport: str):
+    """The recipient read up to ``message``."""
+    _phase("read", kind, message, transport)
+
+
+def _export(spans: list):
+    global _last_flush
+    lines = [json.dumps(span, separators=(",", ":")) + "\n" for span in spans]
+    with _lock:
+        _buffer.extend(lines)
+        now = time.monotonic()
+        if len(_buffer) < FLUSH_LINES and now - _last_flush < FLUSH_INTERVAL:
+            return
+        pending = "".join(_buffer)
+        _buffer.clear()
+        _last_flush = now
+    _write(pending)
+
+
+def _write(data: str):
+    if data and _export_path:
+        with open(_export_path, "a") as fh:
+            fh.write(data)
+
+
+def flush():
+    with _lock:
+        pending = "".join(_buffer)
+        _buffer.clear()
+    _write(pending)
+
+
+def init_app(app):
+    global _export_path, _sample_rate
+    _export_path = app.config.get("TRACE_EXPORT_PATH") or None
+    _sample_rate = app.config.get("TRACE_SAMPLE_RATE", 1.0)
+
+
+atexit.register(flush)
@@ -0,0 +1,17 @@
+from app.extensions import socketio
+
+
+def start_on_first_request(app, target, *args):
+    """Run ``target(*args)`` as a background task once the app starts serving.
+
+    Deferring to the first request keeps ``flask db ...`` and other CLI commands,
+    which also build the app, from spawning server-side loops.
+    """
+    started = False
+
+    @app.before_request
+    def _start_background_task():
+        nonlocal started
+        if not started:
+            started = True
+            socketio.start_background_task(target, *args)
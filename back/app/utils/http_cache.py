@@ -0,0 +1,34 @@
+import os
+
+from flask import current_app, jsonify, request
+
+from app import wire
+from app.db_routing import on_replica
+
+# In-memory version counters restart with the process, so every ETag built from
+# them carries a per-boot nonce to keep tokens from different runs apart.
+BOOT_NONCE = os.urandom(4).hex()
+
+
+def conditional_json(etag: str, build):
+    """Return 304 if the client already holds ``etag``, otherwise ``jsonify(build())``.
+
+    Bodies built from a replica go out without the ETag: they may predate the
+    version it names. Clients that prefer MessagePack get it (``app/wire.py``),
+    under an ETag of its own.
+    """
+    packed = wire.prefers_msgpack()
+    if packed:
+        etag += "-mp"
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    elif packed:
+        response = current_app.response_class(wire.packb(build()), mimetype=wire.MSGPACK_MIMETYPE)
+    else:
+        response = jsonify(build())
+    if response.status_code == 304 or not on_replica():
+        response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    if wire.MSGPACK in wire.available():
+        response.vary.add("Accept")
+    return response
@@ -0,0 +1,66 @@
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+_last_ms = 0
+_seq = 0
+
+
+def uuid7(ms: int = None) -> uuid.UUID:
+    """Time-ordered UUID (RFC 9562 version 7).
+
+    Ids generated by this process are strictly increasing: within one
+    millisecond the 12-bit ``rand_a`` field is used as a counter.
+    """
+    global _last_ms, _seq
+    monotonic = ms is None
+    if monotonic:
+        ms = time.time_ns() // 1_000_000
+        if ms <= _last_ms:
+            ms = _last_ms
+            _seq += 1
+            if _seq > 0xFFF:
+                ms += 1
+                _seq = 0
+        else:
+            # Start in the lower half so a burst still has room to count up.
+            _seq = int.from_bytes(os.urandom(2), "big") & 0x7FF
+        _last_ms = ms
+        rand_a = _seq
+    else:
+        rand_a = int.from_bytes(os.urandom(2), "big") & 0xFFF
+    rand_b = int.from_bytes(os.urandom(8), "big") & ((1 << 62) - 1)
+    value = (ms & ((1 << 48) - 1)) << 80 | 0x7 << 76 | rand_a << 64 | 0b10 << 62 | rand_b
+    return uuid.UUID(int=value)
+
+
+def new_id() -> str:
+    return str(uuid7())
+
+
+def id_for_datetime(dt: datetime) -> str:
+    """Random v7 id whose timestamp part is ``dt``; used to re-key existing rows."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return str(uuid7(int(dt.timestamp() * 1000)))
+
+
+def parse_id(value):
+    """Return ``value`` as a ``uuid.UUID``, or None if it is not a valid id."""
+    if isinstance(value, uuid.UUID):
+        return value
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return uuid.UUID(bytes=bytes(value)) if len(value) == 16 else None
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        return None
+
+
+def id_datetime(value):
+    """Creation time encoded in a v7 id, or None for other ids."""
+    parsed = parse_id(value)
+    if parsed is None or parsed.version != 7:
+        return None
+    return datetime.fromtimestamp((parsed.int >> 80) / 1000, tz=timezone.utc)
@@ -0,0 +1,163 @@
+"""Process-local counters, histograms and gauges for operational visibility.
+
+Everything here is plain dict arithmetic so it can sit on the hot send path;
+values are only formatted when ``snapshot`` (JSON, ``/stats``) or
+``render_prometheus`` (text format, ``/metrics``) is called. Histograms use
+fixed bucket bounds, so ``observe`` is one bisect and three additions.
+
+Both expose internals (endpoints, queue names, pool state), so they are
+served only to peers in ``METRICS_ALLOWED_IPS``; see ``scrape_allowed``.
+"""
+import bisect
+import ipaddress
+import itertools
+import math
+from collections import defaultdict
+
+# Seconds, from 100µs to 10s.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Counts such as recipients per message.
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+_counters = defaultdict(int)
+_histograms = {}
+_gauges = {}
+
+
+class _Histogram:
+    __slots__ = ("bounds", "buckets", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted(labels.items()))
+
+
+def incr(name: str, value: int = 1, **labels):
+    _counters[_key(name, labels)] += value
+
+
+def observe(name: str, value: float, buckets=LATENCY_BUCKETS, **labels):
+    """Add ``value`` to a histogram; the first call for a name fixes its buckets."""
+    key = _key(name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = _Histogram(buckets)
+    histogram.buckets[bisect.bisect_left(histogram.bounds, value)] += 1
+    histogram.sum += value
+    histogram.count += 1
+
+
+def register_gauge(name: str, func, label: str = None):
+    """Register ``func`` to be sampled whenever a snapshot is taken.
+
+    ``func`` returns a number, or a dict keyed by ``label`` whose values are
+    numbers or dicts of numbers (one series per field).
+    """
+    _gauges[name] = (func, label)
+
+
+def counter_value(name: str, **labels) -> int:
+    return _counters.get(_key(name, labels), 0)
+
+
+def scrape_allowed(address: str, allowed) -> bool:
+    """Whether ``address`` is in ``allowed``, a list of IPs and CIDR networks."""
+    try:
+        peer = ipaddress.ip_address(address or "")
+    except ValueError:
+        return False
+    return any(peer in ipaddress.ip_network(network, strict=False) for network in allowed)
+
+
+def _format(name: str, labels) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+
+def _histogram_summary(histogram: _Histogram) -> dict:
+    return {
+        "count": histogram.count,
+        "sum": round(histogram.sum, 6),
+        "buckets": {str(bound): n for bound, n in zip(histogram.bounds, itertools.accumulate(histogram.buckets))},
+    }
+
+
+def snapshot() -> dict:
+    return {
+        "counters": {_format(name, labels): value for (name, labels), value in sorted(_counters.items())},
+        "histograms": {
+            _format(name, labels): _histogram_summary(histogram)
+            for (name, labels), histogram in sorted(_histograms.items(), key=lambda item: item[0])
+        },
+        "gauges": {name: func() for name, (func, _) in sorted(_gauges.items())},
+    }
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _series(name: str, labels, value) -> str:
+    if labels:
+        name += "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+    if isinstance(value, float) and math.isinf(value):
+        value = "+Inf" if value > 0 else "-Inf"
+    return f"{name} {value}"
+
+
+def _bound(bound) -> str:
+    return "+Inf" if bound is None else repr(float(bound))
+
+
+def _gauge_families(name: str, value, label: str) -> dict:
+    """Series of one gauge grouped by metric name, as Prometheus requires."""
+    families = defaultdict(list)
+    if isinstance(value, dict):
+        for key, item in sorted(value.items(), key=lambda kv: str(kv[0])):
+            labels = ((label or "key", key),)
+            if isinstance(item, dict):
+                for field, v in sorted(item.items()):
+                    if v is not None:
+                        families[f"{name}_{field}"].append(_series(f"{name}_{field}", labels, v))
+            elif item is not None:
+                families[name].append(_series(name, labels, item))
+    elif value is not None:
+        families[name].append(_series(name, (), value))
+    return families
+
+
+def render_prometheus(prefix: str = "poebtalk_") -> str:
+    """Every metric in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    typed = set()
+
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(_counters.items()):
+        full = f"{prefix}{name}_total"
+        declare(full, "counter")
+        lines.append(_series(full, labels, value))
+    for (name, labels), histogram in sorted(_histograms.items(), key=lambda item: item[0]):
+        full = prefix + name
+        declare(full, "histogram")
+        cumulative = 0
+        for bound, n in zip(histogram.bounds + (None,), histogram.buckets):
+            cumulative += n
+            lines.append(_series(f"{full}_bucket", labels + (("le", _bound(bound)),), cumulative))
+        lines.append(_series(f"{full}_sum", labels, histogram.sum))
+        lines.append(_series(f"{full}_count", labels, histogram.count))
+    for name, (func, label) in sorted(_gauges.items()):
+        for full, series in _gauge_families(prefix + name, func(), label).items():
+            declare(full, "gauge")
+            lines.extend(series)
+    return "\n".join(lines) + "\n"
@@ -1,10 +1,13 @@
 import os
 import base64
 import hashlib
+import time
 from typing import Optional
 from cryptography.fernet import Fernet, InvalidToken
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from app.utils import metrics
+
 
 def hash_password(password: str) -> str:
     return generate_password_hash(password)
@@ -37,15 +40,21 @@ def encrypt_text(plain: str) -> str:
     if plain is None:
         return None
     f = _get_fernet()
-    return f.encrypt(plain.encode()).decode()
+    started = time.perf_counter()
+    token = f.encrypt(plain.encode()).decode()
+    metrics.observe("crypto_seconds", time.perf_counter() - started, op="encrypt")
+    return token
 
 
 def decrypt_text(value: str) -> str:
     if value is None:
         return None
     f = _get_fernet()
+    started = time.perf_counter()
     try:
         return f.decrypt(value.encode()).decode()
     except InvalidToken:
         # If stored plaintext from old data, return as-is to avoid data loss
         return value
+    finally:
+        metrics.observe("crypto_seconds", time.perf_counter() - started, op="decrypt")
@@ -0,0 +1,51 @@
+"""Per-conversation change counters used to build ETags for history responses.
+
+A conversation's counter is bumped whenever a message is added or a message's
+delivered/read status changes, which are the only ways a page can go stale.
+
+Counters live in an LRU of ``ETAG_VERSIONS_SIZE`` conversations. Every bump
+takes the next value of one process-wide clock, so a conversation that was
+evicted and comes back never reuses a version it had before. Once the LRU has
+filled up, conversations not in it report the current clock: possibly a
+needless cache miss, never a stale ``304``.
+"""
+import hashlib
+import itertools
+
+from flask import current_app
+
+from app.utils.cache import LRUCache
+from app.utils.http_cache import BOOT_NONCE
+
+_clock = itertools.count(1)
+_last = 0
+_versions = None
+
+
+def _get_versions() -> LRUCache:
+    global _versions
+    if _versions is None:
+        _versions = LRUCache(current_app.config.get("ETAG_VERSIONS_SIZE", 100000))
+    return _versions
+
+
+def bump(kind: str, conversation_id: str):
+    global _last
+    value = next(_clock)
+    _last = max(_last, value)
+    _get_versions().set((kind, conversation_id), value)
+
+
+def version(kind: str, conversation_id: str) -> int:
+    versions = _get_versions()
+    # Until something has been evicted, a missing conversation has not changed since boot.
+    missing = _last if len(versions) >= versions.maxsize else 0
+    return versions.get((kind, conversation_id), missing)
+
+
+def etag(kind: str, conversation_id: str, *parts) -> str:
+    raw = ":".join(
+        [BOOT_NONCE, kind, conversation_id, str(version(kind, conversation_id))]
+        + [str(part) for part in parts]
+    )
+    return hashlib.sha1(raw.encode()).hexdigest()
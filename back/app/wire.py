@@ -0,0 +1,108 @@
+"""Compact wire encoding: MessagePack with integer timestamps.
+
+JSON stays the default everywhere. A Socket.IO client opts in per connection
+with ``"encoding": "msgpack"`` in ``auth``; from then on every event for that
+socket carries a single binary attachment instead of a JSON object:
+``[event, <msgpack bytes>]``, which stock Socket.IO clients already receive as
+bytes. REST endpoints answered through ``conditional_json`` do the same for
+requests that prefer ``Accept: application/msgpack``.
+
+The MessagePack form is the JSON document with one change: string values of
+``*_at`` keys (ISO 8601 timestamps) become integer milliseconds since the
+epoch. Keys are kept, so a client decodes both forms with the same code.
+
+Each event is packed once per emit, however many sockets receive it. A batch
+(``app/ws/backpressure.py``) for a MessagePack socket is one attachment as
+well, built by concatenating the packed events behind an array header.
+
+``WS_ENCODINGS`` lists the encodings clients may pick besides JSON; MessagePack
+needs the ``msgpack`` package and is left out when it isn't installed.
+"""
+import struct
+
+from flask import request
+
+from app.utils.time import parse_iso8601
+
+try:
+    import msgpack
+except ImportError:  # optional: without it only JSON is offered
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+MSGPACK_MIMETYPE = "application/msgpack"
+
+_enabled = {JSON}
+
+
+def available() -> set:
+    return _enabled
+
+
+def negotiate(requested) -> str:
+    """The encoding to use for a client that asked for ``requested``."""
+    return requested if requested in _enabled else JSON
+
+
+def prefers_msgpack() -> bool:
+    """Whether the current request's ``Accept`` ranks MessagePack above JSON."""
+    if MSGPACK not in _enabled:
+        return False
+    return request.accept_mimetypes.best_match(["application/json", MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE
+
+
+def _millis(value):
+    parsed = parse_iso8601(value)
+    if parsed is None:
+        return value
+    return int(parsed.timestamp() * 1000)
+
+
+def compact(data):
+    """``data`` with ``*_at`` timestamps as epoch milliseconds; other values are kept."""
+    if isinstance(data, dict):
+        return {
+            key: _millis(value) if isinstance(value, str) and key.endswith("_at") else compact(value)
+            for key, value in data.items()
+        }
+    if isinstance(data, (list, tuple)):
+        return [compact(item) for item in data]
+    return data
+
+
+def packb(data) -> bytes:
+    return msgpack.packb(compact(data), use_bin_type=True)
+
+
+def _array_header(length: int) -> bytes:
+    if length < 16:
+        return bytes((0x90 | length,))
+    if length < 0x10000:
+        return b"\xdc" + struct.pack(">H", length)
+    return b"\xdd" + struct.pack(">I", length)
+
+
+_BATCH_PREFIX = None
+
+
+def pack_batch(parts: list) -> bytes:
+    """``{"type": "batch", "payload": {"events": [...]}}`` from already packed ``[event, data]`` pairs."""
+    global _BATCH_PREFIX
+    if _BATCH_PREFIX is None:
+        # The fixed part of the document, up to the events array.
+        _BATCH_PREFIX = (
+            b"\x82" + msgpack.packb("type") + msgpack.packb("batch") + msgpack.packb("payload") + b"\x81"
+            + msgpack.packb("events")
+        )
+    return _BATCH_PREFIX + _array_header(len(parts)) + b"".join(parts)
+
+
+def init_app(app):
+    global _enabled
+    _enabled = {JSON}
+    for name in filter(None, (part.strip() for part in (app.config.get("WS_ENCODINGS") or "").split(","))):
+        if name == MSGPACK and msgpack is not None:
+            _enabled.add(MSGPACK)
+        elif name != JSON:
+            app.logger.warning("Wire encoding %r is not available", name)
@@ -0,0 +1,405 @@
+"""Bounded per-socket outbound queues and batched delivery.
+
+python-socketio hands every outgoing packet to the recipient's Engine.IO
+socket queue, which a writer drains as fast as the client reads. That queue is
+unbounded, so a slow mobile client in a busy group makes it grow for as long
+as the client stays connected. The client managers here replace the default
+one and check each recipient's queue depth before sending:
+
+* below ``WS_QUEUE_SOFT_LIMIT`` packets, events are sent as usual;
+* at or above it, collapsible events (``message:status``) are parked per
+  socket instead, a newer update for the same key replacing the older one,
+  and sent once the queue has drained below the limit; events that can't be
+  collapsed keep queueing;
+* at ``WS_QUEUE_MAX`` packets the client is treated as stuck: its queue is
+  cleared and the session is closed without waiting for the writer, which may
+  be blocked on the client's full TCP window; Engine.IO's ping timeout ends
+  the connection itself. The client reconnects and catches up over REST.
+
+Sockets that asked for it at ``auth`` get batched delivery instead: events
+for them accumulate for ``WS_BATCH_WINDOW_MS`` and go out as one ``batch``
+event whose payload lists them in order as ``[event, data]`` pairs,
+collapsing status updates the same way. One frame per window replaces one per event, which is most of the cost
+in an active group. Each event is JSON-encoded once however many batches it
+joins; a batch frame is the encoded events joined together.
+
+Sockets that negotiated MessagePack (``app/wire.py``) get events, batched or
+not, packed once per emit for all of them.
+
+Collapsed and dropped events are counted in ``ws_outbound_dropped{event,reason}``
+and disconnects in ``ws_outbound_overflows``; ``ws_batch_events`` is the size
+of each batch. With ``WS_QUEUE_MAX=0``, ``WS_BATCH_WINDOW_MS=0`` and an empty
+``WS_ENCODINGS`` the stock manager is used. Room emits still encode each packet
+once per encoding.
+"""
+import asyncio
+import itertools
+import logging
+
+import socketio
+from engineio import packet as eio_packet
+from socketio import packet
+
+from app import wire
+from app.utils import metrics
+
+logger = logging.getLogger(__name__)
+
+SEND, PARK, OVERFLOW = range(3)
+
+_manager = None
+
+
+def collapse_key(event: str, data):
+    """Updates with equal keys supersede each other; None means the event must be delivered as is."""
+    if event != "message:status" or not isinstance(data, dict):
+        return None
+    payload = data.get("payload") or {}
+    # Read receipts mean "read up to", so the newest per dialog is enough.
+    if payload.get("read_at"):
+        return event, payload.get("dialog_id"), "read"
+    return event, payload.get("dialog_id"), payload.get("message_id")
+
+
+class _BoundedQueues:
+    def _setup(self, soft_limit: int, max_queue: int, drain_interval: float, batch_window: float, batch_max: int):
+        global _manager
+        self.soft_limit = soft_limit
+        self.max_queue = max_queue
+        self.drain_interval = drain_interval
+        self.batch_window = batch_window
+        self.batch_max = batch_max
+        self.parked = {}  # eio_sid -> {collapse key: (event, packets)}
+        self.draining = False
+        self.closing = set()
+        self.batching = {}  # eio_sid -> namespace
+        self.batches = {}  # eio_sid -> {collapse key or sequence number: (event, encoded data)}
+        self.encodings = {}  # eio_sid -> wire encoding, when not JSON
+        self.flushing = False
+        self._sequence = itertools.count()
+        _manager = self
+
+    def _encode(self, event, data, namespace, encoding=wire.JSON) -> list:
+        # As in the stock manager: one encoding shared by every recipient.
+        if encoding == wire.MSGPACK:
+            data = [wire.packb(data)]
+        elif isinstance(data, tuple):
+            data = list(data)
+        elif data is not None:
+            data = [data]
+        else:
+            data = []
+        return self._packets(namespace, [event] + data)
+
+    def _packets(self, namespace, data: list) -> list:
+        # Binary data becomes a binary event whose attachment follows as its own frame.
+        encoded = self.server.packet_class(packet.EVENT, namespace=namespace, data=data).encode()
+        if not isinstance(encoded, list):
+            encoded = [encoded]
+        return [eio_packet.Packet(eio_packet.MESSAGE, p) for p in encoded]
+
+    def _recipients(self, namespace, room, skip_sid):
+        skip = skip_sid if isinstance(skip_sid, list) else [skip_sid]
+        return [(sid, eio_sid) for sid, eio_sid in self.get_participants(namespace, room) if sid not in skip]
+
+    def _active(self) -> bool:
+        return bool(self.max_queue or self.batching or self.encodings)
+
+    def _admit(self, eio_sid, key) -> int:
+        if not self.max_queue:
+            return SEND
+        socket = self.server.eio.sockets.get(eio_sid)
+        if socket is None:
+            return SEND
+        if eio_sid in self.closing or socket.closed:
+            return OVERFLOW
+        depth = socket.queue.qsize()
+        if depth >= self.max_queue or len(self.parked.get(eio_sid, ())) >= self.max_queue:
+            return OVERFLOW
+        # Once a socket has parked updates, later ones for it are parked too, so they can't overtake.
+        if key is not None and (depth >= self.soft_limit or eio_sid in self.parked):
+            return PARK
+        return SEND
+
+    def _park(self, eio_sid, key, event, packets) -> bool:
+        """Park an update; returns True when the drain task has to be started."""
+        parked = self.parked.setdefault(eio_sid, {})
+        if parked.pop(key, None) is not None:
+            metrics.incr("ws_outbound_dropped", event=event, reason="collapsed")
+        parked[key] = (event, packets)
+        if self.draining:
+            return False
+        self.draining = True
+        return True
+
+    def _ready(self) -> list:
+        """Parked updates of sockets whose queues have drained; forgets closed sockets."""
+        ready = []
+        for eio_sid in list(self.parked):
+            socket = self.server.eio.sockets.get(eio_sid)
+            if socket is None or socket.closed:
+                for event, _ in self.parked.pop(eio_sid).values():
+                    metrics.incr("ws_outbound_dropped", event=event, reason="disconnected")
+            elif socket.queue.qsize() < self.soft_limit:
+                ready.append((eio_sid, self.parked.pop(eio_sid).values()))
+        return ready
+
+    def _overflowed(self, eio_sid, event) -> bool:
+        """Count the dropped event; returns True when the socket has to be cut off."""
+        metrics.incr("ws_outbound_dropped", event=event, reason="overflow")
+        socket = self.server.eio.sockets[eio_sid]
+        if eio_sid in self.closing or socket.closed:
+            return False
+        self.closing.add(eio_sid)
+        metrics.incr("ws_outbound_overflows")
+        for parked_event, _ in self.parked.pop(eio_sid, {}).values():
+            metrics.incr("ws_outbound_dropped", event=parked_event, reason="overflow")
+        self.batches.pop(eio_sid, None)
+        logger.warning("Outbound queue of %s reached %d packets; disconnecting", eio_sid, socket.queue.qsize())
+        _clear(socket.queue)
+        return True
+
+    def enable_batching(self, sid, namespace) -> bool:
+        """Batch everything sent to ``sid`` from now on; False when batching is off."""
+        eio_sid = self.eio_sid_from_sid(sid, namespace)
+        if not self.batch_window or eio_sid is None:
+            return False
+        self.batching[eio_sid] = namespace
+        return True
+
+    def set_encoding(self, sid, namespace, encoding) -> bool:
+        """Encode everything sent to ``sid`` from now on with ``encoding``."""
+        eio_sid = self.eio_sid_from_sid(sid, namespace)
+        if eio_sid is None:
+            return False
+        if encoding == wire.JSON:
+            self.encodings.pop(eio_sid, None)
+        else:
+            self.encodings[eio_sid] = encoding
+        return True
+
+    def _batch(self, eio_sid, key, event, encoded) -> bool:
+        """Add an encoded event to the socket's batch; returns True when the flush task has to be started."""
+        batch = self.batches.setdefault(eio_sid, {})
+        if key is None:
+            key = next(self._sequence)
+        elif batch.pop(key, None) is not None:
+            metrics.incr("ws_outbound_dropped", event=event, reason="collapsed")
+        batch[key] = (event, encoded)
+        if self.flushing:
+            return False
+        self.flushing = True
+        return True
+
+    def _full_batches(self) -> list:
+        return [eio_sid for eio_sid, batch in self.batches.items() if len(batch) >= self.batch_max]
+
+    def _batch_packet(self, eio_sid, batch: dict) -> list:
+        namespace = self.batching.get(eio_sid, "/")
+        metrics.observe("ws_batch_events", len(batch), buckets=metrics.SIZE_BUCKETS)
+        if self.encodings.get(eio_sid) == wire.MSGPACK:
+            return self._packets(namespace, ["batch", wire.pack_batch([encoded for _, encoded in batch.values()])])
+        prefix = str(packet.EVENT) + ("" if namespace == "/" else namespace + ",")
+        events = ",".join(encoded for _, encoded in batch.values())
+        frame = prefix + '["batch",{"type":"batch","payload":{"events":[' + events + "]}}]"
+        return [eio_packet.Packet(eio_packet.MESSAGE, frame)]
+
+    def _take_batches(self, eio_sids=None) -> list:
+        """(eio_sid, packets) for the given sockets' batches, or for all of them."""
+        taken = []
+        for eio_sid in list(self.batches if eio_sids is None else eio_sids):
+            batch = self.batches.pop(eio_sid, None)
+            if batch:
+                taken.append((eio_sid, self._batch_packet(eio_sid, batch)))
+        return taken
+
+    def _dumps(self, data, encoding):
+        if encoding == wire.MSGPACK:
+            return wire.packb(data)
+        return self.server.packet_class.json.dumps(data, separators=(",", ":"))
+
+    def basic_disconnect(self, sid, namespace, **kwargs):
+        eio_sid = self.eio_sid_from_sid(sid, namespace)
+        self.batching.pop(eio_sid, None)
+        self.batches.pop(eio_sid, None)
+        self.encodings.pop(eio_sid, None)
+        return super().basic_disconnect(sid, namespace, **kwargs)
+
+    def depths(self) -> dict:
+        sockets = list(self.server.eio.sockets.values()) if self.server else []
+        return {
+            "max": max((s.queue.qsize() for s in sockets), default=0),
+            "parked": sum(len(p) for p in self.parked.values()),
+        }
+
+
+def _clear(queue):
+    while True:
+        try:
+            queue.get_nowait()
+        except Exception:  # queue.Empty, eventlet's or asyncio's
+            return
+        # Engine.IO joins the queue when closing; keep the count of unfinished tasks right.
+        queue.task_done()
+
+
+class BoundedManager(_BoundedQueues, socketio.Manager):
+    """For ``socketio.Server`` (Flask-SocketIO: eventlet or threading)."""
+
+    def __init__(self, soft_limit: int, max_queue: int, drain_interval=0.1, batch_window=0.0, batch_max=100):
+        super().__init__()
+        self._setup(soft_limit, max_queue, drain_interval, batch_window, batch_max)
+
+    def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        if callback or not self._active():
+            return super().emit(event, data, namespace, room=room, skip_sid=skip_sid, callback=callback, to=to, **kwargs)
+        if namespace not in self.rooms:
+            return
+        key = collapse_key(event, data)
+        packets, encoded = {}, {}  # by wire encoding
+        for sid, eio_sid in self._recipients(namespace, to or room, skip_sid):
+            encoding = self.encodings.get(eio_sid, wire.JSON)
+            if eio_sid in self.batching:
+                if encoding not in encoded:
+                    encoded[encoding] = self._dumps([event, data], encoding)
+                if self._batch(eio_sid, key, event, encoded[encoding]):
+                    self.server.start_background_task(self._flush)
+                continue
+            if encoding not in packets:
+                packets[encoding] = self._encode(event, data, namespace, encoding)
+            self._deliver(eio_sid, key, event, packets[encoding])
+        for eio_sid, batch_packets in self._take_batches(self._full_batches()):
+            self._deliver(eio_sid, None, "batch", batch_packets)
+
+    def _deliver(self, eio_sid, key, event, packets):
+        action = self._admit(eio_sid, key)
+        if action == SEND:
+            for p in packets:
+                self.server._send_eio_packet(eio_sid, p)
+        elif action == PARK:
+            if self._park(eio_sid, key, event, packets):
+                self.server.start_background_task(self._drain)
+        elif self._overflowed(eio_sid, event):
+            self.server.start_background_task(self._disconnect, eio_sid)
+
+    def _flush(self):
+        try:
+            while self.batches:
+                self.server.sleep(self.batch_window)
+                for eio_sid, packets in self._take_batches():
+                    self._deliver(eio_sid, None, "batch", packets)
+        finally:
+            self.flushing = False
+
+    def _drain(self):
+        try:
+            while self.parked:
+                self.server.sleep(self.drain_interval)
+                for eio_sid, updates in self._ready():
+                    for _, packets in updates:
+                        for p in packets:
+                            self.server._send_eio_packet(eio_sid, p)
+        finally:
+            self.draining = False
+
+    def _disconnect(self, eio_sid):
+        try:
+            socket = self.server.eio.sockets.get(eio_sid)
+            if socket is not None:
+                socket.close(wait=False, abort=True)
+        finally:
+            self.closing.discard(eio_sid)
+
+
+class AsyncBoundedManager(_BoundedQueues, socketio.AsyncManager):
+    """For the ASGI mode's ``socketio.AsyncServer``."""
+
+    def __init__(self, soft_limit: int, max_queue: int, drain_interval=0.1, batch_window=0.0, batch_max=100):
+        super().__init__()
+        self._setup(soft_limit, max_queue, drain_interval, batch_window, batch_max)
+
+    async def emit(self, event, data, namespace, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        if callback or not self._active():
+            return await super().emit(
+                event, data, namespace, room=room, skip_sid=skip_sid, callback=callback, to=to, **kwargs
+            )
+        if namespace not in self.rooms:
+            return
+        key = collapse_key(event, data)
+        packets, encoded = {}, {}  # by wire encoding
+        tasks = []
+        for sid, eio_sid in self._recipients(namespace, to or room, skip_sid):
+            encoding = self.encodings.get(eio_sid, wire.JSON)
+            if eio_sid in self.batching:
+                if encoding not in encoded:
+                    encoded[encoding] = self._dumps([event, data], encoding)
+                if self._batch(eio_sid, key, event, encoded[encoding]):
+                    self.server.start_background_task(self._flush)
+                continue
+            if encoding not in packets:
+                packets[encoding] = self._encode(event, data, namespace, encoding)
+            tasks.extend(self._deliver(eio_sid, key, event, packets[encoding]))
+        for eio_sid, batch_packets in self._take_batches(self._full_batches()):
+            tasks.extend(self._deliver(eio_sid, None, "batch", batch_packets))
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def _deliver(self, eio_sid, key, event, packets) -> list:
+        """Like ``BoundedManager._deliver``; returns the send tasks to await."""
+        action = self._admit(eio_sid, key)
+        if action == SEND:
+            return [asyncio.create_task(self.server._send_eio_packet(eio_sid, p)) for p in packets]
+        if action == PARK:
+            if self._park(eio_sid, key, event, packets):
+                self.server.start_background_task(self._drain)
+        elif self._overflowed(eio_sid, event):
+            self.server.start_background_task(self._disconnect, eio_sid)
+        return []
+
+    async def _flush(self):
+        try:
+            while self.batches:
+                await self.server.sleep(self.batch_window)
+                tasks = []
+                for eio_sid, packets in self._take_batches():
+                    tasks.extend(self._deliver(eio_sid, None, "batch", packets))
+                if tasks:
+                    await asyncio.wait(tasks)
+        finally:
+            self.flushing = False
+
+    async def _drain(self):
+        try:
+            while self.parked:
+                await self.server.sleep(self.drain_interval)
+                for eio_sid, updates in self._ready():
+                    for _, packets in updates:
+                        for p in packets:
+                            await self.server._send_eio_packet(eio_sid, p)
+        finally:
+            self.draining = False
+
+    async def _disconnect(self, eio_sid):
+        try:
+            socket = self.server.eio.sockets.get(eio_sid)
+            if socket is not None:
+                await socket.close(wait=False, abort=True)
+        finally:
+            self.closing.discard(eio_sid)
+
+
+def from_config(config, manager_class=BoundedManager):
+    """The manager for ``config``, or None (the stock one) when bounds, batching and encodings are all off."""
+    if not config.get("WS_QUEUE_MAX") and not config.get("WS_BATCH_WINDOW_MS") and not config.get("WS_ENCODINGS"):
+        return None
+    return manager_class(
+        config["WS_QUEUE_SOFT_LIMIT"],
+        config["WS_QUEUE_MAX"],
+        config["WS_QUEUE_DRAIN_INTERVAL"],
+        config["WS_BATCH_WINDOW_MS"] / 1000,
+        config["WS_BATCH_MAX_EVENTS"],
+    )
+
+
+metrics.register_gauge("ws_outbound_queue_max_depth", lambda: _manager.depths()["max"] if _manager else None)
+metrics.register_gauge("ws_outbound_parked", lambda: _manager.depths()["parked"] if _manager else None)
@@ -1,16 +1,18 @@
 from flask import request, session as socket_session
 from flask_jwt_extended import decode_token
-from sqlalchemy.exc import IntegrityError
 from flask_socketio import disconnect, join_room
 
 from app.extensions import db, socketio
+from app.ws import outbound
+from app import events, idempotency, instrumentation, rate_limit, tracing
 from app.models import Dialog, Message, Group, GroupMember, GroupMessage
+from app.serializers import serialize_group_message, serialize_message
 from app.utils.time import isoformat, parse_iso8601, utcnow
-from app.utils.security import encrypt_text, decrypt_text
+from app.utils.security import encrypt_text
 
 
 def _emit_error(message: str):
-    socketio.emit("error", {"error": {"code": "ws_error", "message": message}}, to=request.sid)
+    outbound.emit("error", {"error": {"code": "ws_error", "message": message}}, to=request.sid)
 
 
 def _require_auth():
@@ -21,28 +23,6 @@ def _require_auth():
         return None
     return user_id
 
-
-def _serialize_message(message: Message):
-    sender = message.sender
-    return {
-        "id": message.id,
-        "dialog_id": message.dialog_id,
-        "client_msg_id": message.client_msg_id,
-        "sender_id": message.sender_id,
-        "sender_username": sender.username if sender else None,
-        "sender_avatar_url": sender.avatar_url if sender else None,
-        "type": message.type,
-        "text": decrypt_text(message.text),
-        "file_url": message.file_url,
-        "file_name": message.file_name,
-        "file_mime": message.file_mime,
-        "file_size": message.file_size,
-        "created_at": isoformat(message.created_at),
-        "delivered_at": isoformat(message.delivered_at),
-        "read_at": isoformat(message.read_at),
-    }
-
-
 @socketio.on("connect")
 def handle_connect():
     socket_session["user_id"] = None
@@ -59,6 +39,11 @@ def handle_message(data):
         _emit_error("Invalid payload")
         return
     event_type = data.get("type")
+    with instrumentation.ws_event(event_type):
+        _dispatch(event_type, data)
+
+
+def _dispatch(event_type, data: dict):
     payload = data.get("payload") or {}
 
     if event_type == "auth":
@@ -68,6 +53,10 @@ def handle_message(data):
     user_id = _require_auth()
     if not user_id:
         return
+    retry_after = rate_limit.check(user_id, event_type, "ws")
+    if retry_after:
+        outbound.emit("error", rate_limit.ws_error(event_type, retry_after, payload), to=request.sid)
+        return
 
     if event_type == "message:send":
         _handle_message_send(user_id, payload)
@@ -100,6 +89,11 @@ def _handle_auth(data):
     user_id = decoded.get("sub")
     socket_session["user_id"] = user_id
     join_room(f"user:{user_id}")
+    # Only clients that asked for batching or an encoding get a reply, so older clients see no change.
+    reply = outbound.negotiate(user_id, data)
+    if reply:
+        outbound.emit("auth:ok", reply, to=request.sid)
+        outbound.apply(request.sid, reply)
 
 
 def _handle_message_send(user_id: str, payload: dict):
@@ -114,7 +108,9 @@ def _handle_message_send(user_id: str, payload: dict):
     if not dialog_id or not client_msg_id:
         _emit_error("dialog_id and client_msg_id are required")
         return
-    dialog = Dialog.query.get(dialog_id)
+    trace = tracing.MessageTrace("dialog", "ws")
+    with trace.stage("load"):
+        dialog = Dialog.query.get(dialog_id)
     if not dialog or not dialog.includes_user(user_id):
         _emit_error("Dialog not found or access denied")
         return
@@ -130,41 +126,47 @@ def _handle_message_send(user_id: str, payload: dict):
         _emit_error("Unsupported message type")
         return
 
-    message = Message(
-        dialog_id=dialog_id,
-        sender_id=user_id,
-        client_msg_id=client_msg_id,
-        type=msg_type,
-        text=encrypt_text(text) if text else None,
-        file_url=file_url,
-        file_name=file_name,
-        file_mime=file_mime,
-        file_size=file_size,
-        created_at=utcnow(),
-    )
-    db.session.add(message)
-    try:
-        db.session.commit()
-    except IntegrityError:
-        db.session.rollback()
-        message = (
-            Message.query.filter_by(sender_id=user_id, client_msg_id=client_msg_id, dialog_id=dialog_id).first()
+    with trace.stage("insert"):
+        message, created = idempotency.get_or_insert(
+            Message,
+            user_id,
+            client_msg_id,
+            lambda: dict(
+                dialog_id=dialog_id,
+                sender_id=user_id,
+                client_msg_id=client_msg_id,
+                type=msg_type,
+                text=trace.timed("encrypt", encrypt_text, text) if text else None,
+                file_url=file_url,
+                file_name=file_name,
+                file_mime=file_mime,
+                file_size=file_size,
+                created_at=utcnow(),
+            ),
         )
-        if not message:
-            _emit_error("Message conflict")
-            return
-    dialog.last_message_id = message.id
-    dialog.last_message_at = message.created_at
-    db.session.commit()
-
-    msg_payload = _serialize_message(message)
-    socketio.emit(
-        "message:ack",
-        {"type": "message:ack", "payload": {"client_msg_id": client_msg_id, "message": msg_payload}},
-        to=request.sid,
-    )
-    peer_id = dialog.peer_for(user_id).id
-    socketio.emit("message:new", {"type": "message:new", "payload": {"message": msg_payload}}, room=f"user:{peer_id}")
+    if not message or message.dialog_id != dialog_id:
+        _emit_error("Message conflict")
+        return
+    if created:
+        dialog.last_message_id = message.id
+        dialog.last_message_at = message.created_at
+        with trace.stage("commit"):
+            db.session.commit()
+
+    with trace.stage("serialize"):
+        msg_payload = serialize_message(message)
+    if created:
+        with trace.stage("cache"):
+            events.message_sent("dialog", dialog_id, message.created_at, msg_payload, [dialog.user1_id, dialog.user2_id])
+    with trace.stage("emit"):
+        outbound.emit(
+            "message:ack",
+            {"type": "message:ack", "payload": {"client_msg_id": client_msg_id, "message": msg_payload}},
+            to=request.sid,
+        )
+        peer_id = dialog.peer_for(user_id).id
+        outbound.emit("message:new", {"type": "message:new", "payload": {"message": msg_payload}}, to=f"user:{peer_id}")
+    trace.finish(message.id, created)
 
 
 def _handle_message_delivered(user_id: str, payload: dict):
@@ -185,8 +187,10 @@ def _handle_message_delivered(user_id: str, payload: dict):
         return
     message.delivered_at = delivered_at_dt
     db.session.commit()
+    events.message_delivered("dialog", message.dialog_id, message.id, message.delivered_at)
+    tracing.delivered("dialog", message, "ws")
 
-    socketio.emit(
+    outbound.emit(
         "message:status",
         {
             "type": "message:status",
@@ -197,7 +201,7 @@ def _handle_message_delivered(user_id: str, payload: dict):
                 "read_at": isoformat(message.read_at),
             },
         },
-        room=f"user:{message.sender_id}",
+        to=f"user:{message.sender_id}",
     )
 
 
@@ -227,7 +231,9 @@ def _handle_message_read(user_id: str, payload: dict):
         Message.read_at.is_(None),
     ).update({"read_at": read_at_dt}, synchronize_session=False)
     db.session.commit()
-    socketio.emit(
+    events.messages_read("dialog", dialog_id, user_id, target_message.created_at, read_at_dt)
+    tracing.read("dialog", target_message, "ws")
+    outbound.emit(
         "message:status",
         {
             "type": "message:status",
@@ -238,31 +244,9 @@ def _handle_message_read(user_id: str, payload: dict):
                 "read_at": isoformat(read_at_dt),
             },
         },
-        room=f"user:{target_message.sender_id}",
+        to=f"user:{target_message.sender_id}",
     )
 
-
-def _serialize_group_message(message: GroupMessage):
-    sender = message.sender
-    return {
-        "id": message.id,
-        "group_id": message.group_id,
-        "client_msg_id": message.client_msg_id,
-        "sender_id": message.sender_id,
-        "sender_username": sender.username if sender else None,
-        "sender_avatar_url": sender.avatar_url if sender else None,
-        "type": message.type,
-        "text": decrypt_text(message.text),
-        "file_url": message.file_url,
-        "file_name": message.file_name,
-        "file_mime": message.file_mime,
-        "file_size": message.file_size,
-        "created_at": isoformat(message.created_at),
-        "delivered_at": isoformat(message.delivered_at),
-        "read_at": isoformat(message.read_at),
-    }
-
-
 def _handle_group_message_send(user_id: str, payload: dict):
     group_id = payload.get("group_id")
     client_msg_id = payload.get("client_msg_id")
@@ -276,14 +260,16 @@ def _handle_group_message_send(user_id: str, payload: dict):
     if not group_id or not client_msg_id:
         _emit_error("group_id and client_msg_id are required")
         return
-    group = Group.query.get(group_id)
-    if not group:
-        _emit_error("Group not found")
-        return
-    member = GroupMember.query.filter_by(group_id=group_id, user_id=user_id).first()
-    if not member:
-        _emit_error("Not a member of group")
-        return
+    trace = tracing.MessageTrace("group", "ws")
+    with trace.stage("load"):
+        group = Group.query.get(group_id)
+        if not group:
+            _emit_error("Group not found")
+            return
+        member = GroupMember.query.filter_by(group_id=group_id, user_id=user_id).first()
+        if not member:
+            _emit_error("Not a member of group")
+            return
     if msg_type == "text":
         if text is None:
             _emit_error("text is required for text messages")
@@ -296,36 +282,46 @@ def _handle_group_message_send(user_id: str, payload: dict):
         _emit_error("Unsupported message type")
         return
 
-    message = GroupMessage(
-        group_id=group_id,
-        sender_id=user_id,
-        client_msg_id=client_msg_id,
-        type=msg_type,
-        text=encrypt_text(text) if text else None,
-        file_url=file_url,
-        file_name=file_name,
-        file_mime=file_mime,
-        file_size=file_size,
-        created_at=utcnow(),
-    )
-    db.session.add(message)
-    try:
-        db.session.commit()
-    except IntegrityError:
-        db.session.rollback()
-        message = (
-            GroupMessage.query.filter_by(sender_id=user_id, client_msg_id=client_msg_id, group_id=group_id).first()
+    with trace.stage("insert"):
+        message, created = idempotency.get_or_insert(
+            GroupMessage,
+            user_id,
+            client_msg_id,
+            lambda: dict(
+                group_id=group_id,
+                sender_id=user_id,
+                client_msg_id=client_msg_id,
+                type=msg_type,
+                text=trace.timed("encrypt", encrypt_text, text) if text else None,
+                file_url=file_url,
+                file_name=file_name,
+                file_mime=file_mime,
+                file_size=file_size,
+                created_at=utcnow(),
+            ),
         )
-        if not message:
-            _emit_error("Message conflict")
-            return
-
-    msg_payload = _serialize_group_message(message)
-    socketio.emit(
-        "group:message:ack",
-        {"type": "group:message:ack", "payload": {"client_msg_id": client_msg_id, "message": msg_payload}},
-        room=f"user:{user_id}",
-    )
-    member_ids = [gm.user_id for gm in GroupMember.query.filter_by(group_id=group_id).all()]
-    for uid in member_ids:
-        socketio.emit("group:message:new", {"type": "group:message:new", "payload": {"message": msg_payload}}, room=f"user:{uid}")
+    if not message or message.group_id != group_id:
+        _emit_error("Message conflict")
+        return
+    if created:
+        with trace.stage("commit"):
+            db.session.commit()
+
+    with trace.stage("serialize"):
+        msg_payload = serialize_group_message(message)
+    with trace.stage("members"):
+        member_ids = [gm.user_id for gm in GroupMember.query.filter_by(group_id=group_id).all()]
+    if created:
+        with trace.stage("cache"):
+            events.message_sent("group", group_id, message.created_at, msg_payload, member_ids)
+    with trace.stage("emit"):
+        outbound.emit(
+            "group:message:ack",
+            {"type": "group:message:ack", "payload": {"client_msg_id": client_msg_id, "message": msg_payload}},
+            to=f"user:{user_id}",
+        )
+        for uid in member_ids:
+            outbound.emit(
+                "group:message:new", {"type": "group:message:new", "payload": {"message": msg_payload}}, to=f"user:{uid}"
+            )
+    trace.finish(message.id, created)
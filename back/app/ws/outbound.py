@@ -0,0 +1,100 @@
+"""Single exit point for server-to-client Socket.IO events.
+
+REST routes and WebSocket handlers call ``emit`` instead of talking to a server
+object directly. Flask-SocketIO delivers them by default; the ASGI entry point
+(``app/asgi``) installs a backend that hands them to its ``AsyncServer``.
+
+Every emit is counted (``ws_emits``) with the number of sockets it reaches
+(``ws_emit_sockets``), read from the Socket.IO manager's room table.
+"""
+from app import wire
+from app.extensions import socketio
+from app.utils import metrics
+
+_backend = None
+_manager = None
+
+
+def set_backend(backend, manager=None):
+    """Route every ``emit`` to ``backend(event, data, to)``; None restores Flask-SocketIO.
+
+    ``manager`` is the Socket.IO client manager of the server behind ``backend``.
+    """
+    global _backend, _manager
+    _backend = backend
+    _manager = manager
+
+
+def _client_manager():
+    return _manager or getattr(socketio.server, "manager", None)
+
+
+def _rooms() -> dict:
+    manager = _client_manager()
+    if manager is None:
+        return {}
+    return manager.rooms.get("/", {})
+
+
+def record(event: str, to: str):
+    metrics.incr("ws_emits", event=event)
+    metrics.observe("ws_emit_sockets", len(_rooms().get(to) or ()), buckets=metrics.SIZE_BUCKETS)
+
+
+def emit(event: str, data: dict, to: str):
+    """Send ``event`` to a socket id or a room such as ``user:<id>``."""
+    record(event, to)
+    if _backend is not None:
+        _backend(event, data, to)
+    else:
+        socketio.emit(event, data, to=to)
+
+
+def negotiate(user_id: str, data: dict):
+    """The ``auth:ok`` reply to an ``auth`` that asked for batching or an encoding, else None.
+
+    Send the reply first and then ``apply`` it, so the client gets it in the
+    format it already knows.
+    """
+    payload = data.get("payload") or {}
+    batch = data.get("batch") or payload.get("batch")
+    encoding = data.get("encoding") or payload.get("encoding")
+    if not batch and not encoding:
+        return None
+    manager = _client_manager()
+    window = getattr(manager, "batch_window", 0.0) if batch else 0.0
+    reply = {
+        "user_id": user_id,
+        "batch": bool(window),
+        "encoding": wire.negotiate(encoding) if hasattr(manager, "set_encoding") else wire.JSON,
+    }
+    if window:
+        reply["batch_window_ms"] = round(window * 1000, 3)
+    return {"type": "auth:ok", "payload": reply}
+
+
+def apply(sid: str, reply: dict):
+    """Switch socket ``sid`` to what ``reply`` (from ``negotiate``) granted."""
+    manager = _client_manager()
+    if reply["payload"]["batch"]:
+        manager.enable_batching(sid, "/")
+    if reply["payload"]["encoding"] != wire.JSON:
+        manager.set_encoding(sid, "/", reply["payload"]["encoding"])
+
+
+def is_online(user_id: str) -> bool:
+    """Whether ``user_id`` has an authenticated socket on this server."""
+    return bool(_rooms().get(f"user:{user_id}"))
+
+
+def _connected_sockets() -> int:
+    # Every connected socket is in the namespace's ``None`` room.
+    return len(_rooms().get(None) or ())
+
+
+def _authenticated_users() -> int:
+    return sum(1 for room, sids in list(_rooms().items()) if isinstance(room, str) and room.startswith("user:") and sids)
+
+
+metrics.register_gauge("ws_connected_sockets", _connected_sockets)
+metrics.register_gauge("ws_authenticated_users", _authenticated_users)
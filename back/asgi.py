@@ -0,0 +1,8 @@
+import os
+
+# Flask-SocketIO must not pick eventlet here: the event loop belongs to uvicorn.
+os.environ.setdefault("SOCKETIO_ASYNC_MODE", "threading")
+
+from app.asgi import create_asgi_app  # noqa: E402
+
+app = create_asgi_app()
@@ -0,0 +1,93 @@
+"""Batched vs per-event delivery under the same load.
+
+Runs ``load_test.py`` twice with identical parameters, first with every
+client on per-event delivery and then with every client asking for batched
+delivery at ``auth``, each on a fresh server and database. Receipts are on by
+default (``--no-receipts`` to drop them), since status updates are what
+batching collapses. Reports frames per second the clients received, events
+per frame, server CPU per delivered message and delivery latency for both
+runs, with the ratios.
+
+    python bench/batch_bench.py --server eventlet --users 60 --group-size 20 --rate 100 --duration 20
+    WS_BATCH_WINDOW_MS=25 python bench/batch_bench.py --server asgi --output batch.json
+
+The server picks up ``WS_BATCH_WINDOW_MS`` and ``WS_BATCH_MAX_EVENTS`` from
+the environment.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+LOAD_TEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "load_test.py")
+
+
+def run(extra_args: list, batch: bool) -> dict:
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as fh:
+        output = fh.name
+    try:
+        command = [sys.executable, LOAD_TEST, *extra_args, "--output", output] + (["--batch"] if batch else [])
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        with open(output) as fh:
+            return json.load(fh)
+    finally:
+        os.unlink(output)
+
+
+def digest(result: dict) -> dict:
+    frames = result["frames"]
+    delivery = result["latency"]["delivery"]
+    server = result["server_process"] or {}
+    return {
+        "delivered": result["throughput"]["delivered"],
+        "frame_rate": frames["frame_rate"],
+        "events_per_frame": frames["events_per_frame"],
+        "server_cpu_ms_per_delivery": frames["server_cpu_ms_per_delivery"],
+        "server_cpu_percent": server.get("cpu_percent"),
+        "delivery_p50_ms": delivery.get("p50_ms"),
+        "delivery_p99_ms": delivery.get("p99_ms"),
+        "errors": result["errors"],
+    }
+
+
+def _ratio(after, before):
+    return round(after / before, 3) if after is not None and before else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=("asgi", "eventlet"), default="eventlet")
+    parser.add_argument("--users", type=int, default=40)
+    parser.add_argument("--group-size", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=100)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--no-receipts", action="store_true", help="Don't send delivered/read receipts.")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    load_args = [
+        "--server", args.server, "--users", str(args.users), "--group-size", str(args.group_size),
+        "--rate", str(args.rate), "--duration", str(args.duration), "--rest-rate", "0",
+    ] + ([] if args.no_receipts else ["--receipts"])
+    before = digest(run(load_args, batch=False))
+    after = digest(run(load_args, batch=True))
+    result = {
+        "params": dict(vars(args), batch_window_ms=os.environ.get("WS_BATCH_WINDOW_MS", "default")),
+        "per_event": before,
+        "batched": after,
+        "ratio": {
+            key: _ratio(after[key], before[key])
+            for key in ("frame_rate", "server_cpu_ms_per_delivery", "delivery_p50_ms", "delivery_p99_ms")
+        },
+    }
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Push notifications to offline recipients, with the fake provider.
+
+Builds the app on a temporary SQLite database with ``PUSH_PROVIDER=fake``,
+registers ``--users`` users with a device each and puts them in dialogs and
+groups of ``--group-size``. Users ``--online`` and up are "online": they sign
+in over Socket.IO (``socketio.test_client``) and must get nothing. Then
+``--messages`` messages go out over REST in bursts of ``--burst`` per
+conversation, and the jobs worker runs in-process after each
+``--coalesce``-second window.
+
+Reported as JSON: messages sent, recipients that were offline, jobs queued
+(``push:fanout``, ``push:notify``), notifications delivered to the fake
+provider and per offline recipient, so the effect of per-user coalescing
+shows as notifications per message received; and the REST send p50.
+
+    python bench/push_demo.py
+    python bench/push_demo.py --users 40 --messages 400 --burst 8 --output push.json
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+
+def build(args):
+    os.environ.update(
+        DATABASE_URL=f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='push-demo-'), 'push.db')}",
+        PUSH_PROVIDER="fake",
+        PUSH_COALESCE_SECONDS=str(args.coalesce),
+        RATE_LIMITS="",
+    )
+    from app import create_app
+    from app.extensions import db
+
+    app = create_app()
+    with app.app_context():
+        db.create_all(bind_key=None)
+    return app
+
+
+def run(args) -> dict:
+    app = build(args)
+    from app import jobs, push
+    from app.extensions import socketio
+    from app.models import Job
+    from app.utils import metrics
+
+    client = app.test_client()
+    rng = random.Random(args.seed)
+    users = []
+    for i in range(args.users):
+        body = client.post("/auth/register", json={"username": f"push{i}", "password": "push-demo"}).get_json()
+        headers = {"Authorization": f"Bearer {body['access_token']}"}
+        client.post("/push/devices", json={"token": f"ExponentPushToken[{i}]", "platform": "android"}, headers=headers)
+        users.append((body["user"]["id"], headers, body["access_token"]))
+    sockets = []
+    for _, _, token in users[args.online:]:
+        sock = socketio.test_client(app)
+        sock.emit("message", {"type": "auth", "access_token": token})
+        sockets.append(sock)
+
+    conversations = []
+    for (a_id, a_headers, _), (b_id, _, _) in zip(users[::2], users[1::2]):
+        dialog = client.post("/dialogs", json={"peer_user_id": b_id}, headers=a_headers).get_json()["dialog"]
+        conversations.append((f"/dialogs/{dialog['id']}/messages", a_headers))
+    for start in range(0, args.users, args.group_size):
+        members = users[start:start + args.group_size]
+        group = client.post(
+            "/groups", json={"name": f"Group {start}", "member_ids": [m[0] for m in members[1:]]},
+            headers=members[0][1],
+        ).get_json()["group"]
+        conversations.append((f"/groups/{group['id']}/messages", members[0][1]))
+
+    worker = jobs.Worker(app, concurrency=4, poll_interval=0.01)
+    latencies = []
+    fanouts = notifies = 0
+    sent = 0
+    while sent < args.messages:
+        for url, headers in rng.sample(conversations, min(len(conversations), 3)):
+            for _ in range(args.burst):
+                started = time.perf_counter()
+                client.post(url, json={"client_msg_id": f"p{sent}", "type": "text", "text": "ping"}, headers=headers)
+                latencies.append(time.perf_counter() - started)
+                sent += 1
+        with app.app_context():
+            fanouts += Job.query.filter_by(name="push:fanout").count()
+        worker.run(burst=True)
+        with app.app_context():
+            notifies += Job.query.filter_by(name="push:notify").count()
+        time.sleep(args.coalesce)
+        worker.run(burst=True)
+    for sock in sockets:
+        sock.disconnect()
+
+    provider = push.get()
+    online = {f"ExponentPushToken[{i}]" for i in range(args.online, args.users)}
+    offline = sum(v for k, v in metrics.snapshot()["counters"].items() if k.startswith("push_offline_recipients"))
+    return {
+        "messages": sent,
+        "send_p50_ms": round(statistics.median(latencies) * 1000, 3),
+        "offline_recipients": offline,
+        "fanout_jobs": fanouts,
+        "notify_jobs": notifies,
+        "notifications": len(provider.sent),
+        "notifications_to_online": sum(1 for n in provider.sent if n["token"] in online),
+        "notifications_per_message_received": round(len(provider.sent) / offline, 3) if offline else None,
+        "sample": provider.sent[:3],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--online", type=int, default=15, help="Users from this index on are online.")
+    parser.add_argument("--group-size", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--burst", type=int, default=5, help="Messages per conversation in a row.")
+    parser.add_argument("--coalesce", type=float, default=0.2, help="PUSH_COALESCE_SECONDS.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    text = json.dumps(run(args), indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
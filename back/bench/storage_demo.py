@@ -0,0 +1,215 @@
+"""Presigned uploads against a local S3 stand-in.
+
+Starts a minimal S3-compatible object server in-process: path-style buckets,
+``PUT``/``GET`` of objects, and Signature Version 4 query-string
+authentication checked from the raw request (method, path, query, the signed
+headers and ``X-Amz-Expires``). Then runs the app with ``STORAGE_BACKEND=s3``
+pointed at it and walks through the upload flow:
+
+1. ``POST /uploads/presign`` -> the client PUTs the bytes straight to the store;
+2. a message refers to the file by ``/uploads/<name>``;
+3. ``GET /uploads/<name>`` -> ``302`` to a presigned GET on the store.
+
+It also checks that the store rejects a PUT whose body or type differs from
+what was presigned, and that the legacy multipart ``POST /uploads`` still
+works. Results are printed as JSON; the app handles no attachment bytes except
+on the legacy path.
+
+    python bench/storage_demo.py
+    python bench/storage_demo.py --size 5000000 --output storage.json
+
+Against a real MinIO instead: ``STORAGE_BACKEND=s3 S3_ENDPOINT=http://localhost:9000
+S3_BUCKET=chat S3_ACCESS_KEY=... S3_SECRET_KEY=...``.
+"""
+import argparse
+import hashlib
+import hmac
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, quote, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+ACCESS_KEY = "demo-access"
+SECRET_KEY = "demo-secret"
+REGION = "us-east-1"
+BUCKET = "chat"
+
+
+def _sign(secret: str, datestamp: str, region: str, string_to_sign: str) -> str:
+    key = ("AWS4" + secret).encode()
+    for part in (datestamp, region, "s3", "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Objects in ``server.objects``; every request must carry a valid presigned query."""
+
+    def log_message(self, *args):
+        pass
+
+    def _authorized(self) -> bool:
+        parts = urlsplit(self.path)
+        query = parse_qsl(parts.query, keep_blank_values=True)
+        params = dict(query)
+        try:
+            signature = params.pop("X-Amz-Signature")
+            amz_date = params["X-Amz-Date"]
+            access_key, datestamp, region, _, _ = params["X-Amz-Credential"].split("/")
+            signed_headers = params["X-Amz-SignedHeaders"].split(";")
+            expires = int(params["X-Amz-Expires"])
+        except (KeyError, ValueError):
+            return False
+        issued = datetime.strptime(amz_date, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+        if access_key != ACCESS_KEY or datetime.now(timezone.utc) > issued + timedelta(seconds=expires):
+            return False
+        headers = {name: (self.headers.get(name) or "").strip() for name in signed_headers}
+        canonical_query = "&".join(
+            f"{quote(k, safe='-_.~')}={quote(v, safe='-_.~')}" for k, v in sorted(params.items())
+        )
+        canonical_request = "\n".join(
+            [
+                self.command,
+                parts.path,
+                canonical_query,
+                "".join(f"{name}:{headers[name]}\n" for name in signed_headers),
+                ";".join(signed_headers),
+                "UNSIGNED-PAYLOAD",
+            ]
+        )
+        string_to_sign = "\n".join(
+            ["AWS4-HMAC-SHA256", amz_date, f"{datestamp}/{region}/s3/aws4_request",
+             hashlib.sha256(canonical_request.encode()).hexdigest()]
+        )
+        return hmac.compare_digest(_sign(SECRET_KEY, datestamp, region, string_to_sign), signature)
+
+    def _reply(self, status: int, body: bytes = b"", content_type: str = "application/xml"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length)
+        if not self._authorized():
+            return self._reply(403, b"<Error><Code>SignatureDoesNotMatch</Code></Error>")
+        self.server.objects[urlsplit(self.path).path] = (body, self.headers.get("Content-Type"))
+        self._reply(200)
+
+    def do_GET(self):
+        if not self._authorized():
+            return self._reply(403, b"<Error><Code>SignatureDoesNotMatch</Code></Error>")
+        stored = self.server.objects.get(urlsplit(self.path).path)
+        if stored is None:
+            return self._reply(404, b"<Error><Code>NoSuchKey</Code></Error>")
+        self._reply(200, stored[0], stored[1] or "application/octet-stream")
+
+
+def start_stand_in():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.objects = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _request(url: str, method: str = "GET", data: bytes = None, headers: dict = None):
+    request = urllib.request.Request(url, data=data, method=method, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as exc:
+        return exc.code, exc.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=256 * 1024, help="Bytes in the uploaded file.")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    server = start_stand_in()
+    os.environ.update(
+        DATABASE_URL=f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='storage-demo-'), 'demo.db')}",
+        STORAGE_BACKEND="s3",
+        S3_ENDPOINT=f"http://127.0.0.1:{server.server_port}",
+        S3_BUCKET=BUCKET,
+        S3_REGION=REGION,
+        S3_ACCESS_KEY=ACCESS_KEY,
+        S3_SECRET_KEY=SECRET_KEY,
+        RATE_LIMITS="",
+    )
+    from app import create_app
+    from app.extensions import db
+
+    app = create_app()
+    with app.app_context():
+        db.create_all(bind_key=None)
+    client = app.test_client()
+    users = []
+    for name in ("alice", "bob"):
+        body = client.post("/auth/register", json={"username": name, "password": "storage-demo"}).get_json()
+        users.append((body["user"]["id"], {"Authorization": f"Bearer {body['access_token']}"}))
+    (alice_id, alice), (bob_id, bob) = users
+    dialog_id = client.post("/dialogs", json={"peer_user_id": bob_id}, headers=alice).get_json()["dialog"]["id"]
+
+    payload = os.urandom(args.size)
+    presigned = client.post(
+        "/uploads/presign", json={"file_name": "photo.jpg", "file_size": len(payload), "file_mime": "image/jpeg"},
+        headers=alice,
+    ).get_json()
+    upload = presigned["upload"]
+    tampered_status, _ = _request(upload["url"], "PUT", payload[:-1], upload["headers"])
+    retyped_status, _ = _request(upload["url"], "PUT", payload, {"Content-Type": "text/html"})
+    put_status, _ = _request(upload["url"], "PUT", payload, upload["headers"])
+
+    message = client.post(
+        f"/dialogs/{dialog_id}/messages",
+        json={
+            "client_msg_id": "demo-1", "type": "image", "file_url": presigned["url"],
+            "file_name": presigned["file_name"], "file_size": presigned["file_size"], "file_mime": presigned["file_mime"],
+        },
+        headers=alice,
+    ).get_json()["message"]
+    served = client.get(message["file_url"], headers=bob)
+    get_status, fetched = _request(served.headers["Location"])
+
+    legacy = client.post(
+        "/uploads", data={"file": (io.BytesIO(b"legacy bytes"), "note.txt", "text/plain")}, headers=alice,
+        content_type="multipart/form-data",
+    ).get_json()
+    legacy_status, legacy_body = _request(client.get(legacy["url"]).headers["Location"])
+
+    result = {
+        "store": os.environ["S3_ENDPOINT"],
+        "presign": {"url": presigned["url"], "put_host": urlsplit(upload["url"]).netloc},
+        "put_wrong_length_status": tampered_status,
+        "put_wrong_type_status": retyped_status,
+        "put_status": put_status,
+        "message_file_url": message["file_url"],
+        "get_redirect_status": served.status_code,
+        "get_status": get_status,
+        "bytes_match": fetched == payload,
+        "legacy_upload_match": legacy_status == 200 and legacy_body == b"legacy bytes",
+        "objects": sorted(server.objects),
+    }
+    server.shutdown()
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""Bandwidth and CPU of the wire encodings on a recorded workload.
+
+A workload is the list of Socket.IO events the server emitted, one
+``[event, data]`` JSON array per line. ``--record`` produces one: it builds
+the app on a temporary SQLite database, has ``--users`` users send
+``--messages`` messages over REST to dialogs and groups, the peer reading
+each dialog message, and captures every emit through ``outbound.set_backend``. A
+workload recorded elsewhere can be replayed with ``--workload``.
+
+Each event is encoded as the server would send it, per event and in batches of
+``--batch-size``:
+
+* ``json``: the stock Socket.IO text packet;
+* ``msgpack``: a binary event with a MessagePack attachment (``app/wire.py``).
+
+Reported as JSON: bytes per event on the wire (Socket.IO packets, without
+Engine.IO and WebSocket framing), frames, and encode/decode microseconds per
+event, with ratios against ``json``.
+
+    python bench/wire_bench.py --record workload.jsonl --users 50 --messages 2000
+    python bench/wire_bench.py --workload workload.jsonl --batch-size 20 --output wire.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import msgpack
+from socketio import packet
+
+BACK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BACK_DIR)
+
+
+def record(users: int, messages: int, seed: int) -> list:
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='wire-bench-'), 'wire.db')}"
+    os.environ["RATE_LIMITS"] = ""
+    from app import create_app
+    from app.extensions import db
+    from app.ws import outbound
+
+    app = create_app()
+    with app.app_context():
+        db.create_all(bind_key=None)
+    client = app.test_client()
+    rng = random.Random(seed)
+    events = []
+    outbound.set_backend(lambda event, data, to: events.append([event, data]))
+    try:
+        people = []
+        for i in range(users):
+            body = client.post("/auth/register", json={"username": f"wire{i}", "password": "wire-bench"}).get_json()
+            people.append((body["user"]["id"], {"Authorization": f"Bearer {body['access_token']}"}))
+        dialogs = []
+        for (a_id, a_headers), (b_id, b_headers) in zip(people[::2], people[1::2]):
+            dialog = client.post("/dialogs", json={"peer_user_id": b_id}, headers=a_headers).get_json()["dialog"]
+            dialogs.append((dialog["id"], a_headers, b_headers))
+        groups = []
+        for start in range(0, users, 10):
+            members = people[start:start + 10]
+            group = client.post(
+                "/groups", json={"name": f"wire {start}", "member_ids": [m[0] for m in members]}, headers=members[0][1]
+            ).get_json()["group"]
+            groups.append((group["id"], members))
+        for seq in range(messages):
+            text = " ".join(rng.choice(("ok", "see you", "lol", "on my way", "what time?", "sounds good")) for _ in range(3))
+            if seq % 3 == 2:
+                group_id, members = rng.choice(groups)
+                client.post(
+                    f"/groups/{group_id}/messages",
+                    json={"client_msg_id": f"w{seq}", "type": "text", "text": text},
+                    headers=rng.choice(members)[1],
+                )
+                continue
+            dialog_id, sender, reader = rng.choice(dialogs)
+            if rng.random() < 0.5:
+                sender, reader = reader, sender
+            message = client.post(
+                f"/dialogs/{dialog_id}/messages", json={"client_msg_id": f"w{seq}", "type": "text", "text": text},
+                headers=sender,
+            ).get_json()["message"]
+            client.post(
+                f"/dialogs/{dialog_id}/read_up_to",
+                json={"last_read_message_id": message["id"], "read_at": message["created_at"]},
+                headers=reader,
+            )
+    finally:
+        outbound.set_backend(None)
+    return events
+
+
+def _packets(data: list) -> list:
+    # Text for JSON; a header plus one attachment per bytes value for MessagePack.
+    encoded = packet.Packet(packet.EVENT, data=data).encode()
+    return encoded if isinstance(encoded, list) else [encoded]
+
+
+def encoders(wire):
+    """name -> (encode one [event, data], encode a batch of them, decode the encoded frames)."""
+
+    def json_batch(events):
+        return _packets(["batch", {"type": "batch", "payload": {"events": events}}])
+
+    def json_decode(frames):
+        for frame in frames:
+            packet.Packet(encoded_packet=frame)
+
+    def msgpack_batch(events):
+        return _packets(["batch", wire.pack_batch([wire.packb(e) for e in events])])
+
+    def msgpack_decode(frames):
+        for frame in frames:
+            if isinstance(frame, bytes):
+                msgpack.unpackb(frame)
+            else:
+                packet.Packet(encoded_packet=frame)
+
+    return {
+        "json": (_packets, json_batch, json_decode),
+        "msgpack": (lambda e: _packets([e[0], wire.packb(e[1])]), msgpack_batch, msgpack_decode),
+    }
+
+
+def measure(events: list, encode, batch_size: int, rounds: int) -> dict:
+    groups = [events[i:i + batch_size] for i in range(0, len(events), batch_size)] if batch_size > 1 else None
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        frames = [f for group in groups for f in encode(group)] if groups else [f for e in events for f in encode(e)]
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {"frames": frames, "encode_seconds": best}
+
+
+def run(events: list, batch_size: int, rounds: int) -> dict:
+    from app import wire
+
+    results = {}
+    for mode, size in (("per_event", 1), ("batched", batch_size)):
+        results[mode] = {}
+        for name, (single, batch, decode) in encoders(wire).items():
+            measured = measure(events, single if size == 1 else batch, size, rounds)
+            frames = measured.pop("frames")
+            started = time.perf_counter()
+            decode(frames)
+            decode_seconds = time.perf_counter() - started
+            size_bytes = sum(len(f if isinstance(f, bytes) else f.encode()) for f in frames)
+            results[mode][name] = {
+                "frames": len(frames),
+                "bytes": size_bytes,
+                "bytes_per_event": round(size_bytes / len(events), 1),
+                "encode_us_per_event": round(measured["encode_seconds"] / len(events) * 1e6, 2),
+                "decode_us_per_event": round(decode_seconds / len(events) * 1e6, 2),
+            }
+        base = results[mode]["json"]
+        for name, result in results[mode].items():
+            result["bytes_ratio"] = round(result["bytes"] / base["bytes"], 3)
+            result["encode_ratio"] = round(result["encode_us_per_event"] / base["encode_us_per_event"], 3)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--record", metavar="FILE", help="Record a workload to FILE, then measure it.")
+    source.add_argument("--workload", metavar="FILE", help="Measure a recorded workload.")
+    parser.add_argument("--users", type=int, default=40, help="Users when recording.")
+    parser.add_argument("--messages", type=int, default=1000, help="Messages sent when recording.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=20, help="Events per batch frame.")
+    parser.add_argument("--rounds", type=int, default=5, help="Encode rounds; the fastest counts.")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    if args.record:
+        events = record(args.users, args.messages, args.seed)
+        with open(args.record, "w") as fh:
+            fh.writelines(json.dumps(event, separators=(",", ":")) + "\n" for event in events)
+    else:
+        with open(args.workload) as fh:
+            events = [json.loads(line) for line in fh if line.strip()]
+
+    counts = {}
+    for event, _ in events:
+        counts[event] = counts.get(event, 0) + 1
+    result = {
+        "workload": {"events": len(events), "by_event": counts},
+        "batch_size": args.batch_size,
+        "results": run(events, args.batch_size, args.rounds),
+    }
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""username lower index
+
+Revision ID: 3f1c2a9b7d10
+Revises: de5763ef061c
+Create Date: 2026-10-19 10:12:41.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9b7d10'
+down_revision = 'de5763ef061c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_users_username_lower", "users", [sa.text("lower(username)")], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index("ix_users_username_lower", table_name="users")
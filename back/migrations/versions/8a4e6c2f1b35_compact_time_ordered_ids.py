@@ -0,0 +1,176 @@
+"""compact time-ordered ids for conversations and messages
+
+Revision ID: 8a4e6c2f1b35
+Revises: 3f1c2a9b7d10
+Create Date: 2026-10-19 14:02:17.530611
+
+Dialog, group and message ids become UUIDs stored as native ``uuid`` on
+PostgreSQL and as 16-byte blobs on SQLite. Existing dialog and group ids keep
+their value. Existing message ids are re-keyed to v7 ids built from their
+``created_at`` so history can be paged by id alone; clients only ever page with
+``next_cursor`` and re-read ids from history, so no client-side state breaks.
+
+On SQLite the declared column types are left as they are: a VARCHAR column
+stores blobs unchanged, which is all the application needs.
+"""
+import uuid
+from datetime import timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4e6c2f1b35'
+down_revision = '3f1c2a9b7d10'
+branch_labels = None
+depends_on = None
+
+BATCH = 5000
+
+# (table, column) pairs converted to the uuid type.
+UUID_COLUMNS = [
+    ("dialogs", "id"),
+    ("dialogs", "last_message_id"),
+    ("messages", "id"),
+    ("messages", "dialog_id"),
+    ("groups", "id"),
+    ("group_members", "group_id"),
+    ("group_messages", "id"),
+    ("group_messages", "group_id"),
+]
+
+# Foreign keys that point at converted columns (PostgreSQL default names).
+FOREIGN_KEYS = [
+    ("fk_dialog_last_message", "dialogs", "messages", "last_message_id"),
+    ("messages_dialog_id_fkey", "messages", "dialogs", "dialog_id"),
+    ("group_members_group_id_fkey", "group_members", "groups", "group_id"),
+    ("group_messages_group_id_fkey", "group_messages", "groups", "group_id"),
+]
+
+
+def _v7_for(created_at):
+    # Mirrors app.utils.ids.id_for_datetime; migrations don't import app code.
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    ms = int(created_at.timestamp() * 1000)
+    rand = int.from_bytes(uuid.uuid4().bytes, "big")
+    value = ms << 80 | 0x7 << 76 | (rand >> 64 & 0xFFF) << 64 | 0b10 << 62 | rand & ((1 << 62) - 1)
+    return str(uuid.UUID(int=value))
+
+
+# v7 id as 32 hex digits: 48-bit unix ms, version nibble, random bits with the
+# RFC 4122 variant; PostgreSQL casts the undashed form to uuid directly.
+PG_V7_EXPR = (
+    "lpad(to_hex(floor(extract(epoch from created_at) * 1000)::bigint), 12, '0')"
+    " || '7' || substr(md5(id || random()::text), 1, 3)"
+    " || substr('89ab', floor(random() * 4)::int + 1, 1)"
+    " || substr(md5(random()::text || id), 1, 15)"
+)
+
+
+def _rekey_messages_postgresql(table_name):
+    op.execute(
+        f"CREATE TEMPORARY TABLE {table_name}_rekey AS "
+        f"SELECT id AS old_id, {PG_V7_EXPR} AS new_id FROM {table_name}"
+    )
+    if table_name == "messages":
+        op.execute(
+            "UPDATE dialogs SET last_message_id = r.new_id FROM messages_rekey r "
+            "WHERE dialogs.last_message_id = r.old_id"
+        )
+    op.execute(
+        f"UPDATE {table_name} SET id = r.new_id FROM {table_name}_rekey r "
+        f"WHERE {table_name}.id = r.old_id"
+    )
+    op.execute(f"DROP TABLE {table_name}_rekey")
+
+
+def _rekey_messages_sqlite(bind, table_name):
+    """Give every message a v7 id derived from created_at; returns {old: new}."""
+    table = sa.table(table_name, sa.column("id", sa.String), sa.column("created_at", sa.DateTime))
+    rows = bind.execute(sa.select(table.c.id, table.c.created_at)).fetchall()
+    mapping = {row.id: _v7_for(row.created_at) for row in rows}
+    stmt = sa.text(f"UPDATE {table_name} SET id = :new WHERE id = :old")
+    items = [{"old": old, "new": uuid.UUID(new).bytes} for old, new in mapping.items()]
+    for start in range(0, len(items), BATCH):
+        bind.execute(stmt, items[start:start + BATCH])
+    return mapping
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == "postgresql":
+        for name, table, _, _ in FOREIGN_KEYS:
+            op.drop_constraint(name, table, type_="foreignkey")
+        _rekey_messages_postgresql("messages")
+        _rekey_messages_postgresql("group_messages")
+        for table, column in UUID_COLUMNS:
+            op.alter_column(
+                table,
+                column,
+                type_=sa.dialects.postgresql.UUID(as_uuid=False),
+                postgresql_using=f"{column}::uuid",
+            )
+        for name, table, referent, column in FOREIGN_KEYS:
+            op.create_foreign_key(name, table, referent, [column], ["id"])
+    else:
+        message_ids = _rekey_messages_sqlite(bind, "messages")
+        _rekey_messages_sqlite(bind, "group_messages")
+        for table, column in UUID_COLUMNS:
+            if (table, column) in (("messages", "id"), ("group_messages", "id")):
+                continue
+            rows = bind.execute(
+                sa.text(f"SELECT rowid, {column} FROM {table} WHERE {column} IS NOT NULL")
+            ).fetchall()
+            items = []
+            for rowid, value in rows:
+                if isinstance(value, bytes):
+                    continue
+                if (table, column) == ("dialogs", "last_message_id"):
+                    value = message_ids.get(value, value)
+                items.append({"rowid": rowid, "value": uuid.UUID(value).bytes})
+            for start in range(0, len(items), BATCH):
+                bind.execute(
+                    sa.text(f"UPDATE {table} SET {column} = :value WHERE rowid = :rowid"),
+                    items[start:start + BATCH],
+                )
+
+    with op.batch_alter_table('messages', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_messages_dialog_id'))
+        batch_op.create_index('ix_messages_dialog_id_id', ['dialog_id', 'id'], unique=False)
+    with op.batch_alter_table('group_messages', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_group_messages_group_id'))
+        batch_op.create_index('ix_group_messages_group_id_id', ['group_id', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('group_messages', schema=None) as batch_op:
+        batch_op.drop_index('ix_group_messages_group_id_id')
+        batch_op.create_index(batch_op.f('ix_group_messages_group_id'), ['group_id'], unique=False)
+    with op.batch_alter_table('messages', schema=None) as batch_op:
+        batch_op.drop_index('ix_messages_dialog_id_id')
+        batch_op.create_index(batch_op.f('ix_messages_dialog_id'), ['dialog_id'], unique=False)
+
+    # Re-keyed message ids stay v7; they are still valid 36-character ids.
+    bind = op.get_bind()
+    if bind.dialect.name == "postgresql":
+        for name, table, _, _ in FOREIGN_KEYS:
+            op.drop_constraint(name, table, type_="foreignkey")
+        for table, column in UUID_COLUMNS:
+            op.alter_column(table, column, type_=sa.String(length=36), postgresql_using=f"{column}::text")
+        for name, table, referent, column in FOREIGN_KEYS:
+            op.create_foreign_key(name, table, referent, [column], ["id"])
+        return
+    for table, column in UUID_COLUMNS:
+        rows = bind.execute(sa.text(f"SELECT rowid, {column} FROM {table} WHERE {column} IS NOT NULL")).fetchall()
+        items = [
+            {"rowid": rowid, "value": str(uuid.UUID(bytes=value))}
+            for rowid, value in rows
+            if isinstance(value, bytes)
+        ]
+        for start in range(0, len(items), BATCH):
+            bind.execute(
+                sa.text(f"UPDATE {table} SET {column} = :value WHERE rowid = :rowid"),
+                items[start:start + BATCH],
+            )
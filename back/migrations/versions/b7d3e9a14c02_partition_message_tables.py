@@ -0,0 +1,145 @@
+"""partition message tables
+
+Revision ID: b7d3e9a14c02
+Revises: 8a4e6c2f1b35
+Create Date: 2026-10-19 16:41:05.274019
+
+Optional: only runs on PostgreSQL with MESSAGE_PARTITIONING=1 in the
+environment, otherwise it is a no-op. ``messages`` and ``group_messages`` are
+rebuilt as tables range-partitioned by month on ``created_at``, with partitions
+for every month that has data plus MESSAGE_PARTITIONS_AHEAD months ahead and a
+DEFAULT partition as a safety net. ``flask partitions ensure`` (also run by the
+server every few hours) keeps creating the future ones.
+
+PostgreSQL requires the partition key in every unique constraint, so the
+primary keys become (id, created_at), the client_msg_id uniqueness includes
+created_at (retries are caught by app/idempotency.py instead), and the
+dialogs.last_message_id foreign key is dropped.
+
+To switch an existing database later, re-run only this revision by moving
+the version stamp around it (stamping touches no tables, so later revisions
+such as the jobs and push_devices tables stay as they are):
+
+    # plain -> partitioned
+    MESSAGE_PARTITIONING=1 flask db stamp 8a4e6c2f1b35
+    MESSAGE_PARTITIONING=1 flask db upgrade b7d3e9a14c02
+    flask db stamp head
+
+    # partitioned -> plain: copies the rows back into plain tables
+    flask db stamp b7d3e9a14c02
+    flask db downgrade 8a4e6c2f1b35
+    flask db stamp head
+
+Never downgrade to 8a4e6c2f1b35 from head: that also drops the tables of
+every later revision.
+"""
+import os
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d3e9a14c02'
+down_revision = '8a4e6c2f1b35'
+branch_labels = None
+depends_on = None
+
+TABLES = {
+    "messages": {
+        "conversation_column": "dialog_id",
+        "conversation_table": "dialogs",
+        "unique": "uq_sender_client_msg",
+        "conversation_index": "ix_messages_dialog_id_id",
+    },
+    "group_messages": {
+        "conversation_column": "group_id",
+        "conversation_table": "groups",
+        "unique": "uq_group_sender_client_msg",
+        "conversation_index": "ix_group_messages_group_id_id",
+    },
+}
+
+
+def _enabled():
+    return op.get_context().dialect.name == "postgresql" and os.getenv("MESSAGE_PARTITIONING") == "1"
+
+
+def _is_partitioned(table):
+    if op.get_context().dialect.name != "postgresql":
+        return False
+    if op.get_context().as_sql:
+        return os.getenv("MESSAGE_PARTITIONING") == "1"
+    return bool(
+        op.get_bind().exec_driver_sql(
+            f"SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('{table}')"
+        ).scalar()
+    )
+
+
+def _create_constraints(table, spec, primary_key, unique_columns):
+    column = spec["conversation_column"]
+    op.execute(f"ALTER TABLE {table} ADD CONSTRAINT {table}_pkey PRIMARY KEY ({primary_key})")
+    op.execute(f"ALTER TABLE {table} ADD CONSTRAINT {spec['unique']} UNIQUE ({unique_columns})")
+    op.execute(
+        f"ALTER TABLE {table} ADD CONSTRAINT {table}_{column}_fkey "
+        f"FOREIGN KEY ({column}) REFERENCES {spec['conversation_table']} (id)"
+    )
+    op.execute(
+        f"ALTER TABLE {table} ADD CONSTRAINT {table}_sender_id_fkey "
+        f"FOREIGN KEY (sender_id) REFERENCES users (id)"
+    )
+    op.execute(f"CREATE INDEX {spec['conversation_index']} ON {table} ({column}, id)")
+    op.execute(f"CREATE INDEX ix_{table}_sender_id ON {table} (sender_id)")
+    op.execute(f"CREATE INDEX ix_{table}_created_at ON {table} (created_at)")
+
+
+def upgrade():
+    if not _enabled():
+        return
+    months_ahead = int(os.getenv("MESSAGE_PARTITIONS_AHEAD", 3))
+    op.execute("ALTER TABLE dialogs DROP CONSTRAINT fk_dialog_last_message")
+    for table, spec in TABLES.items():
+        op.execute(
+            f"CREATE TABLE {table}_partitioned (LIKE {table} INCLUDING DEFAULTS) "
+            f"PARTITION BY RANGE (created_at)"
+        )
+        # One partition per month from the oldest row up to months_ahead from now.
+        op.execute(
+            f"""
+            DO $$
+            DECLARE
+                month date := date_trunc('month', COALESCE((SELECT min(created_at) FROM {table}), now()) AT TIME ZONE 'UTC')::date;
+                stop date := (date_trunc('month', now() AT TIME ZONE 'UTC') + interval '{months_ahead + 1} months')::date;
+            BEGIN
+                WHILE month < stop LOOP
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF {table}_partitioned FOR VALUES FROM (%L) TO (%L)',
+                        '{table}_y' || to_char(month, 'YYYY') || 'm' || to_char(month, 'MM'),
+                        to_char(month, 'YYYY-MM-DD') || ' 00:00:00+00',
+                        to_char(month + interval '1 month', 'YYYY-MM-DD') || ' 00:00:00+00'
+                    );
+                    month := (month + interval '1 month')::date;
+                END LOOP;
+            END $$;
+            """
+        )
+        op.execute(f"CREATE TABLE {table}_default PARTITION OF {table}_partitioned DEFAULT")
+        op.execute(f"INSERT INTO {table}_partitioned SELECT * FROM {table}")
+        op.execute(f"DROP TABLE {table}")
+        op.execute(f"ALTER TABLE {table}_partitioned RENAME TO {table}")
+        _create_constraints(table, spec, "id, created_at", "sender_id, client_msg_id, created_at")
+
+
+def downgrade():
+    if not _is_partitioned("messages"):
+        return
+    for table, spec in TABLES.items():
+        op.execute(f"CREATE TABLE {table}_plain (LIKE {table} INCLUDING DEFAULTS)")
+        op.execute(f"INSERT INTO {table}_plain SELECT * FROM {table}")
+        op.execute(f"DROP TABLE {table}")
+        op.execute(f"ALTER TABLE {table}_plain RENAME TO {table}")
+        _create_constraints(table, spec, "id", "sender_id, client_msg_id")
+    op.execute(
+        "ALTER TABLE dialogs ADD CONSTRAINT fk_dialog_last_message "
+        "FOREIGN KEY (last_message_id) REFERENCES messages (id)"
+    )
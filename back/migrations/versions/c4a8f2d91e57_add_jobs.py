@@ -0,0 +1,46 @@
+"""add jobs
+
+Revision ID: c4a8f2d91e57
+Revises: b7d3e9a14c02
+Create Date: 2026-10-19 22:05:13.480112
+
+Durable queue for deferred work (app/jobs.py).
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4a8f2d91e57'
+down_revision = 'b7d3e9a14c02'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "jobs",
+        sa.Column("id", sa.LargeBinary(16).with_variant(postgresql.UUID(as_uuid=False), "postgresql"), nullable=False),
+        sa.Column("queue", sa.String(length=64), nullable=False),
+        sa.Column("name", sa.String(length=128), nullable=False),
+        sa.Column("payload", sa.Text(), nullable=False),
+        sa.Column("key", sa.String(length=255), nullable=True),
+        sa.Column("status", sa.String(length=16), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("max_attempts", sa.Integer(), nullable=False),
+        sa.Column("run_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("locked_by", sa.String(length=64), nullable=True),
+        sa.Column("locked_until", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("last_error", sa.Text(), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_jobs_status_queue_run_at", "jobs", ["status", "queue", "run_at"], unique=False)
+    op.create_index("ix_jobs_key", "jobs", ["key"], unique=False)
+
+
+def downgrade():
+    op.drop_index("ix_jobs_key", table_name="jobs")
+    op.drop_index("ix_jobs_status_queue_run_at", table_name="jobs")
+    op.drop_table("jobs")
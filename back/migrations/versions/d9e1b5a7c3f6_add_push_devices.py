@@ -0,0 +1,39 @@
+"""add push devices
+
+Revision ID: d9e1b5a7c3f6
+Revises: c4a8f2d91e57
+Create Date: 2026-10-19 23:41:52.906314
+
+Device tokens for push notifications to offline recipients (app/push.py).
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd9e1b5a7c3f6'
+down_revision = 'c4a8f2d91e57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "push_devices",
+        sa.Column("id", sa.LargeBinary(16).with_variant(postgresql.UUID(as_uuid=False), "postgresql"), nullable=False),
+        sa.Column("user_id", sa.String(length=36), nullable=False),
+        sa.Column("token", sa.String(length=255), nullable=False),
+        sa.Column("platform", sa.String(length=16), nullable=True),
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("token"),
+    )
+    op.create_index("ix_push_devices_user_id", "push_devices", ["user_id"], unique=False)
+
+
+def downgrade():
+    op.drop_index("ix_push_devices_user_id", table_name="push_devices")
+    op.drop_table("push_devices")
@@ -1,3 +1,16 @@
+import os
+
+# Only when started directly: gunicorn's eventlet worker patches on its own, and
+# the flask CLI has imported too much by the time it loads this module.
+if __name__ == "__main__" and os.getenv("EVENTLET_MONKEY_PATCH", "1") == "1":
+    try:
+        import eventlet
+    except ImportError:
+        pass
+    else:
+        # Makes DB sockets and the connection pool's locks cooperative.
+        eventlet.monkey_patch()
+
 from app import create_app
 from app.extensions import socketio
 